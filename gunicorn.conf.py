@@ -0,0 +1,44 @@
+"""
+Gunicorn configuration of the web process
+
+Every setting can be overridden with environment variables, so that load tests can compare
+configurations without code changes. HTTP API is served by `truechat.wsgi:application` with sync
+or threaded workers, websockets are served by daphne in the `websocket` process of the Procfile.
+
+Events of chats are published from the workers serving HTTP and delivered by the process holding
+the websocket, so they need the Redis channel layer: without REDIS_URL the configuration is rejected.
+"""
+import multiprocessing
+import os
+
+chdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'truechat')
+bind = f'0.0.0.0:{os.environ.get("PORT", "8000")}'
+
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+# sync workers ignore threads, gthread is used when several threads are requested
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+# workers are restarted after serving this number of requests, jitter keeps them from restarting together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+if not os.environ.get('REDIS_URL'):
+    # the in-memory channel layer delivers events only within the process publishing them
+    raise RuntimeError('REDIS_URL must be set: events of chats are delivered to websockets through Redis')
+
+# the application is loaded and warmed up once in the master and shared by workers after fork
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    server.log.info('Serving with %s workers of class %s, %s threads each, keep-alive %ss',
+                    workers, worker_class, threads, keepalive)
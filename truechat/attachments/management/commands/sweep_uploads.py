@@ -0,0 +1,19 @@
+"""
+Failing of images whose uploads were lost with killed or recycled workers, e.g. hourly from cron:
+
+    manage.py sweep_uploads
+
+Images pending longer than ATTACHMENTS_PENDING_TIMEOUT are marked as failed and temporary files
+of uploads older than that are removed.
+"""
+from django.core.management.base import BaseCommand
+
+from attachments.tasks import sweep_uploads
+
+
+class Command(BaseCommand):
+    help = 'Marks images pending for too long as failed and removes their temporary files'
+
+    def handle(self, *args, **options):
+        failed, removed = sweep_uploads()
+        self.stdout.write(f'Failed {failed} images, removed {removed} temporary files')
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0001_add_image_model_generic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Загружается'), ('ready', 'Готова'), ('failed', 'Ошибка загрузки')], default='ready', max_length=15, verbose_name='Статус'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0002_image_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='storage',
+            field=models.CharField(default='cloudinary', help_text='Название хранилища из ATTACHMENTS_STORAGES', max_length=31, verbose_name='Хранилище'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:20
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0003_image_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='variants',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict, help_text='Описания уменьшенных копий картинки по их видам', verbose_name='Размеры'),
+        ),
+    ]
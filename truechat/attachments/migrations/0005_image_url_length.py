@@ -0,0 +1,18 @@
+# Generated by Django 2.2.5 on 2026-10-18 20:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attachments', '0004_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='imageURL',
+            field=models.CharField(max_length=1023, verbose_name='Image URL'),
+        ),
+    ]
@@ -1,17 +1,33 @@
-import cloudinary
 from cloudinary.models import CloudinaryField
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.fields import JSONField
 from django.db import models
 from django.utils import timezone
 
+from attachments.storage import get_storage
+
 
 class Image(models.Model):
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Загружается'),
+        (READY, 'Готова'),
+        (FAILED, 'Ошибка загрузки'),
+    ]
+
     name = models.CharField('Название картинки', max_length=255,
                             help_text='Название картинки может быть максимум в 255 символов',
                             blank=True)
-    imageURL = models.CharField(max_length=100, verbose_name='Image URL')
+    imageURL = models.CharField(max_length=1023, verbose_name='Image URL')
     imageFile = CloudinaryField('ImageFile')
+    status = models.CharField('Статус', max_length=15, choices=STATUS_CHOICES, default=READY)
+    storage = models.CharField('Хранилище', max_length=31, default='cloudinary',
+                               help_text='Название хранилища из ATTACHMENTS_STORAGES')
+    variants = JSONField('Размеры', default=dict, blank=True,
+                         help_text='Описания уменьшенных копий картинки по их видам')
 
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
@@ -22,8 +38,15 @@ class Image(models.Model):
     def __str__(self):
         return self.name
 
+    def delete_files(self):
+        """Deletes the file of the image with its size variants from the storage"""
+        storage = get_storage(self.storage)
+        for name in {variant['name'] for variant in self.variants.values()} - {self.name}:
+            storage.delete(name)
+        storage.delete(self.name)
+
     def delete(self, *args, **kwargs):
-        cloudinary.uploader.destroy(self.name)
+        self.delete_files()
         super(Image, self).delete(*args, **kwargs)
 
     class Meta:
@@ -1,10 +1,41 @@
 from rest_framework import serializers
 
 from attachments.models import Image
+from attachments.thumbnails import FULL
 
 
 class ImageFieldSerializer(serializers.ModelSerializer):
+    """
+    Image serialization with URL of the variant of given size
+
+    Images uploaded before variants were introduced, or still pending, have only the original URL.
+    """
+    imageURL = serializers.SerializerMethodField()
+    fullURL = serializers.CharField(source='imageURL', read_only=True)
+    width = serializers.SerializerMethodField()
+    height = serializers.SerializerMethodField()
+    size = serializers.SerializerMethodField()
+
+    def __init__(self, *args, size=FULL, **kwargs):
+        self.variant_size = size
+        super(ImageFieldSerializer, self).__init__(*args, **kwargs)
+
+    def get_variant(self, instance):
+        return instance.variants.get(self.variant_size) or instance.variants.get(FULL) or {}
+
+    def get_imageURL(self, instance):
+        return self.get_variant(instance).get('url', instance.imageURL)
+
+    def get_width(self, instance):
+        return self.get_variant(instance).get('width')
+
+    def get_height(self, instance):
+        return self.get_variant(instance).get('height')
+
+    def get_size(self, instance):
+        return self.get_variant(instance).get('bytes')
+
     class Meta:
         model = Image
-        fields = ['pk', 'name', 'imageURL']
+        fields = ['pk', 'name', 'imageURL', 'fullURL', 'width', 'height', 'size', 'status']
         read_only_fields = ['date_created']
@@ -0,0 +1,90 @@
+"""
+Storage backends of image files
+
+Every Image remembers the name of the storage its file was saved to, so switching
+ATTACHMENTS_STORAGE affects only new uploads and old images are still served and deleted
+by their own storage.
+"""
+import glob
+import os
+import shutil
+
+from cloudinary import uploader
+from cloudinary.utils import cloudinary_url
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from django.utils.text import get_valid_filename
+
+
+class BaseImageStorage:
+    def save(self, name, path):
+        """
+        Saves the local file at path under name and returns URL of the saved image
+
+        :param name:
+        :param path:
+        :return:
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+
+class CloudinaryImageStorage(BaseImageStorage):
+    def save(self, name, path):
+        uploader.upload(path, public_id=name)
+        return cloudinary_url(name)[0]
+
+    def delete(self, name):
+        uploader.destroy(name)
+
+
+class FileSystemImageStorage(BaseImageStorage):
+    """
+    Keeps images in ATTACHMENTS_ROOT, they are served by attachments.views.serve_image_file
+    with FileResponse, which lets the server send them with zero-copy sendfile
+    """
+
+    def __init__(self, root=None, base_url=None):
+        self.root = root or settings.ATTACHMENTS_ROOT
+        self.base_url = base_url or settings.ATTACHMENTS_URL
+
+    def path(self, filename):
+        return os.path.join(self.root, filename)
+
+    def save(self, name, path):
+        os.makedirs(self.root, exist_ok=True)
+        filename = get_valid_filename(name) + os.path.splitext(path)[1]
+        shutil.copyfile(path, self.path(filename))
+        return self.base_url + filename
+
+    def delete(self, name):
+        filename = get_valid_filename(name)
+        for path in glob.glob(self.path(glob.escape(filename))) + glob.glob(self.path(glob.escape(filename) + '.*')):
+            os.remove(path)
+
+
+_storages = {}
+
+
+def get_storage(name=None):
+    """
+    Returns instance of the storage registered in ATTACHMENTS_STORAGES by name,
+    ATTACHMENTS_STORAGE is used by default
+
+    :param name:
+    :return:
+    """
+    name = name or settings.ATTACHMENTS_STORAGE
+    if name not in _storages:
+        _storages[name] = import_string(settings.ATTACHMENTS_STORAGES[name])()
+    return _storages[name]
+
+
+@receiver(setting_changed)
+def reset_storages(setting, **kwargs):
+    if setting in ('ATTACHMENTS_STORAGES', 'ATTACHMENTS_ROOT', 'ATTACHMENTS_URL'):
+        _storages.clear()
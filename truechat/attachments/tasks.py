@@ -0,0 +1,164 @@
+"""
+Background processing of uploaded images
+
+Request threads only stream files to local temporary storage and create pending Image rows,
+uploading to the image service is done by the worker backend configured with
+ATTACHMENTS_UPLOAD_BACKEND. Uploads lost with killed workers are failed by the sweep_uploads command.
+"""
+import glob
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, close_old_connections, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject, empty
+from django.utils.module_loading import import_string
+
+from attachments.storage import get_storage
+from attachments.thumbnails import make_variants
+
+logger = logging.getLogger(__name__)
+
+# prefix of temporary files of uploads in ATTACHMENTS_UPLOAD_DIR
+UPLOAD_PREFIX = 'truechat_upload_'
+
+
+class SyncBackend:
+    """Runs tasks in the calling thread, useful for tests and management commands"""
+
+    def submit(self, func, *args):
+        func(*args)
+
+
+class ThreadPoolBackend:
+    """Runs tasks in a pool of threads of the current process, needs no external services"""
+
+    def __init__(self, max_workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or settings.ATTACHMENTS_UPLOAD_WORKERS,
+                                           thread_name_prefix='attachments')
+
+    def submit(self, func, *args):
+        self.executor.submit(func, *args)
+
+
+backend = SimpleLazyObject(lambda: import_string(settings.ATTACHMENTS_UPLOAD_BACKEND)())
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    if setting in ('ATTACHMENTS_UPLOAD_BACKEND', 'ATTACHMENTS_UPLOAD_WORKERS'):
+        backend._wrapped = empty
+
+
+def enqueue_upload(image, path):
+    """Schedules upload of the file at path for the pending image once the current transaction commits"""
+    transaction.on_commit(lambda: backend.submit(process_upload, image.pk, path))
+
+
+def process_upload(image_id, path):
+    """
+    Uploads the file of pending image with its size variants and marks it as ready,
+    or as failed if upload did not succeed
+
+    :param image_id:
+    :param path: path of the temporary file, removed afterwards
+    :return:
+    """
+    from attachments.models import Image
+    from chat.payloads import image_changed
+
+    close_old_connections()
+    try:
+        image = Image.objects.get(pk=image_id)
+        try:
+            storage = get_storage(image.storage)
+            image.imageURL = storage.save(image.name, path)
+            image.variants = make_variants(image.name, image.imageURL, path, storage)
+            image.status = Image.READY
+            updated = Image.objects.filter(pk=image_id, status=Image.PENDING)\
+                .update(imageURL=image.imageURL, variants=image.variants, status=image.status)
+        except Exception:
+            logger.exception('Upload of image %s failed', image_id)
+            mark_failed(image)
+            return
+        if not updated:
+            # image was deleted or failed by sweep_uploads during the upload, nothing refers to its files
+            try:
+                image.delete_files()
+            except Exception:
+                logger.exception('Files of removed image %s were not deleted', image_id)
+            return
+        image_changed(image)
+        notify_image_ready(image)
+    except Image.DoesNotExist:
+        # image was deleted before its upload started
+        pass
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        close_old_connections()
+
+
+def mark_failed(image):
+    """Marks image as failed and deletes files saved before the failure"""
+    from attachments.models import Image
+    from chat.payloads import image_changed
+
+    if image.imageURL:
+        try:
+            image.delete_files()
+        except Exception:
+            logger.exception('Files of failed image %s were not deleted', image.pk)
+    # replaces the connection if the failure broke it
+    close_old_connections()
+    try:
+        Image.objects.filter(pk=image.pk).update(status=Image.FAILED)
+    except DatabaseError:
+        logger.exception('Image %s was not marked as failed, it is left to sweep_uploads', image.pk)
+        return
+    image_changed(image)
+
+
+def sweep_uploads():
+    """
+    Marks images pending longer than ATTACHMENTS_PENDING_TIMEOUT as failed, their uploads
+    were lost with killed or recycled workers, and removes temporary files left by them
+
+    :return: numbers of failed images and of removed files
+    """
+    from attachments.models import Image
+    from chat.payloads import image_changed
+
+    deadline = timezone.now() - timedelta(seconds=settings.ATTACHMENTS_PENDING_TIMEOUT)
+    images = list(Image.objects.filter(status=Image.PENDING, date_created__lt=deadline))
+    Image.objects.filter(pk__in=[image.pk for image in images], status=Image.PENDING).update(status=Image.FAILED)
+    for image in images:
+        image_changed(image)
+
+    removed = 0
+    for path in glob.glob(os.path.join(glob.escape(settings.ATTACHMENTS_UPLOAD_DIR), UPLOAD_PREFIX + '*')):
+        try:
+            if os.path.getmtime(path) < deadline.timestamp():
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            # removed by the upload in the meantime
+            pass
+    return len(images), removed
+
+
+def notify_image_ready(image):
+    """Lets clients know that placeholder of the image resolved to its URL"""
+    from chat import events
+    from chat.models import Chat, Message
+
+    obj = image.content_object
+    if isinstance(obj, Message):
+        events.message_updated(obj)
+    elif isinstance(obj, Chat):
+        events.chat_updated(obj)
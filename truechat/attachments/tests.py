@@ -1,3 +1,176 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from django.utils import timezone
+from PIL import Image as PILImage
+from rest_framework.test import APITransactionTestCase
+
+from attachments.models import Image
+from attachments import thumbnails
+from attachments.tasks import UPLOAD_PREFIX, process_upload, sweep_uploads
+from chat.models import Chat, Message
+from custom_auth.models import User
+
+
+def make_png(size=(400, 200)):
+    buffer = BytesIO()
+    PILImage.new('RGB', size, 'red').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class UploadTestCase(APITransactionTestCase):
+    """Uploads run synchronously after commit with images kept in temporary directories"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(shutil.rmtree, self.upload_dir)
+        settings = override_settings(ATTACHMENTS_STORAGE='filesystem', ATTACHMENTS_ROOT=self.root,
+                                     ATTACHMENTS_UPLOAD_DIR=self.upload_dir,
+                                     ATTACHMENTS_UPLOAD_BACKEND='attachments.tasks.SyncBackend')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+        self.message = Message.objects.create(chat=self.chat, user=self.user, content='look')
+        self.client.force_authenticate(self.user)
+
+    def upload(self, name='photo.png', content=None):
+        file = SimpleUploadedFile(name, content or make_png(), content_type='image/png')
+        response = self.client.post(f'/messages/{self.message.id}/upload_photo/', {'file': file})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def temporary_files(self):
+        return os.listdir(self.upload_dir)
+
+
+class ProcessUploadTest(UploadTestCase):
+    def test_upload_makes_image_ready(self):
+        self.upload()
+        image = Image.objects.get()
+        self.assertEqual(image.status, Image.READY)
+        self.assertEqual(image.variants['full']['width'], 400)
+        self.assertEqual(image.variants['preview']['width'], 320)
+        self.assertTrue(os.path.exists(os.path.join(self.root, os.path.basename(image.imageURL))))
+        self.assertEqual(self.temporary_files(), [])
+
+    def test_failed_update_marks_image_failed(self):
+        # URL longer than the column makes the final update fail after the files are saved
+        with override_settings(ATTACHMENTS_URL='/' + 'x' * 1100 + '/'), self.assertLogs('attachments.tasks', 'ERROR'):
+            self.upload()
+        image = Image.objects.get()
+        self.assertEqual(image.status, Image.FAILED)
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(self.temporary_files(), [])
+
+    def test_files_of_image_deleted_during_upload_are_deleted(self):
+        def make_variants(name, url, path, storage):
+            Image.objects.all().delete()
+            return thumbnails.make_variants(name, url, path, storage)
+
+        with mock.patch('attachments.tasks.make_variants', make_variants), \
+                mock.patch('attachments.tasks.notify_image_ready') as notify, \
+                mock.patch('attachments.tasks.mark_failed') as mark_failed:
+            self.upload()
+        mark_failed.assert_not_called()
+        self.assertFalse(Image.objects.exists())
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(self.temporary_files(), [])
+        notify.assert_not_called()
+
+    def test_deleted_image_is_not_uploaded(self):
+        path = os.path.join(self.upload_dir, UPLOAD_PREFIX + 'gone.png')
+        with open(path, 'wb') as file:
+            file.write(make_png())
+        process_upload(0, path)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(self.root) and os.listdir(self.root))
+
+
+class SweepUploadsTest(UploadTestCase):
+    def create_pending(self, age):
+        image = Image.objects.create(name='pending', imageURL='', status=Image.PENDING, content_object=self.message)
+        Image.objects.filter(pk=image.pk).update(date_created=timezone.now() - age)
+        return image
+
+    def create_temporary_file(self, age):
+        path = os.path.join(self.upload_dir, UPLOAD_PREFIX + str(age.total_seconds()))
+        open(path, 'wb').close()
+        modified = time.time() - age.total_seconds()
+        os.utime(path, (modified, modified))
+        return path
+
+    @override_settings(ATTACHMENTS_PENDING_TIMEOUT=600)
+    def test_stale_uploads_are_swept(self):
+        stale, fresh = self.create_pending(timedelta(hours=1)), self.create_pending(timedelta(minutes=1))
+        stale_path = self.create_temporary_file(timedelta(hours=1))
+        fresh_path = self.create_temporary_file(timedelta(minutes=1))
+        other_path = os.path.join(self.upload_dir, 'other_file')
+        open(other_path, 'wb').close()
+        os.utime(other_path, (0, 0))
+
+        self.assertEqual(sweep_uploads(), (1, 1))
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual(stale.status, Image.FAILED)
+        self.assertEqual(fresh.status, Image.PENDING)
+        self.assertEqual(sorted(self.temporary_files()), sorted(map(os.path.basename, [fresh_path, other_path])))
+        self.assertFalse(os.path.exists(stale_path))
+
+
+class ImageNamesTest(UploadTestCase):
+    def test_uploads_of_same_file_keep_their_own_files(self):
+        for content in (make_png((10, 10)), make_png((20, 20))):
+            self.upload(content=content)
+        first, second = Image.objects.order_by('id')
+        self.assertNotEqual(first.name, second.name)
+        self.assertTrue(first.name.startswith('photo_'))
+        second.delete()
+        response = self.client.get(first.imageURL)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PILImage.open(BytesIO(b''.join(response.streaming_content))).size, (10, 10))
+        self.assertIn('immutable', response['Cache-Control'])
+
+
+class VariantsTest(UploadTestCase):
+    def test_variants_fit_their_sizes(self):
+        self.upload(content=make_png((1000, 500)))
+        variants = Image.objects.get().variants
+        self.assertEqual((variants['avatar']['width'], variants['avatar']['height']), (64, 32))
+        self.assertEqual((variants['preview']['width'], variants['preview']['height']), (320, 160))
+        self.assertLess(variants['avatar']['bytes'], variants['full']['bytes'])
+        self.assertEqual(len({variant['url'] for variant in variants.values()}), 3)
+
+    def test_small_image_is_its_own_variant(self):
+        self.upload(content=make_png((50, 50)))
+        variants = Image.objects.get().variants
+        self.assertEqual(variants['avatar'], variants['full'])
+
+    def test_not_an_image_has_only_full_variant(self):
+        self.upload(name='notes.txt', content=b'not an image')
+        image = Image.objects.get()
+        self.assertEqual(image.status, Image.READY)
+        self.assertEqual(list(image.variants), ['full'])
+
+    def test_serializers_return_size_appropriate_urls(self):
+        self.upload()
+        image = Image.objects.get()
+        message = self.client.get(f'/messages/{self.message.id}/').data
+        self.assertEqual(message['images'][0]['imageURL'], image.variants['preview']['url'])
+        self.assertEqual(message['images'][0]['fullURL'], image.imageURL)
+        self.assertEqual(message['images'][0]['width'], 320)
+
+        Image.objects.create(name='avatar', imageURL='/legacy.png', content_object=self.user)
+        chat = self.client.get(f'/chats/{self.chat.id}/').data
+        self.assertEqual(chat['creator']['images'][0]['imageURL'], '/legacy.png')
@@ -0,0 +1,62 @@
+"""
+Generation of size variants of uploaded images
+
+Every ready image has a `full` variant, which is the uploaded file itself, and smaller variants
+listed in ATTACHMENTS_VARIANT_SIZES, which fit into a square of the given side.
+Variants are described by {'name', 'url', 'width', 'height', 'bytes'} stored in Image.variants.
+"""
+import os
+import tempfile
+
+from django.conf import settings
+from PIL import Image as PILImage, ImageOps
+
+FULL = 'full'
+
+
+def describe(name, url, path, size=(None, None)):
+    width, height = size
+    return {'name': name, 'url': url, 'width': width, 'height': height, 'bytes': os.path.getsize(path)}
+
+
+def make_variants(name, url, path, storage):
+    """
+    Creates variants of the image already saved to storage under name and url from the local file at path
+
+    :param name:
+    :param url:
+    :param path:
+    :param storage:
+    :return: dict of variant descriptions by their kinds
+    """
+    try:
+        with PILImage.open(path) as source:
+            source = ImageOps.exif_transpose(source)
+            variants = {FULL: describe(name, url, path, source.size)}
+            for kind, side in settings.ATTACHMENTS_VARIANT_SIZES.items():
+                if max(source.size) <= side:
+                    variants[kind] = variants[FULL]
+                else:
+                    variants[kind] = make_variant(f'{name}_{kind}', source, side, storage)
+    except (IOError, OSError, SyntaxError):
+        # not an image Pillow can read, only the original file is available
+        variants = {FULL: describe(name, url, path)}
+    return variants
+
+
+def make_variant(name, source, side, storage):
+    has_alpha = source.mode in ('RGBA', 'LA') or (source.mode == 'P' and 'transparency' in source.info)
+    thumbnail = source.convert('RGBA' if has_alpha else 'RGB')
+    thumbnail.thumbnail((side, side), PILImage.LANCZOS)
+    extension = '.png' if has_alpha else '.jpg'
+    with tempfile.NamedTemporaryFile(dir=settings.ATTACHMENTS_UPLOAD_DIR, prefix='variant_', suffix=extension,
+                                     delete=False) as temporary_file:
+        if has_alpha:
+            thumbnail.save(temporary_file, 'PNG', optimize=True)
+        else:
+            thumbnail.save(temporary_file, 'JPEG', quality=85, optimize=True, progressive=True)
+    try:
+        url = storage.save(name, temporary_file.name)
+        return describe(name, url, temporary_file.name, thumbnail.size)
+    finally:
+        os.remove(temporary_file.name)
@@ -1,7 +1,8 @@
 from django.urls import path
 
-from attachments.views import message_destroy_image
+from attachments.views import message_destroy_image, serve_image_file
 
 urlpatterns = [
-    path(r'<int:pk>/delete_image/', message_destroy_image)
+    path(r'<int:pk>/delete_image/', message_destroy_image, name='image_delete'),
+    path(r'files/<str:filename>', serve_image_file, name='image_file'),
 ]
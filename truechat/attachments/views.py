@@ -1,12 +1,18 @@
-from random import randint
+import mimetypes
+import os
+import re
+import tempfile
+from uuid import uuid4
 
-from cloudinary import uploader
-from cloudinary.templatetags import cloudinary
+from django.conf import settings
+from django.http import FileResponse, Http404
 from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 
 from attachments.models import Image
+from attachments.storage import FileSystemImageStorage, get_storage
+from attachments.tasks import UPLOAD_PREFIX, enqueue_upload
 from chat.models import Message, Chat
 from custom_auth.models import User
 
@@ -14,22 +20,35 @@ from custom_auth.models import User
 class ImageMixin:
 
     @staticmethod
-    def upload_image_cloudinary(file, image_name):
-        uploader.upload(
-            file,
-            public_id=image_name,
-        )
+    def save_temporary_file(file):
+        """Streams uploaded file to local temporary storage and returns its path, keeping the extension"""
+        extension = os.path.splitext(file.name)[1].lower()
+        if not re.fullmatch(r'\.\w{1,8}', extension):
+            extension = ''
+        with tempfile.NamedTemporaryFile(dir=settings.ATTACHMENTS_UPLOAD_DIR, prefix=UPLOAD_PREFIX, suffix=extension,
+                                         delete=False) as temporary_file:
+            for chunk in file.chunks():
+                temporary_file.write(chunk)
+        return temporary_file.name
 
     @staticmethod
     def post_cloudinary(request, obj):
-        print(request.FILES)
+        """
+        Creates pending images for all uploaded files, uploads are finished in background
+        and images get their imageURL when they become ready
+
+        :param request:
+        :param obj:
+        :return:
+        """
         for file in request.FILES.values():
-            image_name = '{0}_v{1}'.format(file.name.split('.')[0],
-                                           randint(1000, 9999))
-            ImageMixin.upload_image_cloudinary(file=file, image_name=image_name)
-            image_url = cloudinary.utils.cloudinary_url(image_name)[0]
-            image = Image(name=image_name, imageURL=image_url, content_object=obj)
+            # names are unique, files of other images are never overwritten and cached files never change
+            image_name = '{0}_{1}'.format(file.name.split('.')[0][:100], uuid4().hex)
+            path = ImageMixin.save_temporary_file(file)
+            image = Image(name=image_name, imageURL='', status=Image.PENDING, storage=settings.ATTACHMENTS_STORAGE,
+                          content_object=obj)
             image.save()
+            enqueue_upload(image, path)
 
     @staticmethod
     def can_change_photo(user, image):
@@ -62,3 +81,24 @@ def message_destroy_image(request, pk=None):
         return Response(status=status.HTTP_403_FORBIDDEN)
     image.delete()
     return Response(status=status.HTTP_200_OK)
+
+
+def serve_image_file(request, filename):
+    """
+    Returns image file saved by the filesystem storage
+
+    :param request:
+    :param filename:
+    :return:
+    """
+    storage = get_storage('filesystem')
+    if not isinstance(storage, FileSystemImageStorage) or os.path.basename(filename) != filename:
+        raise Http404
+    try:
+        file = open(storage.path(filename), 'rb')
+    except (FileNotFoundError, IsADirectoryError):
+        raise Http404
+    response = FileResponse(file, content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    # names of images are never reused
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
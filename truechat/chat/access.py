@@ -0,0 +1,130 @@
+"""
+Resolution of users' access to chats
+
+Access of a user to a chat is defined by their Membership (absent, active or banned)
+and by whether they created the chat. Memberships are looked up once per request on the primary.
+With SHARED_CACHE they are kept in the cache for CHAT_ACCESS_CACHE_TIMEOUT seconds under
+a version token, which is dropped whenever the membership is created, changed or deleted,
+the same way as tokens of payloads. Without a shared cache they are always read from the database,
+a process would otherwise keep letting removed or banned users in.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from chat.models import Chat, Membership
+from chat.payloads import forget, get_versions
+from truechat.replicas import use_primary
+
+ACCESS = 'access'
+# cached value for users without membership, None means a cache miss
+NO_MEMBERSHIP = (0, False)
+
+
+class ChatAccess:
+    def __init__(self, membership_id, is_banned, is_creator):
+        self.membership_id = membership_id
+        self.is_banned = is_banned
+        self.is_creator = is_creator
+
+    @property
+    def has_membership(self):
+        return self.membership_id is not None
+
+    @property
+    def is_member(self):
+        """Same as Chat.is_member: user has a membership, banned or not, or created the chat"""
+        return self.has_membership or self.is_creator
+
+    @property
+    def can_access(self):
+        """User may read and write the chat"""
+        if self.has_membership:
+            return not self.is_banned
+        return self.is_creator
+
+
+def access_object(chat_id, user_id):
+    """(kind, pk) pair of the version token of user's access to chat"""
+    return ACCESS, f'{chat_id}.{user_id}'
+
+
+def cache_key(chat_id, user_id, version):
+    return f'chat.access.{chat_id}.{user_id}.{version}'
+
+
+def read_membership(chat_id, user_id):
+    # a lagging replica would still let in removed or banned users
+    with use_primary():
+        return Membership.objects.filter(chat_id=chat_id, user_id=user_id)\
+            .values_list('id', 'is_banned').first() or NO_MEMBERSHIP
+
+
+def load_membership(chat_id, user_id):
+    """
+    Returns (membership id, is banned) of user in chat from the shared cache or the database
+
+    :param chat_id:
+    :param user_id:
+    :return: (0, False) if user has no membership
+    """
+    if not settings.SHARED_CACHE:
+        return read_membership(chat_id, user_id)
+    obj = access_object(chat_id, user_id)
+    # the version is read before the database, a membership read before a change is cached under a dropped version
+    key = cache_key(chat_id, user_id, get_versions([obj])[obj])
+    membership = cache.get(key)
+    if membership is None:
+        membership = read_membership(chat_id, user_id)
+        cache.set(key, membership, settings.CHAT_ACCESS_CACHE_TIMEOUT)
+    return membership
+
+
+def get_access(request, chat, user=None):
+    """
+    Returns access of user (the requesting user by default) to chat, resolved once per request
+
+    :param request:
+    :param chat:
+    :param user:
+    :return: ChatAccess
+    """
+    user = user or request.user
+    resolved = request.__dict__.setdefault('_chat_access', {})
+    key = (chat.pk, user.pk)
+    if key not in resolved:
+        membership_id, is_banned = load_membership(chat.pk, user.pk)
+        resolved[key] = ChatAccess(membership_id or None, is_banned, chat.creator_id == user.pk)
+    return resolved[key]
+
+
+def forget_access(chat_id, user_ids):
+    """
+    Drops version tokens of cached access of users to chat, also after the current transaction commits,
+    so that access cached by concurrent requests from the state which is being changed is not used
+
+    :param chat_id:
+    :param user_ids:
+    :return:
+    """
+    if settings.SHARED_CACHE:
+        forget([access_object(chat_id, user_id) for user_id in user_ids])
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def membership_changed(sender, instance, **kwargs):
+    forget_access(instance.chat_id, [instance.user_id])
+
+
+@receiver(m2m_changed, sender=Chat.users.through)
+def chat_users_added(sender, instance, action, reverse, pk_set, **kwargs):
+    """Chat.users.add() creates memberships without save signals, removal deletes them one by one"""
+    if action != 'post_add':
+        return
+    if reverse:
+        for chat_id in pk_set:
+            forget_access(chat_id, [instance.pk])
+    else:
+        forget_access(instance.pk, pk_set)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ChatConfig(AppConfig):
     name = 'chat'
+
+    def ready(self):
+        # connects invalidation of cached chat access and payloads
+        from chat import access, payloads  # noqa: F401
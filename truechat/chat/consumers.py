@@ -0,0 +1,59 @@
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from chat.events import chat_group, user_group
+from chat.models import Chat
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Pushes events of all chats available to the connected user
+
+    Server sends `{"event": "message.created", "data": {...}}` objects, where data of message events
+    is the same as MessageSerializer returns. Connections are idle coroutines, they do not hold
+    threads or database connections between events.
+    """
+
+    async def connect(self):
+        user = self.scope['user']
+        if not user.is_authenticated:
+            await self.close()
+            return
+        self.subscriptions = set()
+        await self.subscribe(user_group(user.id))
+        for chat_id in await self.get_chat_ids(user):
+            await self.subscribe(chat_group(chat_id))
+        await self.accept()
+
+    async def disconnect(self, code):
+        for group in list(getattr(self, 'subscriptions', [])):
+            await self.unsubscribe(group)
+
+    async def receive_json(self, content, **kwargs):
+        if content.get('type') == 'ping':
+            await self.send_json({'event': 'pong'})
+
+    async def chat_event(self, event):
+        if 'subscribe' in event:
+            if event['subscribe']:
+                await self.subscribe(chat_group(event['chat']))
+            else:
+                await self.unsubscribe(chat_group(event['chat']))
+        elif event['event'].startswith('membership.') and event['data']['user']['id'] == self.scope['user'].id:
+            # own membership changes come through the user group together with subscription changes
+            return
+        await self.send_json({'event': event['event'], 'data': event['data']})
+
+    async def subscribe(self, group):
+        if group not in self.subscriptions:
+            self.subscriptions.add(group)
+            await self.channel_layer.group_add(group, self.channel_name)
+
+    async def unsubscribe(self, group):
+        if group in self.subscriptions:
+            self.subscriptions.discard(group)
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    @database_sync_to_async
+    def get_chat_ids(self, user):
+        return list(Chat.objects.available_to(user).values_list('id', flat=True))
@@ -0,0 +1,127 @@
+"""
+Chat events: recording to the change log and fan-out to connected websocket clients
+
+Every event is written to ChatChange within the current transaction, so that reconnecting
+clients can catch up through the sync endpoint. Websocket fan-out happens after the transaction
+commits, so clients never receive data which may still be rolled back. Events of a batch
+are sent together from a single callback.
+
+Every chat has a channel layer group which sockets of its members are subscribed to,
+every user has a group used to subscribe their sockets to chats they join.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from chat.models import ChatChange
+
+
+def chat_group(chat_id):
+    return f'chat.{chat_id}'
+
+
+def user_group(user_id):
+    return f'user.{user_id}'
+
+
+def _group_send(messages):
+    """Sends (group, message) pairs in order with a single switch to the event loop"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    async def send():
+        for group, message in messages:
+            await channel_layer.group_send(group, message)
+
+    async_to_sync(send)()
+
+
+def _message(event, data, **extra):
+    return dict(type='chat.event', event=event, data=data, **extra)
+
+
+def _publish(*messages):
+    """Sends (group, message) pairs after the current transaction commits"""
+    transaction.on_commit(lambda: _group_send(messages))
+
+
+def message_created(message):
+    from chat.serializers import MessageSerializer
+    ChatChange.objects.create(event=ChatChange.MESSAGE_CREATED, chat_id=message.chat_id, object_id=message.id)
+    _publish((chat_group(message.chat_id), _message(ChatChange.MESSAGE_CREATED, MessageSerializer(message).data)))
+
+
+def messages_created(messages, data):
+    """
+    Records and publishes creation of a batch of messages
+
+    :param messages:
+    :param data: serialized messages in the same order
+    :return:
+    """
+    ChatChange.objects.bulk_create([ChatChange(event=ChatChange.MESSAGE_CREATED, chat_id=message.chat_id,
+                                               object_id=message.id) for message in messages])
+    _publish(*[(chat_group(message.chat_id), _message(ChatChange.MESSAGE_CREATED, message_data))
+               for message, message_data in zip(messages, data)])
+
+
+def message_updated(message):
+    from chat.serializers import MessageSerializer
+    ChatChange.objects.create(event=ChatChange.MESSAGE_UPDATED, chat_id=message.chat_id, object_id=message.id)
+    _publish((chat_group(message.chat_id), _message(ChatChange.MESSAGE_UPDATED, MessageSerializer(message).data)))
+
+
+def message_deleted(chat_id, message_id):
+    ChatChange.objects.create(event=ChatChange.MESSAGE_DELETED, chat_id=chat_id, object_id=message_id)
+    _publish((chat_group(chat_id), _message(ChatChange.MESSAGE_DELETED, {'id': message_id, 'chat': chat_id})))
+
+
+def membership_changed(chat, user, event):
+    """
+    Notifies chat about membership change of user and (un)subscribes sockets of the user
+
+    :param chat:
+    :param user:
+    :param event: one of ChatChange.MEMBERSHIP_* events
+    :return:
+    """
+    memberships_changed(chat, [user], event)
+
+
+def memberships_changed(chat, users, event):
+    """
+    Notifies chat about the same membership change of several users
+
+    :param chat:
+    :param users:
+    :param event: one of ChatChange.MEMBERSHIP_* events
+    :return:
+    """
+    ChatChange.objects.bulk_create([ChatChange(event=event, chat_id=chat.id, user_id=user.id) for user in users])
+    subscribe = event in (ChatChange.MEMBERSHIP_ADDED, ChatChange.MEMBERSHIP_UNBANNED)
+    messages = []
+    for user in users:
+        data = {'chat': chat.id, 'user': {'id': user.id, 'username': user.username}}
+        messages += [(chat_group(chat.id), _message(event, data)),
+                     (user_group(user.id), _message(event, data, chat=chat.id, subscribe=subscribe))]
+    _publish(*messages)
+
+
+def chat_updated(chat):
+    from chat.serializers import ChatSerializerChange
+    ChatChange.objects.create(event=ChatChange.CHAT_UPDATED, chat_id=chat.id)
+    _publish((chat_group(chat.id), _message(ChatChange.CHAT_UPDATED, ChatSerializerChange(chat).data)))
+
+
+def chat_deleted(chat_id, user_ids):
+    """
+    Notifies users who had access to the deleted chat
+
+    :param chat_id:
+    :param user_ids: ids of members and the creator, collected before deletion
+    :return:
+    """
+    ChatChange.objects.bulk_create([ChatChange(event=ChatChange.CHAT_DELETED, chat_id=chat_id, user_id=user_id)
+                                    for user_id in user_ids])
+    _publish((chat_group(chat_id), _message(ChatChange.CHAT_DELETED, {'id': chat_id})))
@@ -0,0 +1,55 @@
+"""
+Benchmark of the chat API on data generated by seed_data
+
+    manage.py benchmark --requests 500 --concurrency 4 --output results.json
+    manage.py benchmark list scroll --baseline results.json
+
+Scenarios: list, list_page, scroll, send, search_profiles and search_messages, all of them by default.
+`send` adds messages to the generated chats. Results are saved to BENCHMARK_DIR/<date>-<commit>.json
+unless --output is given.
+"""
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from truechat.benchmark import runner
+from truechat.benchmark.scenarios import SCENARIOS, Context
+
+
+class Command(BaseCommand):
+    help = 'Runs benchmark scenarios against the API and saves latency percentiles, throughput and query counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', metavar='scenario', help=f'One of {", ".join(SCENARIOS)}')
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests of every scenario')
+        parser.add_argument('--concurrency', type=int, default=1, help='Number of threads making requests')
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests of every thread')
+        parser.add_argument('--users', type=int, default=200, help='Number of generated users making requests')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='File to save results to')
+        parser.add_argument('--baseline', help='File with earlier results to compare with')
+
+    def handle(self, *args, scenarios, requests, concurrency, warmup, users, seed, output, baseline, **options):
+        if requests < 1 or concurrency < 1 or warmup < 0:
+            raise CommandError('--requests and --concurrency must be positive')
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+        try:
+            context = Context(users, seed)
+        except ValueError as e:
+            raise CommandError(e)
+        selected = {name: SCENARIOS[name] for name in scenarios or SCENARIOS}
+        results = runner.run(selected, context, requests, concurrency, warmup, seed, log=self.stdout.write)
+
+        if output is None:
+            os.makedirs(settings.BENCHMARK_DIR, exist_ok=True)
+            output = os.path.join(settings.BENCHMARK_DIR, f'{time.strftime("%Y%m%d-%H%M%S")}-{results["commit"]}.json')
+        runner.save(results, output)
+        self.stdout.write(self.style.SUCCESS(f'Saved results to {output}'))
+        if baseline:
+            with open(baseline) as file:
+                runner.compare(results, json.load(file), self.stdout.write)
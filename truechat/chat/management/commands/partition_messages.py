@@ -0,0 +1,170 @@
+"""
+Partitioning of the messages table
+
+Converts `messages` into a partitioned table, moving existing rows, or maintains partitions
+of an already partitioned one:
+
+    manage.py partition_messages range --ahead 3   # monthly partitions by date_created
+    manage.py partition_messages hash --partitions 16   # partitions by chat_id
+
+Range partitioning keeps recent months small and hot, pages of ChatViewSet.messages are bounded
+by date_created and touch only partitions of their range. Running it again, e.g. daily,
+creates partitions for the upcoming months, messages of them which landed in the default partition
+are moved to the new partitions. Hash partitioning spreads chats over partitions
+of equal size, every query of a chat's messages touches a single partition.
+
+Conversion locks messages against writes until it is finished, reads are not blocked.
+"""
+from datetime import date, datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from chat.models import Message
+
+TABLE = Message._meta.db_table
+STRATEGIES = {'r': 'range', 'h': 'hash'}
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+class Command(BaseCommand):
+    help = 'Partitions messages by month of date_created or by hash of chat_id'
+
+    def add_arguments(self, parser):
+        parser.add_argument('strategy', choices=sorted(STRATEGIES.values()))
+        parser.add_argument('--ahead', type=int, default=3,
+                            help='Number of upcoming months to create range partitions for')
+        parser.add_argument('--partitions', type=int, default=16, help='Number of hash partitions')
+        parser.add_argument('--dry-run', action='store_true', help='Prints SQL without executing it')
+
+    def handle(self, *args, strategy, ahead, partitions, dry_run, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partitioning requires PostgreSQL')
+        self.dry_run = dry_run
+        with transaction.atomic(), connection.cursor() as cursor:
+            current = self.current_strategy(cursor)
+            if current is None:
+                self.convert(cursor, strategy, ahead, partitions)
+            elif current != strategy:
+                raise CommandError(f'Messages are already partitioned by {current}')
+            elif strategy == 'range':
+                self.add_range_partitions(cursor, ahead)
+            else:
+                self.stdout.write('Messages are already partitioned by hash')
+
+    def execute_sql(self, cursor, sql, params=None):
+        if self.dry_run:
+            self.stdout.write(cursor.mogrify(sql, params).decode() + ';')
+        else:
+            cursor.execute(sql, params)
+
+    @staticmethod
+    def current_strategy(cursor):
+        cursor.execute('SELECT partstrat FROM pg_partitioned_table WHERE partrelid = %s::regclass', [TABLE])
+        row = cursor.fetchone()
+        return STRATEGIES[row[0]] if row else None
+
+    @staticmethod
+    def months(cursor, ahead):
+        """First days of months from the oldest message to `ahead` months after the current one"""
+        cursor.execute(f'SELECT MIN(date_created) FROM {TABLE}')
+        oldest = cursor.fetchone()[0] or timezone.now()
+        first = oldest.date().replace(day=1)
+        last = add_months(timezone.now().date().replace(day=1), ahead)
+        months = [first]
+        while months[-1] < last:
+            months.append(add_months(months[-1], 1))
+        return months
+
+    @staticmethod
+    def month_bounds(month):
+        return [datetime.combine(day, time.min, tzinfo=timezone.utc) for day in (month, add_months(month, 1))]
+
+    def create_range_partitions(self, cursor, months, table):
+        for month in months:
+            name = f'{TABLE}_{month:%Y_%m}'
+            self.execute_sql(cursor, f'CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)',
+                             self.month_bounds(month))
+            if not self.dry_run:
+                self.stdout.write(f'Created partition {name}')
+
+    def add_range_partitions(self, cursor, ahead):
+        """
+        Creates missing monthly partitions of the partitioned table. Messages of the new months which landed
+        in the default partition are moved to them, a partition can not be created while the default one
+        has rows of its range, so the default partition is detached meanwhile
+        """
+        cursor.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                       'WHERE i.inhparent = %s::regclass', [TABLE])
+        existing = {row[0] for row in cursor.fetchall()}
+        months = [month for month in self.months(cursor, ahead) if f'{TABLE}_{month:%Y_%m}' not in existing]
+        default = f'{TABLE}_default'
+        moved_months = []
+        if default in existing:
+            for month in months:
+                cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {default} '
+                               f'WHERE date_created >= %s AND date_created < %s)', self.month_bounds(month))
+                if cursor.fetchone()[0]:
+                    moved_months.append(month)
+        if not moved_months:
+            self.create_range_partitions(cursor, months, TABLE)
+            return
+
+        self.execute_sql(cursor, f'ALTER TABLE {TABLE} DETACH PARTITION {default}')
+        self.create_range_partitions(cursor, months, TABLE)
+        for month in moved_months:
+            self.execute_sql(cursor, f'WITH moved AS (DELETE FROM {default} WHERE date_created >= %s '
+                                     f'AND date_created < %s RETURNING *) INSERT INTO {TABLE} SELECT * FROM moved',
+                             self.month_bounds(month))
+            if not self.dry_run:
+                self.stdout.write(f'Moved {cursor.rowcount} messages from {default} to {TABLE}_{month:%Y_%m}')
+        self.execute_sql(cursor, f'ALTER TABLE {TABLE} ATTACH PARTITION {default} DEFAULT')
+
+    def convert(self, cursor, strategy, ahead, partitions):
+        self.execute_sql(cursor, f'LOCK TABLE {TABLE} IN EXCLUSIVE MODE')
+        # keeps definitions of indexes and foreign keys to recreate them on the partitioned table
+        cursor.execute('SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname != %s',
+                       [TABLE, f'{TABLE}_pkey'])
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                       "WHERE conrelid = %s::regclass AND contype = 'f'", [TABLE])
+        foreign_keys = cursor.fetchall()
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [TABLE, 'id'])
+        sequence = cursor.fetchone()[0]
+        new_table = f'{TABLE}_partitioned'
+
+        if strategy == 'range':
+            key, partition_by = 'date_created', 'RANGE (date_created)'
+        else:
+            key, partition_by = 'chat_id', 'HASH (chat_id)'
+        self.execute_sql(cursor, f'CREATE TABLE {new_table} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+                                 f'PARTITION BY {partition_by}')
+        if strategy == 'range':
+            self.create_range_partitions(cursor, self.months(cursor, ahead), new_table)
+            self.execute_sql(cursor, f'CREATE TABLE {TABLE}_default PARTITION OF {new_table} DEFAULT')
+        else:
+            for remainder in range(partitions):
+                self.execute_sql(cursor, f'CREATE TABLE {TABLE}_{remainder} PARTITION OF {new_table} '
+                                         f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})')
+        self.execute_sql(cursor, f'INSERT INTO {new_table} SELECT * FROM {TABLE}')
+        moved = cursor.rowcount
+
+        # the sequence of ids is owned by the old table and would be dropped together with it
+        self.execute_sql(cursor, f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+        self.execute_sql(cursor, f'DROP TABLE {TABLE}')
+        self.execute_sql(cursor, f'ALTER TABLE {new_table} RENAME TO {TABLE}')
+        self.execute_sql(cursor, f'ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id')
+        # unique constraints of partitioned tables have to include the partition key
+        self.execute_sql(cursor, f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, {key})')
+        for index in indexes:
+            self.execute_sql(cursor, index)
+        for name, definition in foreign_keys:
+            self.execute_sql(cursor, f'ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}')
+        self.execute_sql(cursor, f'ANALYZE {TABLE}')
+        if not self.dry_run:
+            self.stdout.write(f'Partitioned {TABLE} by {strategy}, moved {moved} messages')
@@ -0,0 +1,17 @@
+"""
+Deletion of changes of chats older than CHAT_CHANGES_RETENTION_DAYS, e.g. daily from cron:
+
+    manage.py prune_chat_changes
+
+Clients whose sync cursors are older get 410 and reload their chats.
+"""
+from django.core.management.base import BaseCommand
+
+from chat.sync import prune_changes
+
+
+class Command(BaseCommand):
+    help = 'Deletes changes of chats which are older than sync cursors may be'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Deleted {prune_changes()} changes')
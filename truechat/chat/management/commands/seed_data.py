@@ -0,0 +1,67 @@
+"""
+Generation of synthetic data for benchmarks and large-scale tests
+
+    manage.py seed_data --users 10000 --chats 2000 --messages 1000000 --seed 1
+    manage.py seed_data --users 1000000 --chats 100000 --chat-sizes zipf --message-rate size --messages 10000000
+    manage.py seed_data --import-dir fixtures/
+    manage.py seed_data --clear
+
+Generated users are named bench_<number> and have the password `benchmark`,
+see truechat.benchmark.data. Rows are written with COPY on PostgreSQL and with bulk_create elsewhere.
+--import-dir loads User.csv, chats.csv, Membership.csv, messages.csv and Picture.csv, named after
+the tables, with headers of column names instead, on PostgreSQL only. Missing NOT NULL columns
+get defaults of their fields, columns without defaults, e.g. foreign keys, are required.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from truechat.benchmark import data
+
+
+class Command(BaseCommand):
+    help = 'Generates users, chats, memberships, messages and images for benchmarks or loads them from CSV files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--chats', type=int, default=200, help='Number of group chats')
+        parser.add_argument('--members', type=int, default=20, help='Average number of members of a group chat')
+        parser.add_argument('--chat-sizes', choices=data.CHAT_SIZES, default='exponential',
+                            help='Distribution of sizes of group chats')
+        parser.add_argument('--dialogs', type=int, default=500)
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--message-rate', choices=data.MESSAGE_RATES, default='uniform',
+                            help='Distribution of messages over chats: the same for all, proportional to sizes '
+                                 'or by Zipf law')
+        parser.add_argument('--images', type=int, default=1000)
+        parser.add_argument('--days', type=int, default=90, help='Messages are spread over this number of last days')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, help='Rows written at once, 100000 with COPY, 10000 otherwise')
+        parser.add_argument('--import-dir', help='Directory with CSV files to load instead of generating data')
+        parser.add_argument('--clear', action='store_true', help='Deletes previously generated data')
+
+    def handle(self, *args, clear, import_dir, **options):
+        if clear:
+            data.clear()
+            self.stdout.write('Deleted generated data')
+            return
+        if import_dir:
+            if connection.vendor != 'postgresql':
+                raise CommandError('--import-dir requires PostgreSQL')
+            try:
+                loaded = data.import_dir(import_dir, log=self.stdout.write)
+            except ValueError as e:
+                raise CommandError(e)
+            self.stdout.write(self.style.SUCCESS('Loaded ' + ', '.join(f'{count} rows of {table}'
+                                                                       for table, count in loaded.items())))
+            return
+        counts = {name: options[name] for name in ('users', 'chats', 'members', 'dialogs', 'messages', 'images',
+                                                    'days', 'seed', 'batch_size', 'chat_sizes', 'message_rate')}
+        if counts['users'] < 1 or counts['members'] < 1 or counts['days'] < 1:
+            raise CommandError('--users, --members and --days must be positive')
+        if counts['batch_size'] is not None and counts['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        if min(counts['chats'], counts['dialogs'], counts['messages'], counts['images']) < 0:
+            raise CommandError('--chats, --dialogs, --messages and --images must not be negative')
+        created = data.generate(log=self.stdout.write, **counts)
+        self.stdout.write(self.style.SUCCESS('Generated ' + ', '.join(f'{count} {name}'
+                                                                      for name, count in created.items())))
@@ -1,8 +1,9 @@
 from django.urls import path
 
-from chat.views import MessageAPIView, message_upload_image
+from chat.views import MessageAPIView, MessageSearchView, message_upload_image
 
 urlpatterns = [
-    path(r'<int:pk>/', MessageAPIView.as_view()),
-    path(r'<int:pk>/upload_photo/', message_upload_image)
+    path(r'search/', MessageSearchView.as_view(), name='message_search'),
+    path(r'<int:pk>/', MessageAPIView.as_view(), name='message'),
+    path(r'<int:pk>/upload_photo/', message_upload_image, name='message_upload_photo'),
 ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:05
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def fill_last_messages(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+    latest = Message.objects.filter(chat=OuterRef('pk')).order_by('-date_created', '-id')
+    Chat.objects.update(last_message=Subquery(latest.values('id')[:1]),
+                        last_activity_at=Coalesce(Subquery(latest.values('date_created')[:1]), 'date_created'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_auto_20191115_2029'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Дата последней активности'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.Message', verbose_name='Последнее сообщение'),
+        ),
+        migrations.RunPython(fill_last_messages, migrations.RunPython.noop),
+    ]
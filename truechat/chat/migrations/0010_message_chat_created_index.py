@@ -0,0 +1,17 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_chat_last_message'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', '-date_created', '-id'], name='messages_chat_created_idx'),
+        ),
+    ]
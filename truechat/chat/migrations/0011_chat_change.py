@@ -0,0 +1,39 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:09
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_chat_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('event', models.CharField(choices=[('message.created', 'Сообщение создано'), ('message.updated', 'Сообщение изменено'), ('message.deleted', 'Сообщение удалено'), ('membership.added', 'Участник добавлен'), ('membership.removed', 'Участник удален'), ('membership.banned', 'Участник забанен'), ('membership.unbanned', 'Участник разбанен'), ('chat.updated', 'Чат изменен'), ('chat.deleted', 'Чат удален')], max_length=31, verbose_name='Событие')),
+                ('chat_id', models.PositiveIntegerField(verbose_name='Чат')),
+                ('user_id', models.PositiveIntegerField(blank=True, null=True, verbose_name='Пользователь')),
+                ('object_id', models.PositiveIntegerField(blank=True, null=True, verbose_name='Объект')),
+                ('date_created', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Изменение чата',
+                'verbose_name_plural': 'Изменения чатов',
+                'db_table': 'chat_changes',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='chatchange',
+            index=models.Index(fields=['chat_id', 'id'], name='chat_changes_chat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatchange',
+            index=models.Index(fields=['user_id', 'id'], name='chat_changes_user_idx'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:11
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_read_watermarks(apps, schema_editor):
+    """Existing history is considered read, creators become members to have their own watermark"""
+    Chat = apps.get_model('chat', 'Chat')
+    Membership = apps.get_model('chat', 'Membership')
+    chats = Chat.objects.filter(creator__isnull=False).exclude(members__user=F('creator'))
+    Membership.objects.bulk_create([Membership(user_id=chat.creator_id, chat_id=chat.id, date_started=chat.date_created)
+                                    for chat in chats.only('id', 'creator_id', 'date_created').iterator()])
+    last_message = Chat.objects.filter(pk=OuterRef('chat_id')).values('last_message_id')
+    Membership.objects.update(last_read_message_id=Coalesce(Subquery(last_message[:1]), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_chat_change'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='messagestatus',
+            name='message',
+        ),
+        migrations.RemoveField(
+            model_name='messagestatus',
+            name='user',
+        ),
+        migrations.AddField(
+            model_name='membership',
+            name='last_read_message_id',
+            field=models.PositiveIntegerField(default=0, help_text='Все сообщения чата до этого включительно прочитаны', verbose_name='Последнее прочитанное сообщение'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'id'], name='messages_chat_id_idx'),
+        ),
+        migrations.DeleteModel(
+            name='MessageStatus',
+        ),
+        migrations.RunPython(fill_read_watermarks, migrations.RunPython.noop),
+    ]
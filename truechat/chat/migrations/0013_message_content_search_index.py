@@ -0,0 +1,19 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_membership_last_read'),
+    ]
+
+    operations = [
+        # expression has to match the SQL of SearchVector('content', config='simple') used by chat.search
+        migrations.RunSQL(
+            "CREATE INDEX messages_content_search_idx ON messages "
+            "USING gin (to_tsvector('simple'::regconfig, COALESCE(content, '')))",
+            "DROP INDEX messages_content_search_idx",
+        ),
+    ]
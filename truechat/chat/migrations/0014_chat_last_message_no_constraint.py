@@ -0,0 +1,19 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_message_content_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.Message', verbose_name='Последнее сообщение'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_dialog_pairs(apps, schema_editor):
+    """
+    Pairs are taken from members of existing dialogs, a dialog with oneself has the same user on both sides.
+    Only the oldest of duplicate dialogs gets the pair, others stay available through memberships
+    """
+    Chat = apps.get_model('chat', 'Chat')
+    Membership = apps.get_model('chat', 'Membership')
+    users = {}
+    for chat_id, user_id in Membership.objects.filter(chat__is_dialog=True).values_list('chat_id', 'user_id'):
+        users.setdefault(chat_id, set()).add(user_id)
+    paired, seen = [], set()
+    for chat in Chat.objects.filter(is_dialog=True).only('id', 'creator_id').order_by('id').iterator():
+        chat_users = users.get(chat.id, set()) | ({chat.creator_id} if chat.creator_id else set())
+        if not 1 <= len(chat_users) <= 2:
+            continue
+        pair = (min(chat_users), max(chat_users))
+        if pair in seen:
+            continue
+        seen.add(pair)
+        chat.dialog_user_low_id, chat.dialog_user_high_id = pair
+        paired.append(chat)
+    Chat.objects.bulk_update(paired, ['dialog_user_low', 'dialog_user_high'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0014_chat_last_message_no_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='dialog_user_high',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Второй собеседник'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='dialog_user_low',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Первый собеседник'),
+        ),
+        migrations.RunPython(fill_dialog_pairs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(condition=models.Q(is_dialog=True), fields=('dialog_user_low', 'dialog_user_high'), name='chats_dialog_pair_uniq'),
+        ),
+    ]
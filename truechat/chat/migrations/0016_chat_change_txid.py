@@ -0,0 +1,26 @@
+# Generated by Django 2.2.5 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_chat_dialog_pair'),
+    ]
+
+    operations = [
+        # not a model field: the database fills it in, inserts of the ORM would write NULL instead
+        migrations.RunSQL(
+            "ALTER TABLE chat_changes ADD COLUMN txid bigint NOT NULL DEFAULT txid_current()",
+            "ALTER TABLE chat_changes DROP COLUMN txid",
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX chat_changes_txid_idx ON chat_changes (txid, id)",
+            "DROP INDEX chat_changes_txid_idx",
+        ),
+        migrations.AddIndex(
+            model_name='chatchange',
+            index=models.Index(fields=['date_created'], name='chat_changes_created_idx'),
+        ),
+    ]
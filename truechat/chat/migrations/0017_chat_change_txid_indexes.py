@@ -0,0 +1,33 @@
+# Generated by Django 2.2.5 on 2026-10-20 10:41
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_chat_change_txid'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chatchange',
+            name='chat_changes_chat_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='chatchange',
+            name='chat_changes_user_idx',
+        ),
+        migrations.RunSQL(
+            "DROP INDEX chat_changes_txid_idx",
+            "CREATE INDEX chat_changes_txid_idx ON chat_changes (txid, id)",
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX chat_changes_chat_txid_idx ON chat_changes (chat_id, txid, id)",
+            "DROP INDEX chat_changes_chat_txid_idx",
+        ),
+        migrations.RunSQL(
+            "CREATE INDEX chat_changes_user_txid_idx ON chat_changes (user_id, txid, id)",
+            "DROP INDEX chat_changes_user_txid_idx",
+        ),
+    ]
@@ -1,11 +1,42 @@
 from django.contrib.contenttypes.fields import GenericRelation
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from custom_auth.models import User
 from attachments.models import Image
 
 
+class ChatQuerySet(models.QuerySet):
+    def available_to(self, user):
+        """Chats where user is a not banned member or the creator"""
+        membership = Membership.objects.filter(user=user, is_banned=False)
+        return self.filter(Q(pk__in=membership.values('chat')) | Q(creator=user))
+
+    def refresh_last_messages(self):
+        """Points chats to their latest messages with a single UPDATE"""
+        latest = Message.objects.filter(chat=OuterRef('pk')).order_by('-date_created', '-id')
+        return self.update(last_message=Subquery(latest.values('id')[:1]),
+                           last_activity_at=Coalesce(Subquery(latest.values('date_created')[:1]), 'date_created'))
+
+    def dialog_of(self, user, other):
+        """Dialog between two users, looked up by the unique index on their ordered pair"""
+        low, high = Chat.dialog_pair(user, other)
+        return self.filter(is_dialog=True, dialog_user_low_id=low, dialog_user_high_id=high)
+
+    def dialogs_of(self, user):
+        """Dialogs of user, whichever side of the pair they are"""
+        return self.filter(Q(dialog_user_low=user) | Q(dialog_user_high=user), is_dialog=True)
+
+    def unread_counts(self, user):
+        """Returns {chat id: number of messages unread by user} for chats of the queryset in one query"""
+        counts = Message.objects.filter(chat__in=self.values('pk'), chat__members__user=user,
+                                        id__gt=F('chat__members__last_read_message_id'))\
+            .exclude(user=user).values('chat_id').annotate(unread=Count('id')).order_by()
+        return {count['chat_id']: count['unread'] for count in counts}
+
+
 class Chat(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField('Название чата', max_length=255,
@@ -16,13 +47,37 @@ class Chat(models.Model):
     creator = models.ForeignKey(User, on_delete=models.SET_NULL, verbose_name='Создатель',
                                 related_name='created_chats', null=True)
     is_dialog = models.BooleanField('Личная ли переписка', default=False)
+    # participants of a dialog ordered by id, so that every pair of users has at most one dialog
+    dialog_user_low = models.ForeignKey(User, on_delete=models.SET_NULL, verbose_name='Первый собеседник',
+                                        related_name='+', null=True, blank=True)
+    dialog_user_high = models.ForeignKey(User, on_delete=models.SET_NULL, verbose_name='Второй собеседник',
+                                         related_name='+', null=True, blank=True)
     users = models.ManyToManyField(User, related_name='chats', through='Membership')
     date_created = models.DateTimeField('Дата создания', default=timezone.now)
     images = GenericRelation(Image)
+    # no constraint in the database: partitioned messages have no unique key on id alone
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, verbose_name='Последнее сообщение',
+                                     related_name='+', null=True, blank=True, db_constraint=False)
+    last_activity_at = models.DateTimeField('Дата последней активности', default=timezone.now, db_index=True)
+
+    objects = ChatQuerySet.as_manager()
 
     def is_member(self, user):
         return self.members.filter(user=user).exists() or self.creator == user
 
+    @staticmethod
+    def dialog_pair(user, other):
+        """Ids of dialog participants in the order they are stored in"""
+        return tuple(sorted([user.pk, other.pk]))
+
+    def set_last_message(self, message):
+        """Moves last message pointer to the message unless the chat already has a newer one"""
+        updated = Chat.objects.filter(pk=self.pk, last_activity_at__lte=message.date_created)\
+            .update(last_message=message, last_activity_at=message.date_created)
+        if updated:
+            self.last_message = message
+            self.last_activity_at = message.date_created
+
     def __str__(self):
         return self.name
 
@@ -30,6 +85,10 @@ class Chat(models.Model):
         db_table = 'chats'
         verbose_name = 'Чат'
         verbose_name_plural = 'Чаты'
+        constraints = [
+            models.UniqueConstraint(fields=['dialog_user_low', 'dialog_user_high'], condition=Q(is_dialog=True),
+                                    name='chats_dialog_pair_uniq'),
+        ]
 
 
 class Membership(models.Model):
@@ -41,6 +100,14 @@ class Membership(models.Model):
     date_started = models.DateTimeField('Дата начала общения в чате', default=timezone.now)
     notifications = models.BooleanField('Присылать ли нотификации', default=True,
                                         help_text='Будут ли появляться на телефоне нотификации о сообщении')
+    last_read_message_id = models.PositiveIntegerField('Последнее прочитанное сообщение', default=0,
+                                                       help_text='Все сообщения чата до этого включительно прочитаны')
+
+    def mark_read(self, message_id):
+        """Moves read watermark forward to message_id with a single UPDATE, it never moves back"""
+        Membership.objects.filter(pk=self.pk, last_read_message_id__lt=message_id)\
+            .update(last_read_message_id=message_id)
+        self.last_read_message_id = max(self.last_read_message_id, message_id)
 
     def __str__(self):
         return f'{self.user}({self.chat})'
@@ -62,6 +129,21 @@ class Message(models.Model):
     date_created = models.DateTimeField('Дата создания', default=timezone.now)
     images = GenericRelation(Image)
 
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        # caches dropped by save signals are dropped once more on commit, which has to follow the pointer update
+        with transaction.atomic():
+            super(Message, self).save(*args, **kwargs)
+            if created:
+                self.chat.set_last_message(self)
+
+    def delete(self, *args, **kwargs):
+        chat_id = self.chat_id
+        with transaction.atomic():
+            result = super(Message, self).delete(*args, **kwargs)
+            Chat.objects.filter(pk=chat_id).refresh_last_messages()
+        return result
+
     def __str__(self):
         return f'{self.chat.name}.{self.user.username} - {self.date_created}'
 
@@ -70,17 +152,58 @@ class Message(models.Model):
         verbose_name = 'Сообщение'
         verbose_name_plural = 'Сообщения'
         ordering = ['-date_created']
-
-
-class MessageStatus(models.Model):
-    id = models.AutoField(primary_key=True)
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, verbose_name='сообщение',
-                                related_name='message_statuses')
-    user = models.ForeignKey(User, on_delete=models.SET_NULL, verbose_name='Получатель',
-                             related_name='message_statuses', null=True)
-    is_read = models.BooleanField('Прочитано ли', default=False)
+        indexes = [
+            models.Index(fields=['chat', '-date_created', '-id'], name='messages_chat_created_idx'),
+            models.Index(fields=['chat', 'id'], name='messages_chat_id_idx'),
+        ]
+
+
+class ChatChange(models.Model):
+    """
+    Append-only log of changes in chats, clients synchronise from it in the order of (txid, id)
+
+    Chats and users are stored as plain ids, so that the log outlives deleted chats.
+    `user_id` is set for changes concerning a particular user (membership changes, deletion of chat),
+    so that the user gets them even after leaving the chat.
+
+    The table also has a `txid` column, which is not a field: the database fills it with the id of
+    the inserting transaction, see chat.sync.
+    """
+    MESSAGE_CREATED = 'message.created'
+    MESSAGE_UPDATED = 'message.updated'
+    MESSAGE_DELETED = 'message.deleted'
+    MEMBERSHIP_ADDED = 'membership.added'
+    MEMBERSHIP_REMOVED = 'membership.removed'
+    MEMBERSHIP_BANNED = 'membership.banned'
+    MEMBERSHIP_UNBANNED = 'membership.unbanned'
+    CHAT_UPDATED = 'chat.updated'
+    CHAT_DELETED = 'chat.deleted'
+    EVENT_CHOICES = [
+        (MESSAGE_CREATED, 'Сообщение создано'),
+        (MESSAGE_UPDATED, 'Сообщение изменено'),
+        (MESSAGE_DELETED, 'Сообщение удалено'),
+        (MEMBERSHIP_ADDED, 'Участник добавлен'),
+        (MEMBERSHIP_REMOVED, 'Участник удален'),
+        (MEMBERSHIP_BANNED, 'Участник забанен'),
+        (MEMBERSHIP_UNBANNED, 'Участник разбанен'),
+        (CHAT_UPDATED, 'Чат изменен'),
+        (CHAT_DELETED, 'Чат удален'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    event = models.CharField('Событие', max_length=31, choices=EVENT_CHOICES)
+    chat_id = models.PositiveIntegerField('Чат')
+    user_id = models.PositiveIntegerField('Пользователь', null=True, blank=True)
+    object_id = models.PositiveIntegerField('Объект', null=True, blank=True)
+    date_created = models.DateTimeField('Дата создания', default=timezone.now)
 
     class Meta:
-        db_table = 'message_statuses'
-        verbose_name = 'Статус сообщения'
-        verbose_name_plural = 'Статусы сообщений'
+        db_table = 'chat_changes'
+        verbose_name = 'Изменение чата'
+        verbose_name_plural = 'Изменения чатов'
+        ordering = ['id']
+        # indexes (chat_id, txid, id) and (user_id, txid, id) for chat.sync are created by migrations,
+        # txid is filled in by the database and is not a field
+        indexes = [
+            models.Index(fields=['date_created'], name='chat_changes_created_idx'),
+        ]
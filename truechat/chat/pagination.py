@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db.models import Q, Subquery
+from django.utils import timezone
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+# older pages are looked for within this period before the anchor first, it spans a monthly partition
+RECENT_WINDOW = timedelta(days=31)
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset pagination of messages ordered from the newest to the oldest by (date_created, id)
+
+    Anchors are message ids: `before` returns messages older than the anchor, `after` returns
+    messages newer than the anchor and `around` returns the anchor together with its neighbours.
+    Without an anchor the newest messages are returned. Every page is a range scan of
+    the (chat, date_created, id) index, so its cost does not depend on how deep it is.
+    Pages are bounded by date_created, so partitions of messages outside of the bound are pruned. Older pages
+    are looked for within RECENT_WINDOW before the anchor first and only then among the rest of older messages.
+    """
+    limit_query_param = 'limit'
+    default_limit = api_settings.PAGE_SIZE or 10
+    max_limit = 100
+    anchor_query_params = ('before', 'after', 'around')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        anchor_param, anchor = self.get_anchor(request)
+        if anchor_param is not None:
+            anchor = self.get_anchor_keys(queryset, anchor)
+
+        if anchor_param is None:
+            self.page, self.has_older = self.older(queryset, None, self.limit)
+            self.has_newer = False
+        elif anchor_param == 'before':
+            self.page, self.has_older = self.older(queryset, anchor, self.limit)
+            self.has_newer = True
+        elif anchor_param == 'after':
+            self.page, self.has_newer = self.newer(queryset, anchor, self.limit)
+            self.has_older = True
+        else:
+            newer, self.has_newer = self.newer(queryset, anchor, self.limit // 2)
+            older, self.has_older = self.older(queryset, anchor, self.limit - len(newer), inclusive=True)
+            self.page = newer + older
+        return self.page
+
+    @staticmethod
+    def get_anchor_keys(queryset, pk):
+        """Returns values of the ordering keys of the anchor message"""
+        try:
+            return queryset.filter(pk=pk).values_list('date_created', 'id').get()
+        except queryset.model.DoesNotExist:
+            raise NotFound('Anchor message is not found')
+
+    @staticmethod
+    def older(queryset, anchor, limit, inclusive=False):
+        """Returns up to limit messages older than anchor, the newest first, and whether there are more"""
+        if anchor is not None:
+            date_created, pk = anchor
+            pk_lookup = 'id__lte' if inclusive else 'id__lt'
+            # the redundant bound lets partitions of newer messages be pruned
+            queryset = queryset.filter(Q(date_created__lt=date_created) | Q(**{pk_lookup: pk}),
+                                       date_created__lte=date_created)
+        # pages are looked for in the recent window first, so that partitions of older messages are pruned
+        since = (timezone.now() if anchor is None else anchor[0]) - RECENT_WINDOW
+        queryset = queryset.order_by('-date_created', '-id')
+        messages = list(queryset.filter(date_created__gte=since)[:limit + 1])
+        if len(messages) <= limit:
+            messages += queryset.filter(date_created__lt=since)[:limit + 1 - len(messages)]
+        return messages[:limit], len(messages) > limit
+
+    @staticmethod
+    def newer(queryset, anchor, limit):
+        """Returns up to limit messages newer than anchor, the newest first, and whether there are more"""
+        date_created, pk = anchor
+        queryset = queryset.filter(Q(date_created__gt=date_created) | Q(id__gt=pk), date_created__gte=date_created)
+        messages = list(queryset.order_by('date_created', 'id')[:limit + 1])
+        return messages[:limit][::-1], len(messages) > limit
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(request.query_params.get(self.limit_query_param, self.default_limit),
+                                 strict=True, cutoff=self.max_limit)
+        except ValueError:
+            raise ValidationError({self.limit_query_param: ['Limit must be a positive integer']})
+
+    def get_anchor(self, request):
+        anchors = [param for param in self.anchor_query_params if param in request.query_params]
+        if not anchors:
+            return None, None
+        if len(anchors) > 1:
+            raise ValidationError({anchors[1]: [f'Only one of {", ".join(self.anchor_query_params)} may be used']})
+        try:
+            return anchors[0], _positive_int(request.query_params[anchors[0]], strict=True)
+        except ValueError:
+            raise ValidationError({anchors[0]: ['Anchor must be a message id']})
+
+    def get_link(self, param, message):
+        url = self.request.build_absolute_uri()
+        for anchor_param in self.anchor_query_params:
+            url = remove_query_param(url, anchor_param)
+        return replace_query_param(url, param, message.id)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_link('before', self.page[-1]) if self.page and self.has_older else None),
+            ('previous', self.get_link('after', self.page[0]) if self.page and self.has_newer else None),
+            ('results', data),
+        ]))
+
+
+class MessageRankPagination(MessageKeysetPagination):
+    """
+    Keyset pagination of search results ordered from the most relevant by (rank, id)
+
+    `before` returns less relevant messages than the anchor and `after` returns more relevant ones.
+    The queryset has to be annotated with `rank`.
+    """
+
+    @staticmethod
+    def get_anchor_keys(queryset, pk):
+        """Returns rank of the anchor as a subquery, a float read back could differ from the computed one"""
+        anchor = queryset.filter(pk=pk)
+        if not anchor.exists():
+            raise NotFound('Anchor message is not found')
+        return Subquery(anchor.values('rank')), pk
+
+    @staticmethod
+    def older(queryset, anchor, limit, inclusive=False):
+        """Returns up to limit messages less relevant than anchor, the most relevant first, and if there are more"""
+        if anchor is not None:
+            rank, pk = anchor
+            pk_lookup = 'id__lte' if inclusive else 'id__lt'
+            queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, **{pk_lookup: pk}))
+        messages = list(queryset.order_by('-rank', '-id')[:limit + 1])
+        return messages[:limit], len(messages) > limit
+
+    @staticmethod
+    def newer(queryset, anchor, limit):
+        """Returns up to limit messages more relevant than anchor, the most relevant first, and if there are more"""
+        rank, pk = anchor
+        queryset = queryset.filter(Q(rank__gt=rank) | Q(rank=rank, id__gt=pk))
+        messages = list(queryset.order_by('rank', 'id')[:limit + 1])
+        return messages[:limit][::-1], len(messages) > limit
@@ -0,0 +1,237 @@
+"""
+Versioned cache of serialized users, chats and messages
+
+Every cached object has a version token in the cache, its payload is kept under a key made of
+version tokens of all objects the payload depends on. Model signals drop tokens of affected objects,
+so payloads built from their old state are never read again and just expire. Tokens are dropped right away
+and once more after the transaction commits, so that payloads built meanwhile from the old state are not reused.
+
+Parts of payloads which depend on the requesting user, like unread_count of chats,
+are filled in after reading the cache.
+
+Missing payloads are built from the database the request reads from, only ones built from the primary
+are cached: a lagging replica may return the old state of objects whose tokens were already dropped.
+
+Payloads are cached only with SHARED_CACHE, a process can not drop tokens from caches of other processes,
+so without a shared cache payloads are built on every request.
+"""
+import uuid
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from attachments.models import Image
+from chat.models import Chat, Membership, Message
+from chat.serializers import ChatSerializer, MessageSerializer
+from custom_auth.models import User
+from custom_auth.serializers import UserSerializerGet
+from truechat.replicas import current_replica
+
+USER = 'user'
+# the whole ChatSerializer payload: chat, its images, members and last message
+CHAT = 'chat'
+# own fields of chat, which are included into messages
+CHAT_INFO = 'chat_info'
+MESSAGE = 'message'
+
+
+def version_key(kind, pk):
+    return f'version.{kind}.{pk}'
+
+
+def get_versions(objects):
+    """
+    Returns version tokens of objects, creating tokens for objects which have none
+
+    :param objects: (kind, pk) pairs
+    :return: dict of tokens by (kind, pk) pairs, tokens are None without a shared cache
+    """
+    if not settings.SHARED_CACHE:
+        return dict.fromkeys(objects)
+    keys = {obj: version_key(*obj) for obj in objects}
+    found = cache.get_many(keys.values())
+    versions, created = {}, {}
+    for obj, key in keys.items():
+        if key in found:
+            versions[obj] = found[key]
+        else:
+            versions[obj] = created[key] = uuid.uuid4().hex
+    if created:
+        cache.set_many(created, None)
+    return versions
+
+
+def forget(objects):
+    """
+    Drops version tokens of objects, so that their cached payloads are not used anymore
+
+    :param objects: (kind, pk) pairs
+    :return:
+    """
+    keys = [version_key(*obj) for obj in set(objects)]
+    if keys and settings.SHARED_CACHE:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def forget_chats(chat_ids):
+    forget([(CHAT, chat_id) for chat_id in chat_ids])
+
+
+def get_payloads(keys, build):
+    """
+    Returns payloads from the cache, building and caching the missing ones,
+    payloads built from a replica are not cached
+
+    :param keys: cache keys of payloads by pks of objects
+    :param build: function returning payloads by pks for a list of missing pks
+    :return: dict of payloads by pks
+    """
+    found = cache.get_many(keys.values()) if settings.SHARED_CACHE else {}
+    payloads = {pk: found[key] for pk, key in keys.items() if key in found}
+    missing = [pk for pk in keys if pk not in payloads]
+    if missing:
+        built = build(missing)
+        # payloads built from a lagging replica would stay in the cache under current versions
+        if settings.SHARED_CACHE and current_replica() is None:
+            cache.set_many({keys[pk]: payload for pk, payload in built.items()}, settings.PAYLOAD_CACHE_TIMEOUT)
+        payloads.update(built)
+    return payloads
+
+
+def user_payloads(users):
+    """
+    Returns UserSerializerGet payloads of users by their pks
+
+    :param users:
+    :return:
+    """
+    pks = {user.pk for user in users}
+    versions = get_versions((USER, pk) for pk in pks)
+    keys = {pk: f'payload.user.{pk}.{versions[USER, pk]}' for pk in pks}
+
+    def build(missing):
+        return {user.pk: UserSerializerGet(user).data
+                for user in User.objects.filter(pk__in=missing).prefetch_related('images')}
+
+    return get_payloads(keys, build)
+
+
+def chat_payloads(chat_ids, user):
+    """
+    Returns ChatSerializer payloads of chats in the given order with unread counts of user
+
+    :param chat_ids:
+    :param user:
+    :return:
+    """
+    chat_ids = list(chat_ids)
+    versions = get_versions((CHAT, pk) for pk in chat_ids)
+    keys = {pk: f'payload.chat.{pk}.{versions[CHAT, pk]}' for pk in chat_ids}
+
+    def build(pks):
+        chats = ChatSerializer.setup_eager_loading(Chat.objects.filter(pk__in=pks))
+        return {chat.pk: ChatSerializer(chat).data for chat in chats}
+
+    payloads = get_payloads(keys, build)
+    counts = Chat.objects.filter(pk__in=chat_ids).unread_counts(user) if chat_ids else {}
+    result = []
+    for pk in chat_ids:
+        payload = dict(payloads[pk])
+        payload['unread_count'] = counts.get(pk, 0)
+        result.append(payload)
+    return result
+
+
+def message_payloads(messages):
+    """
+    Returns MessageSerializer payloads of messages in the given order
+
+    :param messages: messages, their related objects need not be loaded
+    :return:
+    """
+    messages = list(messages)
+    objects = set()
+    for message in messages:
+        objects.update([(MESSAGE, message.pk), (CHAT_INFO, message.chat_id), (USER, message.user_id)])
+    versions = get_versions(objects)
+    keys = {message.pk: f'payload.message.{message.pk}.{versions[MESSAGE, message.pk]}.'
+                        f'{versions[CHAT_INFO, message.chat_id]}.{versions[USER, message.user_id]}'
+            for message in messages}
+
+    def build(pks):
+        missing = Message.objects.filter(pk__in=pks).select_related('chat', 'user')\
+            .prefetch_related('images', 'user__images')
+        return {message.pk: MessageSerializer(message).data for message in missing}
+
+    payloads = get_payloads(keys, build)
+    return [payloads[message.pk] for message in messages]
+
+
+def user_dependants(user_id):
+    """Objects whose payloads include the user: the user and chats they are in, created or wrote last to"""
+    chat_ids = Chat.objects.filter(Q(members__user_id=user_id) | Q(creator_id=user_id) |
+                                   Q(last_message__user_id=user_id)).values_list('id', flat=True).distinct()
+    return [(USER, user_id)] + [(CHAT, chat_id) for chat_id in chat_ids]
+
+
+def image_changed(image):
+    """
+    Drops payloads including the image, also used for status changes which bypass save signals
+
+    :param image:
+    :return:
+    """
+    if not settings.SHARED_CACHE:
+        return
+    model = ContentType.objects.get_for_id(image.content_type_id).model_class()
+    if model is User:
+        forget(user_dependants(image.object_id))
+    elif model is Chat:
+        forget([(CHAT, image.object_id), (CHAT_INFO, image.object_id)])
+    elif model is Message:
+        chat_id = Message.objects.filter(pk=image.object_id).values_list('chat_id', flat=True).first()
+        forget([(MESSAGE, image.object_id)] + ([(CHAT, chat_id)] if chat_id else []))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_saved(sender, instance, created=False, **kwargs):
+    if settings.SHARED_CACHE:
+        forget([(USER, instance.pk)] if created else user_dependants(instance.pk))
+
+
+@receiver(post_save, sender=Chat)
+@receiver(post_delete, sender=Chat)
+def chat_saved(sender, instance, **kwargs):
+    forget([(CHAT, instance.pk), (CHAT_INFO, instance.pk)])
+
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def membership_saved(sender, instance, **kwargs):
+    forget_chats([instance.chat_id])
+
+
+@receiver(m2m_changed, sender=Chat.users.through)
+def chat_users_added(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add':
+        forget_chats(pk_set if reverse else [instance.pk])
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def message_saved(sender, instance, **kwargs):
+    # the message may be the last message of the chat
+    forget([(MESSAGE, instance.pk), (CHAT, instance.chat_id)])
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def image_saved(sender, instance, **kwargs):
+    image_changed(instance)
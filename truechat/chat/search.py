@@ -0,0 +1,55 @@
+"""
+Full-text search of messages
+
+Messages are matched against `to_tsvector('simple', content)` which is covered by the
+messages_content_search_idx expression index, so the tsvector is not stored in the table
+and is not loaded with every message.
+
+Headlines are built from the html escaped content, so the only tags in them are the highlighting ones.
+"""
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db.models import CharField, F, Func, Value
+from django.db.models.functions import Replace
+
+from chat.models import Chat, Message
+
+SEARCH_CONFIG = 'simple'
+
+
+HTML_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), ("'", '&#39;'))
+
+
+def escape_html(expression):
+    """Escapes html special characters of a text expression in the database like django.utils.html.escape"""
+    for char, entity in HTML_ESCAPES:
+        expression = Replace(expression, Value(char), Value(entity))
+    return expression
+
+
+class SearchHeadline(Func):
+    function = 'ts_headline'
+    output_field = CharField()
+    template = "%(function)s(%(config)s::regconfig, %(expressions)s)"
+
+    def __init__(self, expression, query, options, **extra):
+        super().__init__(expression, query, Value(options), config=f"'{SEARCH_CONFIG}'", **extra)
+
+
+def search_messages(user, text, chat_id=None):
+    """
+    Returns messages containing all words of text from chats available to user,
+    annotated with `rank` and `headline` of the html escaped content with highlighted words
+
+    :param user:
+    :param text:
+    :param chat_id: restricts search to a single chat
+    :return:
+    """
+    query = SearchQuery(text, config=SEARCH_CONFIG)
+    vector = SearchVector('content', config=SEARCH_CONFIG)
+    chats = Chat.objects.available_to(user)
+    if chat_id is not None:
+        chats = chats.filter(pk=chat_id)
+    headline = SearchHeadline(escape_html(F('content')), query, 'StartSel=<b>, StopSel=</b>, MaxFragments=2')
+    return Message.objects.annotate(search=vector).filter(search=query, chat__in=chats.values('pk'))\
+        .annotate(rank=SearchRank(vector, query), headline=headline)
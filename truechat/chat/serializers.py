@@ -1,8 +1,9 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from rest_framework.serializers import Serializer
 
 from attachments.serializers import ImageFieldSerializer
-from chat.models import Chat, Message
+from chat.models import Chat, Membership, Message
 from custom_auth.serializers import UserSerializerGet
 from custom_auth.models import User
 
@@ -12,30 +13,54 @@ class ChatSerializer(serializers.ModelSerializer):
     creator = UserSerializerGet()
     users = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
-    images = ImageFieldSerializer(many=True)
+    unread_count = serializers.SerializerMethodField()
+    images = ImageFieldSerializer(many=True, size='avatar')
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Prepares queryset of chats so that serializing them takes a fixed number of queries
+
+        :param queryset:
+        :return:
+        """
+        active_members = Membership.objects.filter(is_banned=False).select_related('user')\
+            .prefetch_related('user__images')
+        return queryset.select_related('creator', 'last_message__user', 'last_message__chat')\
+            .prefetch_related('images', 'creator__images', 'last_message__images', 'last_message__user__images',
+                              Prefetch('members', queryset=active_members, to_attr='active_members'))
+
+    def get_unread_count(self, instance):
+        return getattr(instance, 'unread_count', None)
 
     def get_last_message(self, instance):
-        try:
-            last_message = instance.messages.select_related('user', 'chat').prefetch_related('images', 'user__images')\
-                    .latest('date_created')
-        except Message.DoesNotExist:
-            last_message = None
+        last_message = instance.last_message
         return MessageSerializer(last_message).data if last_message else Serializer(None).data
 
     def get_users(self, instance):
-        users = User.objects.prefetch_related('images', 'memberships')\
-            .filter(memberships__in=instance.members.filter(is_banned=False))
+        if hasattr(instance, 'active_members'):
+            users = [membership.user for membership in instance.active_members]
+        else:
+            users = User.objects.prefetch_related('images', 'memberships')\
+                .filter(memberships__in=instance.members.filter(is_banned=False))
         return UserSerializerGet(users, many=True).data
 
     class Meta:
         model = Chat
         fields = ("id", "name", "description", "creator", "users", "is_dialog", "date_created",
-                  "last_message", "images")
+                  "last_message", "unread_count", "images")
 
 
 class ChatSerializerChange(serializers.ModelSerializer):
     """Chat room serialization"""
 
+    def update(self, instance, validated_data):
+        """Saves only the given fields, a full save would write back a stale last message pointer"""
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=list(validated_data))
+        return instance
+
     class Meta:
         model = Chat
         fields = ("id", "name", "description")
@@ -44,14 +69,31 @@ class ChatSerializerChange(serializers.ModelSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     chat = ChatSerializerChange()
     user = UserSerializerGet()
-    images = ImageFieldSerializer(many=True)
+    images = ImageFieldSerializer(many=True, size='preview')
 
     class Meta:
         model = Message
         fields = ("id", "user", "content", "chat", 'date_created', 'images')
 
 
+class MessageSearchSerializer(MessageSerializer):
+    rank = serializers.FloatField(read_only=True)
+    headline = serializers.CharField(read_only=True)
+
+    class Meta(MessageSerializer.Meta):
+        fields = MessageSerializer.Meta.fields + ('rank', 'headline')
+
+
 class MessageSerializerChange(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = ("id", "content")
+
+
+class MessageSerializerBulk(serializers.ModelSerializer):
+    """Message of a batch, chat is a plain id, so that a batch is validated without queries"""
+    chat = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        model = Message
+        fields = ("chat", "content")
@@ -0,0 +1,165 @@
+"""
+Incremental synchronisation of clients from the ChatChange log
+
+Ids of changes are taken when rows are inserted, but transactions commit in another order,
+so a change may become visible after changes with larger ids were already sent to a client.
+Changes are read in the order of (txid, id) instead, txid being the id of the inserting transaction,
+and only changes of transactions older than every transaction still in progress are returned.
+Transactions committing later have larger txids, so no change can appear behind a cursor.
+
+Changes are kept for CHAT_CHANGES_RETENTION_DAYS, cursors carry the time they were issued at
+and older ones are rejected as expired: their clients have to reload chats and take a new cursor.
+"""
+import base64
+import binascii
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from chat.models import Chat, ChatChange, Message
+from custom_auth.models import User
+
+Cursor = namedtuple('Cursor', ['txid', 'change_id', 'issued_at'])
+
+# pruning lags behind expiration of cursors, so that changes of transactions lasting while a cursor
+# was issued are not deleted before the cursor expires
+PRUNE_MARGIN = timedelta(days=1)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class ExpiredCursor(InvalidCursor):
+    pass
+
+
+def txid():
+    return RawSQL(f'{connection.ops.quote_name(ChatChange._meta.db_table)}.txid', ())
+
+
+def snapshot_xmin():
+    """Id of the oldest transaction in progress, all older ones are either committed or rolled back"""
+    return RawSQL('txid_snapshot_xmin(txid_current_snapshot())', ())
+
+
+def encode_cursor(cursor):
+    value = f'{cursor.txid}.{cursor.change_id}.{cursor.issued_at}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    try:
+        parts = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode().split('.')
+        cursor = Cursor(*map(int, parts)) if len(parts) == 3 else None
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor('Cursor is invalid')
+    if len(parts) == 1 and parts[0].isdigit():
+        # cursors of the id order can not be converted, changes behind them may be missing
+        raise ExpiredCursor('Cursor is expired')
+    if cursor is None or min(cursor) < 0:
+        raise InvalidCursor('Cursor is invalid')
+    if cursor.issued_at < time.time() - settings.CHAT_CHANGES_RETENTION_DAYS * 24 * 3600:
+        raise ExpiredCursor('Cursor is expired')
+    return cursor
+
+
+def head_cursor():
+    """Cursor pointing after all changes already committed, some later ones may be in the state read after it"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        xmin = cursor.fetchone()[0]
+    return Cursor(xmin, 0, int(time.time()))
+
+
+def visible_changes(user, cursor):
+    """
+    Queryset of changes visible to user after cursor in the order of (txid, id)
+
+    Ids of chats are loaded beforehand: a subquery under OR is only a filter, while a list lets both sides
+    of OR seek indexes (chat_id, txid, id) and (user_id, txid, id) to the cursor, so the cost follows
+    the number of changes missed by the user instead of all changes made since the cursor.
+
+    :param user:
+    :param cursor: Cursor
+    :return:
+    """
+    chat_ids = list(Chat.objects.available_to(user).values_list('id', flat=True))
+    return ChatChange.objects.annotate(txid=txid())\
+        .filter(Q(txid__gt=cursor.txid) | Q(txid=cursor.txid, id__gt=cursor.change_id),
+                Q(chat_id__in=chat_ids) | Q(user_id=user.id), txid__gte=cursor.txid, txid__lt=snapshot_xmin())\
+        .order_by('txid', 'id')
+
+
+def get_changes(user, cursor, limit):
+    """
+    Returns up to limit changes visible to user after cursor, whether there are more of them and the next cursor
+
+    Changes are visible when they happened in a chat currently available to the user
+    or concern the user personally, e.g. removal from a chat.
+
+    :param user:
+    :param cursor: Cursor
+    :param limit:
+    :return:
+    """
+    changes = list(visible_changes(user, cursor)[:limit + 1])
+    changes, has_more = changes[:limit], len(changes) > limit
+    position = (changes[-1].txid, changes[-1].id) if changes else cursor[:2]
+    # the client is up to date only after the last page
+    issued_at = cursor.issued_at if has_more else int(time.time())
+    return changes, has_more, Cursor(*position, issued_at)
+
+
+def prune_changes():
+    """Deletes changes which are older than any cursor may be, returns their number"""
+    deadline = timezone.now() - timedelta(days=settings.CHAT_CHANGES_RETENTION_DAYS) - PRUNE_MARGIN
+    deleted, _ = ChatChange.objects.filter(date_created__lt=deadline).delete()
+    return deleted
+
+
+def serialize_changes(changes, issued_at):
+    """
+    Serializes changes with current state of the changed objects loaded in a fixed number of queries
+
+    :param changes: changes returned by get_changes
+    :param issued_at: time of the cursor the changes were read after
+    :return:
+    """
+    from chat.serializers import ChatSerializerChange, MessageSerializer
+
+    message_ids = {change.object_id for change in changes
+                   if change.event in (ChatChange.MESSAGE_CREATED, ChatChange.MESSAGE_UPDATED)}
+    messages = Message.objects.filter(id__in=message_ids).select_related('chat', 'user')\
+        .prefetch_related('images', 'user__images').in_bulk() if message_ids else {}
+    chat_ids = {change.chat_id for change in changes if change.event == ChatChange.CHAT_UPDATED}
+    chats = Chat.objects.filter(id__in=chat_ids).in_bulk() if chat_ids else {}
+    user_ids = {change.user_id for change in changes if change.event.startswith('membership.')}
+    users = User.objects.filter(id__in=user_ids).only('id', 'username').in_bulk() if user_ids else {}
+
+    result = []
+    for change in changes:
+        if change.event in (ChatChange.MESSAGE_CREATED, ChatChange.MESSAGE_UPDATED):
+            message = messages.get(change.object_id)
+            # deleted messages are reported by their own later change
+            data = MessageSerializer(message).data if message else None
+        elif change.event == ChatChange.MESSAGE_DELETED:
+            data = {'id': change.object_id, 'chat': change.chat_id}
+        elif change.event == ChatChange.CHAT_UPDATED:
+            chat = chats.get(change.chat_id)
+            data = ChatSerializerChange(chat).data if chat else None
+        elif change.event == ChatChange.CHAT_DELETED:
+            data = {'id': change.chat_id}
+        else:
+            user = users.get(change.user_id)
+            data = {'chat': change.chat_id,
+                    'user': {'id': change.user_id, 'username': user.username if user else None}}
+        result.append({'cursor': encode_cursor(Cursor(change.txid, change.id, issued_at)), 'event': change.event, 'chat': change.chat_id,
+                       'data': data, 'date_created': change.date_created})
+    return result
@@ -1,3 +1,754 @@
-from django.test import TestCase
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from chat.access import NO_MEMBERSHIP, access_object, cache_key, load_membership, read_membership
+from chat.models import Chat, ChatChange, Membership, Message
+from chat.payloads import chat_payloads, get_versions
+from chat.serializers import ChatSerializerChange
+from chat.sync import Cursor, encode_cursor, get_changes, prune_changes, visible_changes
+from custom_auth.models import User
+from custom_auth.signed_tokens import issue_tokens
+from truechat.routing import application
+
+
+class ChatListQueriesTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.friend = User.objects.create_user(username='friend', email='friend@truechat.com', password='password')
+        self.client.force_authenticate(self.user)
+        # warms up ContentType cache used by generic image relations
+        ContentType.objects.get_for_models(Chat, Message, User)
+
+    def create_chats(self, count):
+        chats = Chat.objects.bulk_create([Chat(name=f'chat{i}', creator=self.friend) for i in range(count)])
+        Membership.objects.bulk_create([Membership(user=user, chat=chat)
+                                        for chat in chats for user in (self.user, self.friend)])
+        Message.objects.bulk_create([Message(chat=chat, user=self.friend, content=f'message of {chat.name}')
+                                     for chat in chats])
+        Chat.objects.filter(pk__in=[chat.pk for chat in chats]).refresh_last_messages()
+
+    def count_list_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context), response
+
+    def test_list_query_count_does_not_depend_on_chats_count(self):
+        self.create_chats(10)
+        few_chats_queries, response = self.count_list_queries('/chats/')
+        self.assertEqual(len(response.data), 10)
+        self.assertEqual(response.data[0]['last_message']['content'], f'message of {response.data[0]["name"]}')
+        self.assertEqual({user['username'] for user in response.data[0]['users']}, {'owner', 'friend'})
+
+        self.create_chats(990)
+        many_chats_queries, response = self.count_list_queries('/chats/')
+        self.assertEqual(len(response.data), 1000)
+        self.assertEqual(few_chats_queries, many_chats_queries)
+
+    def test_paginated_list_query_count_does_not_depend_on_chats_count(self):
+        self.create_chats(10)
+        few_chats_queries, _ = self.count_list_queries('/chats/?page=1')
+        self.create_chats(990)
+        many_chats_queries, response = self.count_list_queries('/chats/?page=1')
+        self.assertEqual(response.data['count'], 1000)
+        self.assertEqual(few_chats_queries, many_chats_queries)
+
+
+class LastMessageTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+        self.client.force_authenticate(self.user)
+
+    def test_new_message_moves_pointer(self):
+        response = self.client.post(f'/chats/{self.chat.id}/add_message/', {'content': 'hello'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message.content, 'hello')
+        self.assertEqual(self.chat.last_activity_at, self.chat.last_message.date_created)
+
+    def test_update_of_stale_chat_keeps_pointer(self):
+        stale = Chat.objects.get(pk=self.chat.pk)
+        message = Message.objects.create(chat=self.chat, user=self.user, content='newer')
+        serializer = ChatSerializerChange(stale, data={'name': 'renamed'}, partial=True)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.name, 'renamed')
+        self.assertEqual(self.chat.last_message_id, message.id)
+
+
+class MessageKeysetPaginationTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+        self.client.force_authenticate(self.user)
+        start = timezone.now() - timedelta(days=1)
+        # pairs of messages share dates, so that pages are ordered by id within the same date
+        self.messages = Message.objects.bulk_create([
+            Message(chat=self.chat, user=self.user, content=f'message {i}', date_created=start + timedelta(i // 2))
+            for i in range(25)])
+        self.ids = [message.id for message in self.messages][::-1]
+
+    def get_page(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_scroll_back_returns_every_message_once(self):
+        url, ids = f'/chats/{self.chat.id}/messages/', []
+        params = {'limit': 7}
+        while url:
+            page = self.get_page(url, **params)
+            ids += [message['id'] for message in page['results']]
+            url, params = page['next'], {}
+        self.assertEqual(ids, self.ids)
+
+    def test_after_returns_newer_messages(self):
+        page = self.get_page(f'/chats/{self.chat.id}/messages/', after=self.ids[10], limit=4)
+        self.assertEqual([message['id'] for message in page['results']], self.ids[6:10])
+        self.assertIsNotNone(page['previous'])
+        self.assertIsNotNone(page['next'])
+
+    def test_around_includes_anchor(self):
+        page = self.get_page(f'/chats/{self.chat.id}/messages/', around=self.ids[10], limit=5)
+        self.assertEqual([message['id'] for message in page['results']], self.ids[8:13])
+
+    def test_first_and_last_pages_have_no_links_outwards(self):
+        page = self.get_page(f'/chats/{self.chat.id}/messages/', limit=30)
+        self.assertEqual(len(page['results']), 25)
+        self.assertIsNone(page['next'])
+        self.assertIsNone(page['previous'])
+
+    def test_invalid_anchors(self):
+        url = f'/chats/{self.chat.id}/messages/'
+        self.assertEqual(self.client.get(url, {'before': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'before': 1, 'after': 2}).status_code, 400)
+        other = Chat.objects.create(name='other', creator=self.user)
+        message = Message.objects.create(chat=other, user=self.user, content='elsewhere')
+        self.assertEqual(self.client.get(url, {'before': message.id}).status_code, 404)
+
+
+class ChatEventsTest(APITransactionTestCase):
+    """Websocket fan-out through the in-memory channel layer, events are sent after transactions commit"""
+
+    @classmethod
+    def setUpClass(cls):
+        super(ChatEventsTest, cls).setUpClass()
+        # consumers query the database from threads which are not reused, their connections must not outlive calls
+        cls.conn_max_age = connection.settings_dict['CONN_MAX_AGE']
+        connection.settings_dict['CONN_MAX_AGE'] = 0
+
+    @classmethod
+    def tearDownClass(cls):
+        connection.settings_dict['CONN_MAX_AGE'] = cls.conn_max_age
+        super(ChatEventsTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.friend = User.objects.create_user(username='friend', email='friend@truechat.com', password='password')
+        self.stranger = User.objects.create_user(username='stranger', email='stranger@truechat.com',
+                                                 password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user, self.friend)
+        self.client.force_authenticate(self.user)
+        self.tokens = {user: Token.objects.create(user=user).key for user in (self.friend, self.stranger)}
+
+    async def post(self, *args, **kwargs):
+        def request():
+            # the test client does not close connections after requests
+            try:
+                return self.client.post(*args, **kwargs)
+            finally:
+                connection.close()
+
+        return await sync_to_async(request)()
+
+    def connect(self, user):
+        return WebsocketCommunicator(application, f'/ws/chats/?token={self.tokens[user]}')
+
+    def test_anonymous_connection_is_closed(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(application, '/ws/chats/?token=wrong')
+            connected, _ = await communicator.connect()
+            self.assertFalse(connected)
+
+        async_to_sync(scenario)()
+
+    def test_signed_tokens_are_accepted(self):
+        access = issue_tokens(self.friend)['access']
+
+        async def scenario():
+            for communicator in (WebsocketCommunicator(application, f'/ws/chats/?token={access}'),
+                                 WebsocketCommunicator(application, '/ws/chats/',
+                                                       headers=[(b'authorization', f'Bearer {access}'.encode())])):
+                self.assertTrue((await communicator.connect())[0])
+                await communicator.disconnect()
+            communicator = WebsocketCommunicator(application, f'/ws/chats/?token={access}x')
+            self.assertFalse((await communicator.connect())[0])
+
+        async_to_sync(scenario)()
+
+    def test_members_receive_new_messages(self):
+        async def scenario():
+            friend = self.connect(self.friend)
+            stranger = self.connect(self.stranger)
+            self.assertTrue((await friend.connect())[0])
+            self.assertTrue((await stranger.connect())[0])
+            response = await self.post(f'/chats/{self.chat.id}/add_message/', {'content': 'hello'}, format='json')
+            self.assertEqual(response.status_code, 200)
+            event = await friend.receive_json_from()
+            self.assertEqual(event['event'], 'message.created')
+            self.assertEqual(event['data']['content'], 'hello')
+            self.assertTrue(await stranger.receive_nothing())
+            await friend.disconnect()
+            await stranger.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_added_member_is_subscribed(self):
+        async def scenario():
+            stranger = self.connect(self.stranger)
+            self.assertTrue((await stranger.connect())[0])
+            response = await self.post(f'/chats/{self.chat.id}/add_member/stranger/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual((await stranger.receive_json_from())['event'], 'membership.added')
+            await self.post(f'/chats/{self.chat.id}/add_message/', {'content': 'welcome'}, format='json')
+            self.assertEqual((await stranger.receive_json_from())['data']['content'], 'welcome')
+            await stranger.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_bulk_added_members_are_notified_together(self):
+        async def scenario():
+            stranger = self.connect(self.stranger)
+            self.assertTrue((await stranger.connect())[0])
+            response = await self.post(f'/chats/{self.chat.id}/add_members/',
+                                       {'usernames': ['stranger', 'nobody']}, format='json')
+            self.assertEqual(response.data['results'], {'stranger': 'added', 'nobody': 'not_found'})
+            self.assertEqual((await stranger.receive_json_from())['event'], 'membership.added')
+            await self.post(f'/chats/{self.chat.id}/add_message/', {'content': 'welcome'}, format='json')
+            self.assertEqual((await stranger.receive_json_from())['data']['content'], 'welcome')
+            await stranger.disconnect()
+
+        async_to_sync(scenario)()
+
+class SyncTest(APITransactionTestCase):
+    """Changes are committed by real transactions here, the log is ordered by them"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+        self.client.force_authenticate(self.user)
+
+    def sync(self, cursor, status_code=200, **params):
+        response = self.client.get('/chats/sync/', dict(params, cursor=cursor))
+        self.assertEqual(response.status_code, status_code, response.data)
+        return response.data
+
+    def head(self):
+        return self.client.get('/chats/sync/').data['cursor']
+
+    def send(self, content):
+        response = self.client.post(f'/chats/{self.chat.id}/add_message/', {'content': content}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_changes_after_cursor(self):
+        cursor = self.head()
+        self.send('first')
+        self.send('second')
+        page = self.sync(cursor, limit=1)
+        self.assertTrue(page['has_more'])
+        self.assertEqual([change['data']['content'] for change in page['changes']], ['first'])
+        page = self.sync(page['cursor'])
+        self.assertFalse(page['has_more'])
+        self.assertEqual([change['data']['content'] for change in page['changes']], ['second'])
+        self.assertEqual(self.sync(page['cursor'])['changes'], [])
+
+    def test_change_committed_late_is_not_skipped(self):
+        cursor = self.head()
+        # another connection inserts a change, which gets a smaller id, and commits after the message
+        other = connection.get_new_connection(connection.get_connection_params())
+        try:
+            with other.cursor() as other_cursor:
+                other_cursor.execute("INSERT INTO chat_changes (event, chat_id, date_created) VALUES (%s, %s, now())",
+                                     [ChatChange.CHAT_UPDATED, self.chat.id])
+            self.send('hello')
+            page = self.sync(cursor)
+            self.assertEqual(page['changes'], [])
+            other.commit()
+        finally:
+            other.close()
+        page = self.sync(page['cursor'])
+        self.assertEqual([change['event'] for change in page['changes']],
+                         [ChatChange.CHAT_UPDATED, ChatChange.MESSAGE_CREATED])
+
+    def test_removed_member_gets_own_removal(self):
+        friend = User.objects.create_user(username='friend', email='friend@truechat.com', password='password')
+        self.chat.users.add(friend)
+        self.client.force_authenticate(friend)
+        cursor = self.head()
+        self.client.force_authenticate(self.user)
+        self.send('before removal')
+        self.assertEqual(self.client.delete(f'/chats/{self.chat.id}/delete_member/friend/').status_code, 200)
+        self.send('after removal')
+        self.client.force_authenticate(friend)
+        events = [change['event'] for change in self.sync(cursor)['changes']]
+        self.assertEqual(events, [ChatChange.MEMBERSHIP_REMOVED])
+
+    def test_invalid_and_expired_cursors(self):
+        self.sync('not a cursor', status_code=400)
+        # cursors of the id order were base64 encoded ids
+        self.sync('MTA', status_code=410)
+        old = int(time.time()) - (settings.CHAT_CHANGES_RETENTION_DAYS + 1) * 24 * 3600
+        self.sync(encode_cursor(Cursor(0, 0, old)), status_code=410)
+
+    def test_prune_keeps_recent_changes(self):
+        self.send('recent')
+        old = ChatChange.objects.create(event=ChatChange.CHAT_UPDATED, chat_id=self.chat.id)
+        ChatChange.objects.filter(pk=old.pk).update(
+            date_created=timezone.now() - timedelta(days=settings.CHAT_CHANGES_RETENTION_DAYS + 2))
+        self.assertEqual(prune_changes(), 1)
+        self.assertTrue(ChatChange.objects.filter(event=ChatChange.MESSAGE_CREATED).exists())
+
+
+class SyncQueryTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        stranger = User.objects.create_user(username='stranger', email='stranger@truechat.com', password='password')
+        chats = Chat.objects.bulk_create([Chat(name=f'chat{i}', creator=self.user) for i in range(30)])
+        Membership.objects.bulk_create([Membership(chat=chat, user=self.user) for chat in chats])
+        others = Chat.objects.bulk_create([Chat(name=f'other{i}', creator=stranger) for i in range(100)])
+        # traffic of other users outnumbers changes of the user by far
+        ChatChange.objects.bulk_create([ChatChange(event=ChatChange.MESSAGE_CREATED, chat_id=others[i % 100].id)
+                                        for i in range(20000)])
+        ChatChange.objects.bulk_create([ChatChange(event=ChatChange.MESSAGE_CREATED, chat_id=chat.id)
+                                        for chat in chats])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT txid_current()')
+            self.cursor = Cursor(cursor.fetchone()[0] - 1, 0, int(time.time()))
+            cursor.execute('ANALYZE chat_changes')
+
+    def test_changes_are_sought_by_chats_and_user(self):
+        plan = visible_changes(self.user, self.cursor).explain()
+        self.assertIn('chat_changes_chat_txid_idx', plan)
+        self.assertIn('chat_changes_user_txid_idx', plan)
+        self.assertRegex(plan, r'Index Cond: \(\(chat_id = ANY .* AND \(txid >= ')
+        self.assertNotIn('Seq Scan on chat_changes', plan)
+
+    def test_changes_take_fixed_number_of_queries(self):
+        with self.assertNumQueries(2):
+            get_changes(self.user, self.cursor, 100)
+
+
+class ReadWatermarkTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.friend = User.objects.create_user(username='friend', email='friend@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user, self.friend)
+        self.messages = Message.objects.bulk_create([Message(chat=self.chat, user=self.friend, content=f'message {i}')
+                                                     for i in range(10000)])
+        Chat.objects.filter(pk=self.chat.pk).refresh_last_messages()
+        self.client.force_authenticate(self.user)
+
+    def read(self, **data):
+        response = self.client.post(f'/chats/{self.chat.id}/read/', data, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_unread_counts_in_list(self):
+        self.read(message_id=self.messages[5999].id)
+        response = self.client.get('/chats/')
+        self.assertEqual(response.data[0]['unread_count'], 4000)
+
+    def test_reading_whole_chat_is_one_update(self):
+        with CaptureQueriesContext(connection) as context:
+            data = self.read()
+        self.assertEqual(data['unread_count'], 0)
+        self.assertEqual(data['last_read_message_id'], self.messages[-1].id)
+        updates = [query['sql'] for query in context if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse([query for query in context if query['sql'].startswith('INSERT')])
+
+    def test_watermark_never_moves_back(self):
+        self.read(message_id=self.messages[10].id)
+        data = self.read(message_id=self.messages[5].id)
+        self.assertEqual(data['last_read_message_id'], self.messages[10].id)
+        self.assertEqual(data['unread_count'], 10000 - 11)
+
+    def test_watermark_is_capped_at_last_message(self):
+        data = self.read(message_id=self.messages[-1].id + 100)
+        self.assertEqual(data['last_read_message_id'], self.messages[-1].id)
+
+    def test_invalid_message_id(self):
+        response = self.client.post(f'/chats/{self.chat.id}/read/', {'message_id': 'last'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_list_body_is_rejected(self):
+        response = self.client.post(f'/chats/{self.chat.id}/read/', [], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Membership.objects.get(chat=self.chat, user=self.user).last_read_message_id, 0)
+
+
+class MessageSearchTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        response = self.client.get('/messages/search/', params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def create_messages(self, *contents, chat=None):
+        return Message.objects.bulk_create([Message(chat=chat or self.chat, user=self.user, content=content)
+                                            for content in contents])
+
+    def test_only_available_chats_are_searched(self):
+        stranger = User.objects.create_user(username='stranger', email='stranger@truechat.com', password='password')
+        other = Chat.objects.create(name='other', creator=stranger)
+        banned = Chat.objects.create(name='banned', creator=stranger)
+        Membership.objects.create(chat=banned, user=self.user, is_banned=True)
+        self.create_messages('secret plan')
+        self.create_messages('secret of other chat', chat=other)
+        self.create_messages('secret of banned chat', chat=banned)
+        self.assertEqual([message['content'] for message in self.search(q='secret')['results']], ['secret plan'])
+
+    def test_headline_escapes_content(self):
+        self.create_messages('<script>alert("hacked")</script> & hello')
+        headline = self.search(q='hello')['results'][0]['headline']
+        self.assertNotIn('<script', headline)
+        self.assertNotIn('</script', headline)
+        self.assertIn('&lt;/script&gt; &amp;', headline)
+        self.assertIn('<b>hello</b>', headline)
+
+    def test_results_are_ordered_by_rank(self):
+        weak, strong = self.create_messages('cat ' + 'and some other words ' * 20, 'cat cat cat')
+        results = self.search(q='cat')['results']
+        self.assertEqual([message['id'] for message in results], [strong.id, weak.id])
+        self.assertGreater(results[0]['rank'], results[1]['rank'])
+
+    def test_rank_pages_return_every_message_once(self):
+        self.create_messages(*['word ' * (i % 5 + 1) + 'filler ' * i for i in range(23)])
+        ids, params = [], {'q': 'word', 'limit': 5}
+        while True:
+            page = self.search(**params)
+            ids += [message['id'] for message in page['results']]
+            if not page['next']:
+                break
+            params = dict(params, before=page['next'].split('before=')[1].split('&')[0])
+        self.assertEqual(len(ids), 23)
+        self.assertEqual(len(set(ids)), 23)
+        after = self.search(q='word', limit=3, after=ids[10])['results']
+        self.assertEqual([message['id'] for message in after], ids[7:10])
+
+    def test_date_order(self):
+        messages = self.create_messages('dog', 'dog dog dog', 'dog')
+        results = self.search(q='dog', order='date')['results']
+        self.assertEqual([message['id'] for message in results], [message.id for message in messages][::-1])
+
+
+class AccessCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.friend = User.objects.create_user(username='friend', email='friend@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.owner)
+        self.chat.users.add(self.owner, self.friend)
+        self.client.force_authenticate(self.friend)
+
+    def get_chat(self):
+        return self.client.get(f'/chats/{self.chat.id}/').status_code
+
+    def count_access_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.get_chat(), 200)
+        return len([query for query in context
+                    if query['sql'].startswith('SELECT "Membership"."id", "Membership"."is_banned" FROM')])
+
+    @override_settings(SHARED_CACHE=False)
+    def test_without_shared_cache_access_is_read_from_database(self):
+        self.assertEqual(self.get_chat(), 200)
+        # a change made by another process, which can not drop anything from this process' cache
+        Membership.objects.filter(user=self.friend).update(is_banned=True)
+        self.assertEqual(self.get_chat(), 403)
+
+    @override_settings(SHARED_CACHE=True)
+    def test_shared_cache_is_used_and_dropped_on_ban(self):
+        self.assertEqual(self.count_access_queries(), 1)
+        self.assertEqual(self.count_access_queries(), 0)
+        self.client.force_authenticate(self.owner)
+        self.assertEqual(self.client.put(f'/chats/{self.chat.id}/ban_member/friend/').status_code, 200)
+        self.client.force_authenticate(self.friend)
+        self.assertEqual(self.get_chat(), 403)
+
+    @override_settings(SHARED_CACHE=True)
+    def test_membership_read_before_change_is_not_reused(self):
+        obj = access_object(self.chat.id, self.friend.id)
+        version = get_versions([obj])[obj]
+        membership = read_membership(self.chat.id, self.friend.id)
+        # the membership is removed while the request above is still running
+        self.chat.users.remove(self.friend)
+        cache.set(cache_key(self.chat.id, self.friend.id, version), membership)
+        self.assertEqual(load_membership(self.chat.id, self.friend.id), NO_MEMBERSHIP)
+
+
+class PayloadCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+        self.client.force_authenticate(self.user)
+
+    def get_names(self):
+        return [chat['name'] for chat in self.client.get('/chats/').data]
+
+    @override_settings(SHARED_CACHE=False)
+    def test_without_shared_cache_payloads_are_built_every_time(self):
+        self.assertEqual(self.get_names(), ['chat'])
+        # a change made by another process, which can not drop anything from this process' cache
+        Chat.objects.filter(pk=self.chat.pk).update(name='renamed')
+        self.assertEqual(self.get_names(), ['renamed'])
+
+    @override_settings(SHARED_CACHE=True)
+    def test_shared_cache_is_used_and_dropped_on_change(self):
+        with CaptureQueriesContext(connection) as first:
+            self.assertEqual(self.get_names(), ['chat'])
+        with CaptureQueriesContext(connection) as second:
+            self.assertEqual(self.get_names(), ['chat'])
+        self.assertLess(len(second), len(first))
+        self.client.patch(f'/chats/{self.chat.id}/', {'name': 'renamed'}, format='json')
+        self.assertEqual(self.get_names(), ['renamed'])
+
+
+@override_settings(SHARED_CACHE=True)
+class MessagePayloadRaceTest(APITransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+
+    def test_payload_cached_before_pointer_update_is_dropped(self):
+        def cache_chat(sender, instance, **kwargs):
+            # a concurrent request caches the chat after its payload was dropped, before it points to the message
+            chat_payloads([instance.chat_id], self.user)
+
+        post_save.connect(cache_chat, sender=Message, weak=False)
+        try:
+            message = Message.objects.create(chat=self.chat, user=self.user, content='hello')
+        finally:
+            post_save.disconnect(cache_chat, sender=Message)
+        self.assertEqual(chat_payloads([self.chat.id], self.user)[0]['last_message']['id'], message.id)
+
+
+class PartitionMessagesTest(APITestCase):
+    """Partitioning runs in the transaction of the test, which rolls it back"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+        self.client.force_authenticate(self.user)
+
+    def create_message(self, date_created):
+        return Message.objects.create(chat=self.chat, user=self.user, content='hello', date_created=date_created)
+
+    def partition(self, ahead):
+        with connection.cursor() as cursor:
+            # checks of foreign keys deferred by the test transaction would keep messages from being dropped
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        call_command('partition_messages', 'range', '--ahead', str(ahead), stdout=StringIO())
+
+    def partitions(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass::text, COUNT(*) FROM messages GROUP BY 1')
+            return dict(cursor.fetchall())
+
+    def test_rows_of_default_partition_are_moved_to_new_months(self):
+        now = timezone.now()
+        self.create_message(now)
+        self.partition(1)
+        future = now + timedelta(days=200)
+        self.create_message(future)
+        self.assertEqual(self.partitions()['messages_default'], 1)
+
+        self.partition(8)
+        self.assertEqual(self.partitions(), {f'messages_{now:%Y_%m}': 1, f'messages_{future:%Y_%m}': 1})
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM pg_inherits WHERE inhrelid = 'messages_default'::regclass")
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_first_page_is_bounded_to_recent_messages(self):
+        now = timezone.now()
+        old = [self.create_message(now - timedelta(days=400 + i)) for i in range(3)]
+        recent = [self.create_message(now - timedelta(days=i)) for i in range(3)]
+        self.partition(1)
+        with CaptureQueriesContext(connection) as context:
+            page = self.client.get(f'/chats/{self.chat.id}/messages/', {'limit': 3}).data
+        self.assertEqual([message['id'] for message in page['results']], [message.id for message in recent])
+        pages = [query['sql'] for query in context if 'FROM "messages"' in query['sql'] and 'LIMIT 4' in query['sql']]
+        self.assertEqual(len(pages), 1)
+        self.assertIn('"messages"."date_created" >=', pages[0])
+
+        page = self.client.get(page['next']).data
+        self.assertEqual([message['id'] for message in page['results']], [message.id for message in old])
+        self.assertIsNone(page['next'])
+
+
+class BulkMessagesTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chats = [Chat.objects.create(name=f'chat{i}', creator=self.user) for i in range(2)]
+        for chat in self.chats:
+            chat.users.add(self.user)
+        self.client.force_authenticate(self.user)
+
+    def post(self, url, data, status_code=200):
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status_code, response.data)
+        return response.data
+
+    def test_add_messages_to_several_chats(self):
+        data = self.post('/chats/add_messages/', {'messages': [
+            {'chat': self.chats[0].id, 'content': 'first'},
+            {'chat': self.chats[1].id, 'content': 'second'},
+            {'chat': self.chats[0].id, 'content': 'third'},
+        ]})
+        self.assertEqual([message['content'] for message in data], ['first', 'second', 'third'])
+        for chat, content in zip(self.chats, ['third', 'second']):
+            chat.refresh_from_db()
+            self.assertEqual(chat.last_message.content, content)
+        self.assertEqual(ChatChange.objects.filter(event=ChatChange.MESSAGE_CREATED).count(), 3)
+
+    def test_add_messages_to_unavailable_chat_adds_nothing(self):
+        stranger = User.objects.create_user(username='stranger', email='stranger@truechat.com', password='password')
+        other = Chat.objects.create(name='other', creator=stranger)
+        self.post('/chats/add_messages/', {'messages': [{'chat': self.chats[0].id, 'content': 'mine'},
+                                                        {'chat': other.id, 'content': 'theirs'}]}, status_code=403)
+        self.assertFalse(Message.objects.exists())
+
+    def test_invalid_batches(self):
+        self.post('/chats/add_messages/', [{'chat': self.chats[0].id, 'content': 'list'}], status_code=400)
+        self.post('/chats/add_messages/', {'messages': []}, status_code=400)
+        self.post('/chats/add_messages/', {'messages': [{'chat': self.chats[0].id}]}, status_code=400)
+        too_many = [{'chat': self.chats[0].id, 'content': 'hello'}] * 501
+        self.post('/chats/add_messages/', {'messages': too_many}, status_code=400)
+        self.assertFalse(Message.objects.exists())
+
+
+class BulkMembersTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.friends = [User.objects.create_user(username=f'friend{i}', email=f'friend{i}@truechat.com',
+                                                 password='password') for i in range(3)]
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+        self.client.force_authenticate(self.user)
+
+    def post(self, url, data, status_code=200):
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status_code, response.data)
+        return response.data
+
+    def test_members_are_changed_in_bulk(self):
+        url = f'/chats/{self.chat.id}/'
+        usernames = [friend.username for friend in self.friends]
+        data = self.post(url + 'add_members/', {'usernames': usernames + ['owner', 'nobody']})
+        self.assertEqual(data['results'], dict(dict.fromkeys(usernames, 'added'), owner='already_member',
+                                               nobody='not_found'))
+        data = self.client.put(url + 'ban_members/', {'usernames': usernames[:2]}, format='json').data
+        self.assertEqual(data['results'], dict.fromkeys(usernames[:2], 'banned'))
+        data = self.post(url + 'add_members/', {'usernames': usernames[:1]})
+        self.assertEqual(data['results'], {usernames[0]: 'banned'})
+        data = self.client.put(url + 'unban_members/', {'usernames': usernames[:1]}, format='json').data
+        self.assertEqual(data['results'], {usernames[0]: 'unbanned'})
+        data = self.post(url + 'delete_members/', {'usernames': usernames + ['owner']})
+        self.assertEqual(data['results'], {usernames[0]: 'removed', usernames[1]: 'banned', usernames[2]: 'removed',
+                                           'owner': 'owner'})
+        self.assertEqual(set(Membership.objects.filter(chat=self.chat).values_list('user__username', flat=True)),
+                         {'owner', usernames[1]})
+
+    def test_bulk_change_is_published_with_one_callback(self):
+        callbacks = len(connection.run_on_commit)
+        usernames = [friend.username for friend in self.friends]
+        self.post(f'/chats/{self.chat.id}/add_members/', {'usernames': usernames})
+        self.assertEqual(len(connection.run_on_commit) - callbacks, 1)
+        self.assertEqual(ChatChange.objects.filter(event=ChatChange.MEMBERSHIP_ADDED).count(), 3)
+
+    def test_invalid_usernames(self):
+        url = f'/chats/{self.chat.id}/add_members/'
+        self.post(url, ['friend0'], status_code=400)
+        self.post(url, {'usernames': 'friend0'}, status_code=400)
+        self.post(url, {'usernames': [1]}, status_code=400)
+
+
+class DialogCreationTest(APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.friend = User.objects.create_user(username='friend', email='friend@truechat.com', password='password')
+        self.client.force_authenticate(self.user)
+
+    def test_dialog_is_created_once_for_both_sides(self):
+        response = self.client.post('/chats/private_chats/friend/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({user['username'] for user in response.data['users']}, {'owner', 'friend'})
+        self.client.force_authenticate(self.friend)
+        response = self.client.post('/chats/private_chats/owner/')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(len(response.data['data']), 1)
+        self.assertEqual(len(self.client.get('/chats/private_chats/owner/').data), 1)
+        self.assertEqual(Chat.objects.filter(is_dialog=True).count(), 1)
+
+    def test_concurrently_created_dialog_conflicts(self):
+        low, high = Chat.dialog_pair(self.user, self.friend)
+        other = connection.get_new_connection(connection.get_connection_params())
+        responses = []
+
+        def request():
+            try:
+                responses.append(self.client.post('/chats/private_chats/friend/'))
+            finally:
+                connection.close()
+
+        try:
+            # another request inserts the dialog and has not committed yet
+            with other.cursor() as cursor:
+                cursor.execute('INSERT INTO chats (name, is_dialog, dialog_user_low_id, dialog_user_high_id, '
+                               'date_created, last_activity_at) VALUES (%s, true, %s, %s, now(), now())',
+                               ['friend-owner', low, high])
+            thread = threading.Thread(target=request)
+            thread.start()
+            # the request does not see the dialog and waits on the unique index
+            thread.join(0.5)
+            self.assertTrue(thread.is_alive())
+            other.commit()
+            thread.join()
+        finally:
+            other.close()
+        self.assertEqual(responses[0].status_code, 409)
+        self.assertEqual(len(responses[0].data['data']), 1)
+        self.assertEqual(Chat.objects.filter(is_dialog=True).count(), 1)
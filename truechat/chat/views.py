@@ -1,26 +1,29 @@
-from django.db.models import Q, Max
-from django.db.models.functions import Coalesce
+from django.db import IntegrityError, transaction
+from django.db.models import prefetch_related_objects
 from rest_framework import permissions, status, viewsets
 from rest_framework.decorators import action, api_view, permission_classes
-from rest_framework.generics import RetrieveUpdateDestroyAPIView
+from rest_framework.generics import ListAPIView, RetrieveUpdateDestroyAPIView
 from rest_framework.response import Response
 from rest_framework.serializers import Serializer
 
 from attachments.views import ImageMixin
+from chat import events
+from chat.access import forget_access, get_access
 from chat.models import Chat, Message, Membership
-from chat.serializers import ChatSerializer, ChatSerializerChange, MessageSerializer, MessageSerializerChange
+from chat.pagination import MessageKeysetPagination, MessageRankPagination
+from chat.payloads import chat_payloads, forget_chats, message_payloads
+from chat.sync import ExpiredCursor, InvalidCursor, decode_cursor, encode_cursor, get_changes, head_cursor, \
+    serialize_changes
+from chat.search import search_messages
+from chat.serializers import ChatSerializer, ChatSerializerChange, MessageSearchSerializer, MessageSerializer, \
+    MessageSerializerBulk, MessageSerializerChange
 from custom_auth.models import User
+from truechat.replicas import ReplicaReadMixin
 
 
 class IsNotBanned(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        try:
-            membership = Membership.objects.get(user=request.user, chat=obj)
-            if membership.is_banned:
-                return False
-        except Membership.DoesNotExist:
-            pass
-        return True
+        return not get_access(request, obj).is_banned
 
 
 class IsChatGroup(permissions.BasePermission):
@@ -30,37 +33,27 @@ class IsChatGroup(permissions.BasePermission):
 
 class IsChatMember(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        try:
-            membership = Membership.objects.get(user=request.user, chat=obj)
-            if membership.is_banned:
-                return False
-        except Membership.DoesNotExist:
-            if obj.creator == request.user:
-                return True
-            return False
-
-        return obj.is_member(request.user)
+        return get_access(request, obj).can_access
 
 
 class IsChatAdmin(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        return request.user == obj.creator
+        return request.user.pk == obj.creator_id
 
 
 class IsMessageCreator(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        return request.user == obj.user
+        return request.user.pk == obj.user_id
 
 
 class IsMessageAvailable(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        print(request.method)
         if request.method == 'GET':
-            return IsChatMember.has_object_permission(obj.user, request, view, obj.chat)
-        return request.user == obj.user
+            return IsChatMember().has_object_permission(request, view, obj.chat)
+        return request.user.pk == obj.user_id
 
 
-class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
+class ChatViewSet(ReplicaReadMixin, viewsets.ModelViewSet, ImageMixin):
     """
     retrieve: Returns definite chat by its id with full information about its users
 
@@ -72,10 +65,16 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
     delete: Deletes definite chat by its id
     """
     queryset = Chat.objects.all()
+    replica_actions = ('list', 'messages', 'dialogs')
+    sync_default_limit = 100
+    sync_max_limit = 500
+    add_messages_max_count = 500
+    bulk_members_max_count = 500
 
     def get_serializer_class(self):
         if self.action in ['add_member', 'ban_member', 'unban_member', 'messages', 'create_private_chat',
-                           'get_private_chat', 'upload_image']:
+                           'get_private_chat', 'upload_image', 'sync', 'read', 'add_messages', 'add_members',
+                           'del_members', 'ban_members', 'unban_members', 'dialogs']:
             return Serializer
         if self.action in ['list', 'retrieve']:
             return ChatSerializer
@@ -85,12 +84,13 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
 
     def get_permissions(self):
         permissions_classes = [permissions.IsAuthenticated]
-        if self.action in ['retrieve', 'add_member', 'delete_member', 'add_message', 'messages']:
+        if self.action in ['retrieve', 'add_member', 'delete_member', 'add_message', 'messages', 'read',
+                           'add_members']:
             permissions_classes += [IsChatMember]
-        elif self.action not in ['list']:
+        elif self.action not in ['list', 'sync', 'add_messages', 'dialogs']:
             permissions_classes += [IsChatAdmin]
         if self.action not in ['retrieve', 'create_private_chat', 'list', 'messages', 'add_message', 'create',
-                               'get_private_chat']:
+                               'get_private_chat', 'sync', 'read', 'add_messages', 'dialogs']:
             permissions_classes += [IsChatGroup]
         return [permission() for permission in permissions_classes]
 
@@ -106,10 +106,24 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
         serializer = self.get_serializer_class()
         chat = serializer(data=request.data)
         if chat.is_valid():
-            chat.save(creator=request.user)
+            instance = chat.save(creator=request.user)
+            instance.users.add(request.user)
+            events.membership_changed(instance, request.user, 'membership.added')
             return Response(chat.data)
         return Response(chat.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def perform_update(self, serializer):
+        chat = serializer.save()
+        events.chat_updated(chat)
+
+    def perform_destroy(self, instance):
+        chat_id = instance.id
+        user_ids = set(instance.members.values_list('user_id', flat=True))
+        if instance.creator_id is not None:
+            user_ids.add(instance.creator_id)
+        instance.delete()
+        events.chat_deleted(chat_id, user_ids)
+
     def list(self, request, *args, **kwargs):
         """
         Returns chats related to user with full information about them
@@ -119,19 +133,25 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
         :param kwargs:
         :return:
         """
-        serializer = self.get_serializer_class()
-        membership = Membership.objects.filter(user=request.user, is_banned=False)
-        queryset = Chat.objects.filter(Q(members__in=membership) | Q(creator=request.user))\
-            .select_related('creator').prefetch_related('images', 'creator__images', 'messages')\
-            .annotate(date_last_change=Coalesce(Max('messages__date_created'), 'date_created'))\
-            .order_by('-date_last_change')
-
-        page = self.paginate_queryset(queryset)
-        if page is not None and request.GET.get('page') is not None:
-            chats = serializer(page, many=True)
-            return self.get_paginated_response(chats.data)
-        chats = serializer(queryset, many=True)
-        return Response(chats.data)
+        queryset = Chat.objects.available_to(request.user).order_by('-last_activity_at', '-id')
+
+        if request.GET.get('page') is not None:
+            page = self.paginate_queryset(queryset.only('id'))
+            if page is not None:
+                return self.get_paginated_response(chat_payloads([chat.id for chat in page], request.user))
+        return Response(chat_payloads(queryset.values_list('id', flat=True), request.user))
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Returns definite chat by its id with full information about its users
+
+        :param request:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        chat = self.get_object()
+        return Response(chat_payloads([chat.id], request.user)[0])
 
     @action(detail=True, methods=['post'], url_path='add_member/(?P<username>[^/.]+)', url_name='add_member')
     def add_member(self, request, username, pk=None):
@@ -150,19 +170,16 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
             return Response(status=status.HTTP_404_NOT_FOUND)
         except Chat.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        if chat.is_member(user):
+        access = get_access(request, chat, user)
+        if access.is_member:
             return Response(data={"errors": ["User is already in the chat"]}, status=status.HTTP_409_CONFLICT)
-        try:
-            membership = Membership.objects.get(user=user, chat=chat)
-            if membership.is_banned:
-                return Response(data={"errors": ["User is not in the chat. User is banned."]},
-                                status=status.HTTP_409_CONFLICT)
-        except Membership.DoesNotExist:
-            pass
+        if access.is_banned:
+            return Response(data={"errors": ["User is not in the chat. User is banned."]},
+                            status=status.HTTP_409_CONFLICT)
         if chat.is_dialog:
             return Response(data={"errors": ["Chat is a dialog"]}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
-        chat.users.add(user)
-        chat.save()
+        chat.users.add(user, through_defaults={'last_read_message_id': chat.last_message_id or 0})
+        events.membership_changed(chat, user, 'membership.added')
         return Response(ChatSerializer(chat).data)
 
     @action(detail=True, methods=['delete'], url_path='delete_member/(?P<username>[^/.]+)', url_name='del_member')
@@ -182,25 +199,22 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
             return Response(status=status.HTTP_404_NOT_FOUND)
         except Chat.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        if chat.creator != request.user:
+        if chat.creator_id != request.user.pk:
             return Response(status=status.HTTP_403_FORBIDDEN)
         if chat.is_dialog:
             return Response(data={"errors": ["Chat is a dialog"]}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
-        try:
-            membership = Membership.objects.get(user=user, chat=chat)
-            if membership.is_banned:
-                return Response(data={"errors": ["User is not in the chat. User is banned."]},
-                                status=status.HTTP_409_CONFLICT)
-        except Membership.DoesNotExist:
+        access = get_access(request, chat, user)
+        if not access.has_membership:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        if not chat.is_member(user):
-            return Response(data={"errors": ["User is not in the chat"]}, status=status.HTTP_409_CONFLICT)
-        if chat.creator == user:
+        if access.is_banned:
+            return Response(data={"errors": ["User is not in the chat. User is banned."]},
+                            status=status.HTTP_409_CONFLICT)
+        if access.is_creator:
             return Response(data={"errors": ["User is the owner of the chat. Chat may be deleted."]},
                             status=status.HTTP_409_CONFLICT)
 
         chat.users.remove(user)
-        chat.save()
+        events.membership_changed(chat, user, 'membership.removed')
         return Response(ChatSerializer(chat).data)
 
     @action(detail=True, methods=['put'], url_path='ban_member/(?P<username>[^/.]+)', url_name='ban_member')
@@ -220,18 +234,19 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
             return Response(status=status.HTTP_404_NOT_FOUND)
         except Chat.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        if chat.creator != request.user:
+        if chat.creator_id != request.user.pk:
             return Response(status=status.HTTP_403_FORBIDDEN)
         if chat.is_dialog:
             return Response(data={"errors": ["Chat is a dialog"]}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
-        if not chat.is_member(user):
+        access = get_access(request, chat, user)
+        if not access.is_member:
             return Response(data={"errors": ["User is not in the chat"]}, status=status.HTTP_409_CONFLICT)
-        if chat.creator == user:
+        if access.is_creator:
             return Response(data={"errors": ["User is the owner of the chat"]},
                             status=status.HTTP_409_CONFLICT)
-        membership = Membership.objects.get(user=user, chat=chat)
-        membership.is_banned = True
-        membership.save()
+        membership = Membership(pk=access.membership_id, user=user, chat=chat, is_banned=True)
+        membership.save(update_fields=['is_banned'])
+        events.membership_changed(chat, user, 'membership.banned')
         return Response(ChatSerializer(chat).data)
 
     @action(detail=True, methods=['put'], url_path='unban_member/(?P<username>[^/.]+)', url_name='unban_member')
@@ -251,20 +266,176 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
             return Response(status=status.HTTP_404_NOT_FOUND)
         except Chat.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        if chat.creator != request.user:
+        if chat.creator_id != request.user.pk:
             return Response(status=status.HTTP_403_FORBIDDEN)
         if chat.is_dialog:
             return Response(data={"errors": ["Chat is a dialog"]}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
-        if not chat.is_member(user):
+        access = get_access(request, chat, user)
+        if not access.is_member:
             return Response(data={"errors": ["User is not in the chat"]}, status=status.HTTP_409_CONFLICT)
-        if chat.creator == user:
+        if access.is_creator:
             return Response(data={"errors": ["User is the owner of the chat"]},
                             status=status.HTTP_409_CONFLICT)
-        membership = Membership.objects.get(user=user, chat=chat)
-        membership.is_banned = False
-        membership.save()
+        membership = Membership(pk=access.membership_id, user=user, chat=chat, is_banned=False)
+        membership.save(update_fields=['is_banned'])
+        events.membership_changed(chat, user, 'membership.unbanned')
         return Response(ChatSerializer(chat).data)
 
+    def get_bulk_members(self, request, chat):
+        """
+        Resolves `usernames` of the request to users and their memberships in chat with two queries
+
+        :param request:
+        :param chat:
+        :return: (usernames without duplicates, users by usernames, memberships by user ids)
+                 or error response
+        """
+        usernames = request.data.get('usernames') if isinstance(request.data, dict) else None
+        if not isinstance(usernames, list) or not usernames or not all(isinstance(name, str) for name in usernames):
+            return Response(data={"errors": ["usernames must be a non-empty list of strings"]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        usernames = list(dict.fromkeys(usernames))
+        if len(usernames) > self.bulk_members_max_count:
+            return Response(data={"errors": [f"At most {self.bulk_members_max_count} users may be changed at once"]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        users = {user.username: user for user in User.objects.filter(username__in=usernames).only('id', 'username')}
+        memberships = {membership.user_id: membership for membership in
+                       Membership.objects.filter(chat=chat, user__in=users.values()).only('id', 'user_id', 'is_banned')}
+        return usernames, users, memberships
+
+    @staticmethod
+    def bulk_members_response(chat, results):
+        return Response({'chat': chat.id, 'results': results})
+
+    @action(detail=True, methods=['post'], url_path='add_members')
+    def add_members(self, request, pk=None):
+        """
+        Adds users by list of `usernames` to a specified by id chat,
+        returns result for every username: added, already_member, banned or not_found
+
+        :param request:
+        :param pk:
+        :return:
+        """
+        chat = self.get_object()
+        resolved = self.get_bulk_members(request, chat)
+        if isinstance(resolved, Response):
+            return resolved
+        usernames, users, memberships = resolved
+        results, added = {}, []
+        for username in usernames:
+            user = users.get(username)
+            if user is None:
+                results[username] = 'not_found'
+            elif user.id in memberships:
+                results[username] = 'banned' if memberships[user.id].is_banned else 'already_member'
+            elif user.id == chat.creator_id:
+                results[username] = 'already_member'
+            else:
+                results[username] = 'added'
+                added.append(user)
+        if added:
+            with transaction.atomic():
+                Membership.objects.bulk_create([Membership(chat=chat, user=user,
+                                                           last_read_message_id=chat.last_message_id or 0)
+                                                for user in added], ignore_conflicts=True)
+                self.forget_members(chat, added)
+                events.memberships_changed(chat, added, 'membership.added')
+        return self.bulk_members_response(chat, results)
+
+    @action(detail=True, methods=['post'], url_path='delete_members', url_name='del_members')
+    def del_members(self, request, pk=None):
+        """
+        Deletes users by list of `usernames` from specified by id chat,
+        returns result for every username: removed, not_member, banned, owner or not_found
+
+        :param request:
+        :param pk:
+        :return:
+        """
+        chat = self.get_object()
+        resolved = self.get_bulk_members(request, chat)
+        if isinstance(resolved, Response):
+            return resolved
+        usernames, users, memberships = resolved
+        results, removed = {}, []
+        for username in usernames:
+            user = users.get(username)
+            if user is None:
+                results[username] = 'not_found'
+            elif user.id == chat.creator_id:
+                results[username] = 'owner'
+            elif user.id not in memberships:
+                results[username] = 'not_member'
+            elif memberships[user.id].is_banned:
+                results[username] = 'banned'
+            else:
+                results[username] = 'removed'
+                removed.append(user)
+        if removed:
+            with transaction.atomic():
+                Membership.objects.filter(pk__in=[memberships[user.id].id for user in removed]).delete()
+                self.forget_members(chat, removed)
+                events.memberships_changed(chat, removed, 'membership.removed')
+        return self.bulk_members_response(chat, results)
+
+    def set_members_banned(self, request, is_banned):
+        chat = self.get_object()
+        resolved = self.get_bulk_members(request, chat)
+        if isinstance(resolved, Response):
+            return resolved
+        usernames, users, memberships = resolved
+        results, changed = {}, []
+        for username in usernames:
+            user = users.get(username)
+            if user is None:
+                results[username] = 'not_found'
+            elif user.id == chat.creator_id:
+                results[username] = 'owner'
+            elif user.id not in memberships:
+                results[username] = 'not_member'
+            else:
+                results[username] = 'banned' if is_banned else 'unbanned'
+                if memberships[user.id].is_banned != is_banned:
+                    changed.append(user)
+        if changed:
+            with transaction.atomic():
+                Membership.objects.filter(pk__in=[memberships[user.id].id for user in changed])\
+                    .update(is_banned=is_banned)
+                self.forget_members(chat, changed)
+                events.memberships_changed(chat, changed, 'membership.banned' if is_banned else 'membership.unbanned')
+        return self.bulk_members_response(chat, results)
+
+    @action(detail=True, methods=['put'], url_path='ban_members')
+    def ban_members(self, request, pk=None):
+        """
+        Bans users by list of `usernames` in the specified by id chat,
+        returns result for every username: banned, not_member, owner or not_found
+
+        :param request:
+        :param pk:
+        :return:
+        """
+        return self.set_members_banned(request, True)
+
+    @action(detail=True, methods=['put'], url_path='unban_members')
+    def unban_members(self, request, pk=None):
+        """
+        Unbans users by list of `usernames` in the specified by id chat,
+        returns result for every username: unbanned, not_member, owner or not_found
+
+        :param request:
+        :param pk:
+        :return:
+        """
+        return self.set_members_banned(request, False)
+
+    @staticmethod
+    def forget_members(chat, users):
+        """Drops cached access and chat payload, bulk changes of memberships bypass model signals"""
+        forget_access(chat.id, [user.id for user in users])
+        forget_chats([chat.id])
+
     @action(detail=True, methods=['delete'])
     def delete_member(self, request, pk=None):
         """
@@ -283,16 +454,16 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
         if chat.is_dialog:
             return Response(data={"errors": ["Chat is a dialog"]}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
-        if chat.creator == request.user:
+        access = get_access(request, chat)
+        if access.is_creator:
             return Response(data={"errors": ["User is the owner of the chat. Chat may be deleted."]},
                             status=status.HTTP_409_CONFLICT)
-        membership = Membership.objects.get(user=request.user, chat=chat)
-        if membership.is_banned:
+        if access.is_banned:
             return Response(data={"errors": ["User is not in the chat. User is banned."]},
                             status=status.HTTP_409_CONFLICT)
 
         chat.users.remove(request.user)
-        chat.save()
+        events.membership_changed(chat, request.user, 'membership.removed')
         return Response(ChatSerializer(chat).data)
 
     @action(detail=True, methods=['post'], url_path='add_message')
@@ -315,13 +486,84 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
             content = valid_data.get('content')
             new_message = Message(content=content, user=request.user, chat=chat)
             new_message.save()
+            events.message_created(new_message)
             return Response(MessageSerializer(new_message).data)
         return Response(message.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['post'], url_path='add_messages')
+    def add_messages(self, request):
+        """
+        Adds a batch of `messages`, each with `chat` id and `content`, to chats of the user
+        in one transaction and returns them in the same order
+
+        :param request:
+        :return:
+        """
+        items = request.data.get('messages') if isinstance(request.data, dict) else None
+        if not isinstance(items, list) or not items:
+            return Response(data={"errors": ["messages must be a non-empty list"]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > self.add_messages_max_count:
+            return Response(data={"errors": [f"At most {self.add_messages_max_count} messages may be added at once"]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        serializer = MessageSerializerBulk(data=items, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        chat_ids = {item['chat'] for item in serializer.validated_data}
+        chats = Chat.objects.available_to(request.user).filter(pk__in=chat_ids).in_bulk()
+        unavailable = sorted(chat_ids - chats.keys())
+        if unavailable:
+            return Response(data={"errors": [f"User is not in the chats {', '.join(map(str, unavailable))}"]},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        with transaction.atomic():
+            messages = Message.objects.bulk_create([
+                Message(chat=chats[item['chat']], user=request.user, content=item['content'])
+                for item in serializer.validated_data
+            ])
+            Chat.objects.filter(pk__in=chat_ids).refresh_last_messages()
+            forget_chats(chat_ids)
+            prefetch_related_objects(messages, 'images', 'user__images')
+            data = MessageSerializer(messages, many=True).data
+            events.messages_created(messages, data)
+        return Response(data)
+
+    @action(detail=True, methods=['post'], url_path='read')
+    def read(self, request, pk=None):
+        """
+        Marks messages of specified by id chat as read up to `message_id` inclusive,
+        without `message_id` marks the whole chat as read
+
+        :param request:
+        :param pk:
+        :return:
+        """
+        chat = self.get_object()
+        try:
+            membership = Membership.objects.get(user=request.user, chat=chat)
+        except Membership.DoesNotExist:
+            return Response(data={"errors": ["User is not in the chat"]}, status=status.HTTP_409_CONFLICT)
+        if not isinstance(request.data, dict):
+            return Response(data={"errors": ["request body must be an object"]}, status=status.HTTP_400_BAD_REQUEST)
+        last_message_id = chat.last_message_id or 0
+        try:
+            message_id = min(int(request.data.get('message_id', last_message_id)), last_message_id)
+        except (TypeError, ValueError):
+            return Response(data={"errors": ["message_id must be an integer"]}, status=status.HTTP_400_BAD_REQUEST)
+        membership.mark_read(message_id)
+        return Response({
+            'chat': chat.id,
+            'last_read_message_id': membership.last_read_message_id,
+            'unread_count': Chat.objects.filter(pk=chat.pk).unread_counts(request.user).get(chat.id, 0),
+        })
+
     @action(detail=True, methods=['get'], url_path='messages')
     def messages(self, request, pk=None):
         """
-        Returns messages of specified by id chat
+        Returns messages of specified by id chat from the newest to the oldest.
+        Pages are selected by `limit` and one of `before`, `after` or `around` message ids,
+        `page` keeps the old page number pagination
 
         :param request:
         :param pk:
@@ -331,12 +573,15 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
             chat = self.get_object()
         except Chat.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        queryset = chat.messages.select_related('chat', 'user').prefetch_related('images', 'user__images')
-        page = self.paginate_queryset(queryset)
-        if page is not None and request.GET.get('page') is not None:
-            return self.get_paginated_response(MessageSerializer(page, many=True).data)
+        queryset = chat.messages.only('id', 'chat_id', 'user_id', 'date_created')
+        if request.GET.get('page') is not None:
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                return self.get_paginated_response(message_payloads(page))
 
-        return Response(MessageSerializer(queryset, many=True).data)
+        paginator = MessageKeysetPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        return paginator.get_paginated_response(message_payloads(page))
 
     @action(detail=False, methods=['post', 'get'], url_path='private_chats/(?P<username>[^/.]+)',
             url_name='create_private_chat')
@@ -353,10 +598,8 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
             user = User.objects.get(username=username)
         except User.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
-        us1 = username
-        us2 = request.user.username
-        chats = Chat.objects.filter(Q(name=f'{us1}-{us2}') | Q(name=f'{us2}-{us1}') & Q(is_dialog=True))
-        if chats.exists():
+        chats = list(Chat.objects.dialog_of(request.user, user))
+        if chats:
             if request.method == 'POST':
                 return Response(
                     data={"errors": ["Chat is already existed"], "data": ChatSerializer(chats, many=True).data},
@@ -364,13 +607,41 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
             elif request.method == 'GET':
                 return Response(ChatSerializer(chats, many=True).data)
         if request.method == 'POST':
-            chat = Chat.objects.create(name=f'{us1}-{us2}', creator=request.user, is_dialog=True)
-            chat.users.add(user)
-            chat.save()
+            low, high = Chat.dialog_pair(request.user, user)
+            try:
+                with transaction.atomic():
+                    chat = Chat.objects.create(name=f'{username}-{request.user.username}', creator=request.user,
+                                               is_dialog=True, dialog_user_low_id=low, dialog_user_high_id=high)
+                    chat.users.add(request.user, user)
+                    events.membership_changed(chat, request.user, 'membership.added')
+                    if user != request.user:
+                        events.membership_changed(chat, user, 'membership.added')
+            except IntegrityError:
+                # a concurrent request has created the dialog, the unique index made this one wait for it
+                chats = Chat.objects.dialog_of(request.user, user)
+                return Response(
+                    data={"errors": ["Chat is already existed"], "data": ChatSerializer(chats, many=True).data},
+                    status=status.HTTP_409_CONFLICT)
             return Response(ChatSerializer(chat).data)
         elif request.method == 'GET':
             return Response(status=status.HTTP_404_NOT_FOUND)
 
+    @action(detail=False, methods=['get'], url_path='private_chats', url_name='private_chats')
+    def dialogs(self, request):
+        """
+        Returns all private chats of user from the most recently active one
+
+        :param request:
+        :return:
+        """
+        queryset = Chat.objects.dialogs_of(request.user).order_by('-last_activity_at', '-id')
+
+        if request.GET.get('page') is not None:
+            page = self.paginate_queryset(queryset.only('id'))
+            if page is not None:
+                return self.get_paginated_response(chat_payloads([chat.id for chat in page], request.user))
+        return Response(chat_payloads(queryset.values_list('id', flat=True), request.user))
+
     @action(detail=True, methods=['post'], url_path='upload_image')
     def upload_image(self, request, pk=None):
         """
@@ -385,8 +656,40 @@ class ChatViewSet(viewsets.ModelViewSet, ImageMixin):
         except Chat.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
         self.post_cloudinary(request, chat)
+        events.chat_updated(chat)
         return Response(ChatSerializer(chat).data)
 
+    @action(detail=False, methods=['get'], url_path='sync')
+    def sync(self, request):
+        """
+        Returns changes of user's chats made after `cursor`: created, edited and deleted messages,
+        membership changes and chat updates. Without `cursor` returns only the current cursor,
+        which should be taken before fetching full state of chats, changes already in that state
+        may come again. Expired cursors get 410, their clients have to fetch full state again.
+
+        :param request:
+        :return:
+        """
+        cursor = request.GET.get('cursor')
+        if cursor is None:
+            return Response({'cursor': encode_cursor(head_cursor()), 'has_more': False, 'changes': []})
+        try:
+            cursor = decode_cursor(cursor)
+        except ExpiredCursor as e:
+            return Response(data={"errors": [str(e)]}, status=status.HTTP_410_GONE)
+        except InvalidCursor as e:
+            return Response(data={"errors": [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = max(1, min(int(request.GET.get('limit', self.sync_default_limit)), self.sync_max_limit))
+        except ValueError:
+            return Response(data={"errors": ["Limit must be an integer"]}, status=status.HTTP_400_BAD_REQUEST)
+        changes, has_more, next_cursor = get_changes(request.user, cursor, limit)
+        return Response({
+            'cursor': encode_cursor(next_cursor),
+            'has_more': has_more,
+            'changes': serialize_changes(changes, cursor.issued_at),
+        })
+
 
 class MessageAPIView(RetrieveUpdateDestroyAPIView, ImageMixin):
     """
@@ -400,9 +703,44 @@ class MessageAPIView(RetrieveUpdateDestroyAPIView, ImageMixin):
             return MessageSerializer
         return MessageSerializerChange
 
-    queryset = Message.objects.all()
+    queryset = Message.objects.select_related('chat')
     permission_classes = [permissions.IsAuthenticated, IsMessageAvailable]
 
+    def perform_update(self, serializer):
+        message = serializer.save()
+        events.message_updated(message)
+
+    def perform_destroy(self, instance):
+        chat_id, message_id = instance.chat_id, instance.id
+        instance.delete()
+        events.message_deleted(chat_id, message_id)
+
+
+class MessageSearchView(ListAPIView):
+    """
+    get: Returns messages of user's chats containing all words of `q` from the most relevant,
+    with rank and highlighted headline. `order=date` returns them from the newest to the oldest,
+    `chat` restricts search to a single chat, pages are selected by `limit` and `before`/`after` message ids
+    """
+    serializer_class = MessageSearchSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    @property
+    def pagination_class(self):
+        if self.request.GET.get('order') == 'date':
+            return MessageKeysetPagination
+        return MessageRankPagination
+
+    def get_queryset(self):
+        text = self.request.GET.get('q', '').strip()
+        if not text:
+            return Message.objects.none()
+        chat_id = self.request.GET.get('chat')
+        if chat_id is not None and not chat_id.isdigit():
+            return Message.objects.none()
+        return search_messages(self.request.user, text, chat_id)\
+            .select_related('chat', 'user').prefetch_related('images', 'user__images')
+
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated, IsMessageCreator])
@@ -421,4 +759,5 @@ def message_upload_image(request, pk=None):
     if request.user != message.user:
         return Response(status=status.HTTP_403_FORBIDDEN)
     ImageMixin.post_cloudinary(request, message)
+    events.message_updated(message)
     return Response(MessageSerializer(message).data)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CustomAuthConfig(AppConfig):
     name = 'custom_auth'
+
+    def ready(self):
+        # connects invalidation of cached tokens and revocation of signed tokens of deactivated users
+        from custom_auth import authentication, signed_tokens  # noqa: F401
@@ -0,0 +1,168 @@
+"""
+Token authentication with cached resolution of tokens to users
+
+Resolved tokens are kept in a bounded LRU in memory of the process for AUTH_TOKEN_CACHE_TIMEOUT seconds
+and, when AUTH_TOKEN_SHARED_CACHE_TIMEOUT is set, in the default cache shared by processes.
+Entries are dropped when the token is deleted (logout) or replaced and when its user is changed,
+e.g. deactivated. Other processes drop their in-memory entries only when they expire,
+so AUTH_TOKEN_CACHE_TIMEOUT bounds how long a revoked token may still be accepted by them.
+Invalid tokens and inactive users are never cached.
+
+Requests with unsafe methods always load the token and its user from the database,
+as their views may save the user, e.g. rest_auth's user details and password change,
+and a full save of a cached copy would write back its stale fields, such as is_active.
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.authtoken.models import Token
+
+from custom_auth.models import User
+
+
+class TokenCacheStats:
+    def __init__(self):
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class TokenCache:
+    """Bounded in-process LRU of pickled tokens with their users, entries expire after `timeout` seconds"""
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.stats = TokenCacheStats()
+        self._lock = threading.Lock()
+        # key -> (expires at, pickled token), the most recently used on the right
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, data):
+        if self.max_size <= 0 or self.timeout <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = TokenCache(settings.AUTH_TOKEN_CACHE_SIZE, settings.AUTH_TOKEN_CACHE_TIMEOUT)
+
+
+def shared_key(key):
+    return f'auth.token.{key}'
+
+
+def token_cache_stats():
+    """Counters of token resolutions by this process and the number of tokens held in its memory"""
+    return dict(token_cache.stats.as_dict(), size=len(token_cache))
+
+
+def forget_tokens(keys):
+    """
+    Drops cached resolution of tokens in this process and in the shared cache,
+    also after the current transaction commits, so that concurrent requests do not cache the state being changed
+
+    :param keys: token keys
+    :return:
+    """
+    keys = list(keys)
+    if not keys:
+        return
+    token_cache.stats.invalidations += len(keys)
+
+    def delete():
+        token_cache.delete_many(keys)
+        if settings.AUTH_TOKEN_SHARED_CACHE_TIMEOUT:
+            cache.delete_many([shared_key(key) for key in keys])
+
+    delete()
+    transaction.on_commit(delete)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Same as TokenAuthentication, resolves tokens from the cache when possible.
+    Every request gets its own copy of the user, so that views may change it,
+    requests with unsafe methods get the user loaded from the database
+    """
+    use_cache = True
+
+    def authenticate(self, request):
+        self.use_cache = request.method in SAFE_METHODS
+        return super(CachedTokenAuthentication, self).authenticate(request)
+
+    def authenticate_credentials(self, key):
+        stats = token_cache.stats
+        data = token_cache.get(key) if self.use_cache else None
+        if data is not None:
+            stats.local_hits += 1
+        elif self.use_cache and settings.AUTH_TOKEN_SHARED_CACHE_TIMEOUT:
+            data = cache.get(shared_key(key))
+            if data is not None:
+                stats.shared_hits += 1
+                token_cache.set(key, data)
+        if data is not None:
+            token = pickle.loads(data)
+            return token.user, token
+
+        stats.misses += 1
+        user, token = super(CachedTokenAuthentication, self).authenticate_credentials(key)
+        data = pickle.dumps(token, pickle.HIGHEST_PROTOCOL)
+        token_cache.set(key, data)
+        if settings.AUTH_TOKEN_SHARED_CACHE_TIMEOUT:
+            cache.set(shared_key(key), data, settings.AUTH_TOKEN_SHARED_CACHE_TIMEOUT)
+        return user, token
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    forget_tokens([instance.key])
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, **kwargs):
+    # deactivated users must be rejected, other changes must not be served from stale copies.
+    # Deletion of users deletes their tokens, which drops them by token_changed
+    if not created:
+        forget_tokens(Token.objects.filter(user_id=instance.pk).values_list('key', flat=True))
+
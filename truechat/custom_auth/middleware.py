@@ -0,0 +1,73 @@
+from urllib.parse import parse_qs
+
+from channels.auth import UserLazyObject
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework.exceptions import AuthenticationFailed
+
+from custom_auth.authentication import CachedTokenAuthentication
+from custom_auth.models import User
+from custom_auth.signed_tokens import verify_access_token
+
+
+@database_sync_to_async
+def get_token_user(key):
+    try:
+        user, token = CachedTokenAuthentication().authenticate_credentials(key)
+    except AuthenticationFailed:
+        return AnonymousUser()
+    return user
+
+
+@database_sync_to_async
+def get_signed_token_user(token):
+    try:
+        claims = verify_access_token(token)
+    except AuthenticationFailed:
+        return AnonymousUser()
+    # connections live long, so the whole user is loaded once instead of being built from the claims
+    return User.objects.filter(pk=claims['sub'], is_active=True).first() or AnonymousUser()
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    """
+    Populates scope['user'] of websocket connections from the rest_auth token or the signed access token
+
+    Browsers can not set headers of websocket handshakes, so the token may be passed
+    either as `Authorization: Token <key>` or `Authorization: Bearer <access token>` header
+    or as `?token=<key or access token>` query parameter.
+    """
+
+    def populate_scope(self, scope):
+        if 'user' not in scope:
+            scope['user'] = UserLazyObject()
+
+    async def resolve_scope(self, scope):
+        keyword, key = self.get_credentials(scope)
+        if not key:
+            user = AnonymousUser()
+        elif keyword == 'Bearer':
+            user = await get_signed_token_user(key)
+        else:
+            user = await get_token_user(key)
+        scope['user']._wrapped = user
+
+    @staticmethod
+    def get_credentials(scope):
+        """
+        Finds the token of the connection
+
+        :param scope:
+        :return: tuple of the keyword, 'Token' or 'Bearer', and the token or None
+        """
+        for name, value in scope.get('headers', []):
+            if name == b'authorization':
+                keyword, _, key = value.decode().partition(' ')
+                if keyword in ('Token', 'Bearer') and key:
+                    return keyword, key
+        keys = parse_qs(scope.get('query_string', b'').decode()).get('token')
+        if not keys:
+            return None, None
+        # rest_auth tokens are hex strings, signed tokens consist of dot separated parts
+        return 'Bearer' if '.' in keys[0] else 'Token', keys[0]
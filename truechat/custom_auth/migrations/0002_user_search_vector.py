@@ -0,0 +1,59 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:13
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+SEARCH_VECTOR = """
+    setweight(to_tsvector('simple', coalesce({row}username, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce({row}first_name, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce({row}last_name, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce({row}email, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce({row}about, '')), 'C')
+"""
+
+CREATE_TRIGGER = f"""
+CREATE FUNCTION user_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := {SEARCH_VECTOR.format(row='NEW.')};
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER user_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF username, first_name, last_name, email, about ON "User"
+    FOR EACH ROW EXECUTE PROCEDURE user_search_vector_update();
+
+UPDATE "User" SET search_vector = {SEARCH_VECTOR.format(row='')};
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER user_search_vector_trigger ON "User";
+DROP FUNCTION user_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_auth', '0001_initial'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='user',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='user_search_vector_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['username'], name='user_username_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.5 on 2026-10-18 19:43
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_auth', '0002_user_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('access', 'Токен доступа'), ('refresh', 'Токен обновления'), ('user', 'Все токены пользователя')], max_length=15, verbose_name='Вид')),
+                ('jti', models.CharField(blank=True, max_length=64, null=True, unique=True, verbose_name='Идентификатор токена')),
+                ('revoked_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата отзыва')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Дата истечения')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Отозванный токен',
+                'verbose_name_plural': 'Отозванные токены',
+                'db_table': 'revoked_tokens',
+            },
+        ),
+    ]
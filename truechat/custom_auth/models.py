@@ -1,6 +1,9 @@
 from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
+from django.utils import timezone
 
 from attachments.models import Image
 
@@ -8,8 +11,41 @@ from attachments.models import Image
 class User(AbstractUser):
     about = models.CharField('О себе', max_length=1023, null=True, blank=True)
     images = GenericRelation(Image)
+    # maintained by the user_search_vector_trigger database trigger
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         db_table = 'User'
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        indexes = [
+            GinIndex(fields=['search_vector'], name='user_search_vector_idx'),
+            GinIndex(fields=['username'], name='user_username_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
+
+
+class RevokedToken(models.Model):
+    """
+    Revoked signed tokens: a single token by its jti or all tokens of user issued until `revoked_at`.
+    Entries are not needed after `expires_at`, when all tokens they cover have expired
+    """
+    ACCESS = 'access'
+    REFRESH = 'refresh'
+    USER = 'user'
+    KINDS = (
+        (ACCESS, 'Токен доступа'),
+        (REFRESH, 'Токен обновления'),
+        (USER, 'Все токены пользователя'),
+    )
+
+    kind = models.CharField('Вид', max_length=15, choices=KINDS)
+    jti = models.CharField('Идентификатор токена', max_length=64, unique=True, null=True, blank=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name='Пользователь',
+                             related_name='+', null=True, blank=True)
+    revoked_at = models.DateTimeField('Дата отзыва', default=timezone.now)
+    expires_at = models.DateTimeField('Дата истечения', db_index=True)
+
+    class Meta:
+        db_table = 'revoked_tokens'
+        verbose_name = 'Отозванный токен'
+        verbose_name_plural = 'Отозванные токены'
@@ -13,7 +13,7 @@ class UserSerializerChange(serializers.ModelSerializer):
 
 
 class UserSerializerGet(serializers.ModelSerializer):
-    images = ImageFieldSerializer(many=True)
+    images = ImageFieldSerializer(many=True, size='avatar')
 
     class Meta:
         model = User
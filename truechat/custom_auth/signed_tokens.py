@@ -0,0 +1,240 @@
+"""
+Signed access and refresh tokens
+
+Access tokens live for JWT_ACCESS_TOKEN_LIFETIME seconds and are verified by their signature only:
+the user is built from the claims and its other fields are loaded from the database on first access.
+Refresh tokens live for JWT_REFRESH_TOKEN_LIFETIME seconds, are checked against the database
+and are replaced by a new pair on every use.
+
+Tokens are signed with the key JWT_SIGNING_KEY_ID of JWT_SIGNING_KEYS, its id is put into the `kid` header,
+so keys are rotated by adding a new key, signing with it and removing the old one once its tokens expire.
+
+Revoked access tokens and users whose all tokens are revoked are kept in memory of every process,
+the list is reloaded from RevokedToken every JWT_REVOCATION_REFRESH_INTERVAL seconds. It stays small
+as entries are needed only until the tokens they cover expire.
+"""
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import jwt
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.permissions import SAFE_METHODS
+
+from custom_auth.models import RevokedToken, User
+
+ACCESS = 'access'
+REFRESH = 'refresh'
+
+
+class InvalidToken(exceptions.AuthenticationFailed):
+    pass
+
+
+def _encode(claims, lifetime):
+    now = time.time()
+    claims = dict(claims, jti=uuid.uuid4().hex, iat=now, exp=int(now + lifetime))
+    key_id = settings.JWT_SIGNING_KEY_ID
+    token = jwt.encode(claims, settings.JWT_SIGNING_KEYS[key_id], algorithm=settings.JWT_ALGORITHM,
+                       headers={'kid': key_id})
+    return token.decode(), claims
+
+
+def issue_tokens(user):
+    """
+    Issues a new pair of access and refresh tokens for user
+
+    :param user:
+    :return: dict of the tokens and the lifetime of the access token
+    """
+    access, _ = _encode({'type': ACCESS, 'sub': user.pk, 'name': user.username}, settings.JWT_ACCESS_TOKEN_LIFETIME)
+    refresh, _ = _encode({'type': REFRESH, 'sub': user.pk}, settings.JWT_REFRESH_TOKEN_LIFETIME)
+    return {'access': access, 'refresh': refresh, 'expires_in': settings.JWT_ACCESS_TOKEN_LIFETIME}
+
+
+def decode_token(token, token_type):
+    """
+    Verifies signature, expiration and type of token
+
+    :param token:
+    :param token_type: ACCESS or REFRESH
+    :return: claims
+    """
+    try:
+        key = settings.JWT_SIGNING_KEYS[jwt.get_unverified_header(token).get('kid')]
+        claims = jwt.decode(token, key, algorithms=[settings.JWT_ALGORITHM],
+                            options={'require_exp': True, 'require_iat': True})
+    except (jwt.InvalidTokenError, KeyError):
+        raise InvalidToken('Invalid token.')
+    if claims.get('type') != token_type or not isinstance(claims.get('sub'), int) or 'jti' not in claims:
+        raise InvalidToken('Invalid token.')
+    return claims
+
+
+class RevocationList:
+    """In-memory copy of revoked access tokens and users, reloaded when it is older than `refresh_interval`"""
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._jtis = frozenset()
+        # user id -> timestamp until which all tokens of the user are revoked
+        self._users = {}
+
+    def reload(self):
+        entries = RevokedToken.objects.filter(Q(kind=RevokedToken.ACCESS) | Q(kind=RevokedToken.USER),
+                                              expires_at__gt=timezone.now())
+        jtis, users = set(), {}
+        for kind, jti, user_id, revoked_at in entries.values_list('kind', 'jti', 'user_id', 'revoked_at'):
+            if kind == RevokedToken.ACCESS:
+                jtis.add(jti)
+            else:
+                users[user_id] = max(users.get(user_id, 0), revoked_at.timestamp())
+        self._jtis, self._users = frozenset(jtis), users
+        self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+            with self._lock:
+                if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+                    self.reload()
+
+    def is_revoked(self, claims):
+        self._ensure_loaded()
+        return claims['jti'] in self._jtis or claims['iat'] <= self._users.get(claims['sub'], 0)
+
+    def add_token(self, jti):
+        self._jtis = self._jtis | {jti}
+
+    def add_user(self, user_id, revoked_at):
+        users = dict(self._users)
+        users[user_id] = max(users.get(user_id, 0), revoked_at)
+        self._users = users
+
+    def clear(self):
+        with self._lock:
+            self._loaded_at = None
+
+
+revocation_list = RevocationList(settings.JWT_REVOCATION_REFRESH_INTERVAL)
+
+
+def _expires_at(claims):
+    return datetime.fromtimestamp(claims['exp'], timezone.utc)
+
+
+def purge_expired():
+    RevokedToken.objects.filter(expires_at__lte=timezone.now()).delete()
+
+
+def revoke_token(claims):
+    """
+    Revokes a single token by its claims
+
+    :param claims: decoded claims of an access or a refresh token
+    :return:
+    """
+    kind = RevokedToken.ACCESS if claims['type'] == ACCESS else RevokedToken.REFRESH
+    purge_expired()
+    RevokedToken.objects.bulk_create([RevokedToken(kind=kind, jti=claims['jti'], user_id=claims['sub'],
+                                                   expires_at=_expires_at(claims))], ignore_conflicts=True)
+    if kind == RevokedToken.ACCESS:
+        revocation_list.add_token(claims['jti'])
+
+
+def revoke_user_tokens(user_id):
+    """
+    Revokes all tokens issued to user so far
+
+    :param user_id:
+    :return:
+    """
+    purge_expired()
+    now = timezone.now()
+    entry = RevokedToken.objects.create(kind=RevokedToken.USER, user_id=user_id, revoked_at=now,
+                                        expires_at=now + timedelta(seconds=settings.JWT_REFRESH_TOKEN_LIFETIME))
+    revocation_list.add_user(user_id, entry.revoked_at.timestamp())
+
+
+def refresh_tokens(token):
+    """
+    Exchanges a refresh token for a new pair of tokens, the refresh token can not be used again
+
+    :param token: refresh token
+    :return: dict of the tokens and the lifetime of the access token
+    """
+    claims = decode_token(token, REFRESH)
+    issued_at = datetime.fromtimestamp(claims['iat'], timezone.utc)
+    user = User.objects.filter(pk=claims['sub'], is_active=True).first()
+    if user is None or RevokedToken.objects.filter(kind=RevokedToken.USER, user_id=user.pk,
+                                                   revoked_at__gte=issued_at).exists():
+        raise InvalidToken('Invalid token.')
+    purge_expired()
+    try:
+        # the unique jti lets only one of concurrent requests use the token
+        with transaction.atomic():
+            RevokedToken.objects.create(kind=RevokedToken.REFRESH, jti=claims['jti'], user_id=user.pk,
+                                        expires_at=_expires_at(claims))
+    except IntegrityError:
+        raise InvalidToken('Invalid token.')
+    return issue_tokens(user)
+
+
+def verify_access_token(token):
+    """
+    Verifies access token and checks that it is not revoked
+
+    :param token: access token
+    :return: claims
+    """
+    claims = decode_token(token, ACCESS)
+    if revocation_list.is_revoked(claims):
+        raise InvalidToken('Token has been revoked.')
+    return claims
+
+
+class SignedTokenAuthentication(BaseAuthentication):
+    """
+    Authenticates by `Authorization: Bearer <access token>` without queries,
+    request.user has only id and username loaded, other fields are loaded on access.
+    Requests with unsafe methods get the user loaded from the database
+    """
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise InvalidToken('Invalid token header.')
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            raise InvalidToken('Invalid token header.')
+        claims = verify_access_token(token)
+        if request.method not in SAFE_METHODS:
+            # views of writes may save the user, a full save of the partial user would write back its claims
+            user = User.objects.filter(pk=claims['sub'], is_active=True).first()
+            if user is None:
+                raise InvalidToken('User inactive or deleted.')
+            return user, claims
+        user = User.from_db('default', ['id', 'username', 'is_active'], [claims['sub'], claims.get('name'), True])
+        return user, claims
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, update_fields=None, **kwargs):
+    if not created and not instance.is_active and (update_fields is None or 'is_active' in update_fields):
+        revoke_user_tokens(instance.pk)
@@ -1,3 +1,212 @@
-from django.test import TestCase
+from allauth.account.models import EmailAddress
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
 
-# Create your tests here.
+from custom_auth.authentication import token_cache
+from custom_auth.models import User
+from custom_auth.signed_tokens import issue_tokens, revocation_list
+
+
+class ProfileSearchTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='searcher', email='searcher@truechat.com', password='password')
+        self.client.force_authenticate(self.user)
+
+    def search(self, search_string, **params):
+        response = self.client.get(f'/profiles/{search_string}', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_prefix_of_any_field_matches(self):
+        User.objects.create_user(username='alexander', email='alex@truechat.com', password='password',
+                                 first_name='Alexander', last_name='Pushkin')
+        User.objects.create_user(username='leo', email='leo@truechat.com', password='password',
+                                 first_name='Leo', last_name='Tolstoy')
+        self.assertEqual([user['username'] for user in self.search('push')['results']], ['alexander'])
+        self.assertEqual([user['username'] for user in self.search('tol')['results']], ['leo'])
+
+    def test_vector_follows_updates(self):
+        user = User.objects.create_user(username='leo', email='leo@truechat.com', password='password')
+        self.assertEqual(self.search('tolstoy')['count'], 0)
+        User.objects.filter(pk=user.pk).update(last_name='Tolstoy')
+        self.assertEqual(self.search('tolstoy')['count'], 1)
+
+    def test_misspelt_username_is_found(self):
+        User.objects.create_user(username='dostoevsky', email='fedor@truechat.com', password='password')
+        self.assertEqual([user['username'] for user in self.search('dostoevski')['results']], ['dostoevsky'])
+
+    def test_exact_username_is_ranked_first(self):
+        User.objects.create_user(username='annabel', email='annabel@truechat.com', password='password')
+        User.objects.create_user(username='anna', email='anna@truechat.com', password='password')
+        self.assertEqual(self.search('anna')['results'][0]['username'], 'anna')
+
+    def test_results_are_paginated(self):
+        User.objects.bulk_create([User(username=f'reader{i}', email=f'reader{i}@truechat.com') for i in range(25)])
+        data = self.search('reader')
+        self.assertEqual(data['count'], 25)
+        self.assertEqual(len(data['results']), 10)
+        self.assertIsNotNone(data['next'])
+
+    def test_empty_search_string(self):
+        with CaptureQueriesContext(connection) as context:
+            data = self.search('')
+        self.assertEqual(data['results'], [])
+        self.assertEqual(len(context), 0)
+
+
+class TokenCacheTest(APITestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password',
+                                             first_name='Fedor')
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def get_profile(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/rest-auth/user/')
+        return response, [query['sql'] for query in context if 'FROM "authtoken_token"' in query['sql']]
+
+    def test_token_is_resolved_once(self):
+        self.assertEqual(len(self.get_profile()[1]), 1)
+        response, queries = self.get_profile()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, [])
+
+    def test_logout_drops_token(self):
+        self.get_profile()
+        self.assertEqual(self.client.post('/rest-auth/logout/').status_code, 200)
+        self.assertEqual(self.get_profile()[0].status_code, 401)
+
+    def test_deactivation_drops_token(self):
+        self.get_profile()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get_profile()[0].status_code, 401)
+
+    def test_writes_do_not_save_stale_copies(self):
+        self.get_profile()
+        # changes by queryset updates send no signals, so the cached copy is left stale
+        User.objects.filter(pk=self.user.pk).update(first_name='Lev')
+        response = self.client.patch('/rest-auth/user/', {'last_name': 'Tolstoy'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.last_name), ('Lev', 'Tolstoy'))
+
+    def test_writes_reject_users_deactivated_meanwhile(self):
+        self.get_profile()
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        response = self.client.post('/rest-auth/password/change/',
+                                    {'new_password1': 'n3w-passw0rd', 'new_password2': 'n3w-passw0rd'}, format='json')
+        self.assertEqual(response.status_code, 401)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertTrue(self.user.check_password('password'))
+
+
+class SignedTokenTest(APITestCase):
+    def setUp(self):
+        revocation_list.clear()
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password',
+                                             first_name='Fedor')
+        EmailAddress.objects.create(user=self.user, email=self.user.email, verified=True, primary=True)
+
+    def obtain(self):
+        response = self.client.post('/auth/token/', {'username': 'owner', 'password': 'password'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def authorize(self, access):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def get_profile(self, access):
+        self.authorize(access)
+        return self.client.get('/rest-auth/user/')
+
+    def refresh(self, refresh):
+        return self.client.post('/auth/token/refresh/', {'refresh': refresh}, format='json')
+
+    def revoke(self, access, data=None):
+        self.authorize(access)
+        return self.client.post('/auth/token/revoke/', data or {}, format='json')
+
+    def test_access_token_is_verified_without_queries(self):
+        access = self.obtain()['access']
+        self.assertEqual(self.get_profile(access).data['username'], 'owner')
+        # the revocation list is loaded by the first request
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/auth/token/revoke/')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(len(context), 0)
+
+    def test_invalid_access_tokens_are_rejected(self):
+        tokens = self.obtain()
+        self.assertEqual(self.get_profile(tokens['access'][:-1]).status_code, 401)
+        self.assertEqual(self.get_profile(tokens['refresh']).status_code, 401)
+        with override_settings(JWT_ACCESS_TOKEN_LIFETIME=-1):
+            expired = issue_tokens(self.user)['access']
+        self.assertEqual(self.get_profile(expired).status_code, 401)
+        with override_settings(JWT_SIGNING_KEYS={'retired': 'secret'}, JWT_SIGNING_KEY_ID='retired'):
+            unknown = issue_tokens(self.user)['access']
+        self.assertEqual(self.get_profile(unknown).status_code, 401)
+
+    def test_refresh_token_is_used_once(self):
+        tokens = self.obtain()
+        response = self.refresh(tokens['refresh'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_profile(response.data['access']).status_code, 200)
+        self.assertEqual(self.refresh(tokens['refresh']).status_code, 401)
+        self.assertEqual(self.refresh(response.data['access']).status_code, 401)
+
+    def test_refresh_requires_token(self):
+        self.assertEqual(self.refresh(None).status_code, 400)
+        response = self.client.post('/auth/token/refresh/', [self.obtain()['refresh']], format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_revoke_access_and_refresh_tokens(self):
+        tokens = self.obtain()
+        self.assertEqual(self.revoke(tokens['access'], {'refresh': tokens['refresh']}).status_code, 204)
+        self.assertEqual(self.get_profile(tokens['access']).status_code, 401)
+        self.assertEqual(self.refresh(tokens['refresh']).status_code, 401)
+
+    def test_revoke_all_tokens(self):
+        first, second = self.obtain(), self.obtain()
+        self.assertEqual(self.revoke(first['access'], {'all': True}).status_code, 204)
+        self.assertEqual(self.get_profile(second['access']).status_code, 401)
+        self.assertEqual(self.refresh(second['refresh']).status_code, 401)
+        # the list is reloaded by other processes
+        revocation_list.clear()
+        self.assertEqual(self.get_profile(second['access']).status_code, 401)
+        self.assertEqual(self.get_profile(self.obtain()['access']).status_code, 200)
+
+    def test_revoke_rejects_foreign_and_malformed_requests(self):
+        tokens = self.obtain()
+        other = User.objects.create_user(username='other', email='other@truechat.com', password='password')
+        self.assertEqual(self.revoke(tokens['access'], {'refresh': issue_tokens(other)['refresh']}).status_code, 400)
+        self.authorize(tokens['access'])
+        response = self.client.post('/auth/token/revoke/', [tokens['refresh']], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_profile(tokens['access']).status_code, 200)
+
+    def test_deactivation_revokes_tokens(self):
+        tokens = self.obtain()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get_profile(tokens['access']).status_code, 401)
+        self.assertEqual(self.refresh(tokens['refresh']).status_code, 401)
+
+    def test_writes_do_not_save_partial_users(self):
+        access = self.obtain()['access']
+        User.objects.filter(pk=self.user.pk).update(first_name='Lev', username='lev')
+        self.authorize(access)
+        response = self.client.patch('/rest-auth/user/', {'last_name': 'Tolstoy'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.username, self.user.first_name, self.user.last_name), ('lev', 'Lev', 'Tolstoy'))
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.patch('/rest-auth/user/', {'last_name': 'T'}, format='json').status_code, 401)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
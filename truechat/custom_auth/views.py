@@ -1,14 +1,23 @@
+import re
+
 from allauth.account.models import EmailConfirmationHMAC
-from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import F, Q
 from django.http import HttpResponseRedirect
+from rest_auth.serializers import LoginSerializer
 from rest_framework import permissions, status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from attachments.views import ImageMixin
+from chat.payloads import user_payloads
 from custom_auth.models import User
 from custom_auth.serializers import UserSerializerChange, UserSerializerGet
+from custom_auth.signed_tokens import REFRESH, InvalidToken, decode_token, issue_tokens, refresh_tokens, \
+    revoke_token, revoke_user_tokens
+from truechat.replicas import ReplicaReadMixin
 
 
 class UserIsOwnerOrReadOnly(permissions.BasePermission):
@@ -18,10 +27,11 @@ class UserIsOwnerOrReadOnly(permissions.BasePermission):
         return obj.id == request.user.id
 
 
-class UserAPIViewChange(APIView):
+class UserAPIViewChange(ReplicaReadMixin, APIView):
     permission_classes = (
         permissions.IsAuthenticated,
     )
+    replica_actions = ('get',)
 
     def get_object(self):
         return self.request.user
@@ -37,6 +47,8 @@ class UserAPIViewChange(APIView):
         user = self.get_object()
         if username and user.username != username:
             return Response(status=status.HTTP_403_FORBIDDEN)
+        # request.user may come from the token cache, all its fields are saved back
+        user = User.objects.get(pk=user.pk)
         serializer = UserSerializerChange(user, data=request.data)
         if serializer.is_valid():
             serializer.save()
@@ -57,36 +69,34 @@ class UserAPIViewChange(APIView):
                 user = User.objects.get(username=username)
             except User.DoesNotExist:
                 return Response(status=status.HTTP_404_NOT_FOUND)
-        serializer = UserSerializerGet(user)
-        return Response(serializer.data)
+        return Response(user_payloads([user])[user.pk])
 
 
-class UserListView(APIView):
+class UserListView(ReplicaReadMixin, ListAPIView):
+    """
+    get: Returns profiles matching searching string, paginated by `page`
+    """
     permission_classes = (
         permissions.IsAuthenticated,
     )
+    replica_actions = ('get',)
+    serializer_class = UserSerializerGet
 
-    def get(self, request, search_string=None):
+    def get_queryset(self):
         """
-        Returns profiles which contain searching string
+        Searches profiles by prefixes of words in the stored search vector
+        and by trigram similarity of username for autocomplete
 
-        :param request:
-        :param search_string:
         :return:
         """
-        query = SearchQuery(search_string)
-
-        username_vector = SearchVector('username', weight='A')
-        first_name_vector = SearchVector('first_name', weight='B')
-        last_name_vector = SearchVector('last_name', weight='B')
-        email_vector = SearchVector('email', weight='B')
-        about_vector = SearchVector('about', weight='C')
-        vectors = username_vector + first_name_vector + last_name_vector + email_vector + about_vector
-        qs = User.objects
-        qs = qs.annotate(search=vectors).filter(search=query)
-        qs = qs.annotate(rank=SearchRank(vectors, query)).order_by('-rank')
-        print(qs)
-        return Response(UserSerializerGet(qs, many=True).data)
+        search_string = self.kwargs.get('search_string') or ''
+        words = re.findall(r'\w+', search_string)
+        if not words:
+            return User.objects.none()
+        query = SearchQuery(' & '.join(f"'{word}':*" for word in words), config='simple', search_type='raw')
+        rank = SearchRank(F('search_vector'), query) + TrigramSimilarity('username', search_string)
+        return User.objects.filter(Q(search_vector=query) | Q(username__trigram_similar=search_string))\
+            .annotate(rank=rank).order_by('-rank', 'id').prefetch_related('images')
 
 
 def confirm_email(request, key):
@@ -108,3 +118,68 @@ def user_upload_image(request):
     user = request.user
     ImageMixin.post_cloudinary(request, user)
     return Response(UserSerializerGet(user).data)
+
+
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([permissions.AllowAny])
+def obtain_tokens(request):
+    """
+    Returns signed `access` and `refresh` tokens for `username` or `email` and `password`,
+    the access token is sent as `Authorization: Bearer <access>`
+
+    :param request:
+    :return:
+    """
+    serializer = LoginSerializer(data=request.data, context={'request': request})
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    return Response(issue_tokens(serializer.validated_data['user']))
+
+
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([permissions.AllowAny])
+def refresh_token(request):
+    """
+    Exchanges `refresh` token for a new pair of tokens, the refresh token can be used only once
+
+    :param request:
+    :return:
+    """
+    token = request.data.get('refresh') if isinstance(request.data, dict) else None
+    if not isinstance(token, str):
+        return Response(data={"errors": ["refresh token is required"]}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        return Response(refresh_tokens(token))
+    except InvalidToken as e:
+        return Response(data={"errors": [e.detail]}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def revoke_tokens(request):
+    """
+    Revokes the signed access token of the request and `refresh` token if given,
+    with `all` set revokes all signed tokens issued to user
+
+    :param request:
+    :return:
+    """
+    if not isinstance(request.data, dict):
+        return Response(data={"errors": ["request body must be an object"]}, status=status.HTTP_400_BAD_REQUEST)
+    if request.data.get('all'):
+        revoke_user_tokens(request.user.pk)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    token = request.data.get('refresh')
+    if token is not None:
+        try:
+            claims = decode_token(token, REFRESH) if isinstance(token, str) else None
+        except InvalidToken:
+            claims = None
+        if claims is None or claims['sub'] != request.user.pk:
+            return Response(data={"errors": ["refresh token is invalid"]}, status=status.HTTP_400_BAD_REQUEST)
+        revoke_token(claims)
+    if isinstance(request.auth, dict):
+        revoke_token(request.auth)
+    return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,12 @@
+import os
+
+import django
+from channels.routing import get_default_application
+
+from truechat.warmup import warm_up
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'truechat.settings')
+django.setup()
+
+application = get_default_application()
+warm_up()
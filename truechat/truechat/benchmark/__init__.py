@@ -0,0 +1,7 @@
+"""
+Benchmarks of the chat API
+
+`manage.py seed_data` fills the database with synthetic users, chats, memberships, messages and images,
+`manage.py benchmark` runs scenarios against the API in process and saves latency percentiles,
+throughput and query counts per endpoint, so that results of different commits can be compared.
+"""
@@ -0,0 +1,222 @@
+"""
+Synthetic data for benchmarks
+
+All generated users have usernames starting with PREFIX and all generated chats are created by them,
+so generated data can be removed without touching real one. Generation is deterministic for a seed,
+sizes of chats and rates of messages in them follow configurable distributions.
+"""
+import os
+import random
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import timezone
+
+from attachments.models import Image
+from chat.models import Chat, Membership, Message
+from custom_auth.models import User
+from truechat.benchmark import loaders
+
+PREFIX = 'bench_'
+PASSWORD = 'benchmark'
+WORDS = ('hello', 'world', 'meeting', 'tomorrow', 'lunch', 'release', 'deploy', 'review', 'ticket', 'coffee',
+         'weekend', 'photo', 'call', 'later', 'thanks', 'question', 'answer', 'database', 'chat', 'message')
+CHAT_SIZES = ('exponential', 'uniform', 'zipf')
+MESSAGE_RATES = ('uniform', 'size', 'zipf')
+ZIPF_ALPHA = 1.5
+# contents of messages are drawn from a pool, generating every one of millions of them takes longer than writing
+SENTENCES = 10000
+
+
+@transaction.atomic
+def clear():
+    """Deletes generated users and their chats, memberships are deleted by cascade"""
+    users = User.objects.filter(username__startswith=PREFIX)
+    chats = Chat.objects.filter(creator__in=users)
+    Image.objects.filter(content_type=ContentType.objects.get_for_model(Message),
+                         object_id__in=Message.objects.filter(chat__in=chats).values('id')).delete()
+    Image.objects.filter(content_type=ContentType.objects.get_for_model(User), object_id__in=users.values('id'))\
+        .delete()
+    Image.objects.filter(content_type=ContentType.objects.get_for_model(Chat), object_id__in=chats.values('id'))\
+        .delete()
+    # the cascade would load every message to look for their images, which are already deleted
+    messages = Message.objects.filter(chat__in=chats)
+    messages._raw_delete(messages.db)
+    chats.delete()
+    users.delete()
+
+
+def sentence(rng, words=8):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, words)))
+
+
+def chat_size(rng, distribution, mean, limit):
+    """
+    Number of invited members of a group chat
+
+    :param distribution: `uniform`, `exponential` or `zipf`, the last gives a few very large chats
+    :param mean: average size
+    :param limit: largest size
+    :return:
+    """
+    if distribution == 'uniform':
+        size = rng.randint(1, 2 * mean - 1)
+    elif distribution == 'exponential':
+        size = int(rng.expovariate(1 / mean)) + 1
+    elif distribution == 'zipf':
+        size = round(rng.paretovariate(ZIPF_ALPHA) * mean * (ZIPF_ALPHA - 1) / ZIPF_ALPHA)
+    else:
+        raise ValueError(f'Unknown distribution of chat sizes {distribution}')
+    return max(1, min(limit, size))
+
+
+def message_weights(rng, distribution, sizes):
+    """
+    Cumulative weights of chats getting messages
+
+    :param distribution: `uniform`, `size` for rates proportional to numbers of members
+        or `zipf` for rates inversely proportional to ranks of chats in a random order
+    :param sizes: numbers of members of chats
+    :return:
+    """
+    if distribution == 'uniform':
+        weights = [1] * len(sizes)
+    elif distribution == 'size':
+        weights = sizes
+    elif distribution == 'zipf':
+        ranks = list(range(1, len(sizes) + 1))
+        rng.shuffle(ranks)
+        weights = [1 / rank for rank in ranks]
+    else:
+        raise ValueError(f'Unknown distribution of messages {distribution}')
+    return list(accumulate(weights))
+
+
+@transaction.atomic
+def generate(users=1000, chats=200, members=20, dialogs=500, messages=100000, images=1000, days=90, seed=0,
+             batch_size=None, chat_sizes='exponential', message_rate='uniform', log=None):
+    """
+    Generates data and returns numbers of created objects
+
+    Rows are written with COPY on PostgreSQL and with bulk_create on other databases, see loaders.
+    Tables are locked for the time of generation, so that ids can be assigned in advance.
+
+    :param users: number of users
+    :param chats: number of group chats
+    :param members: average number of members of a group chat
+    :param dialogs: number of dialogs between random pairs of users
+    :param messages: number of messages spread over chats and `days` days before now
+    :param images: number of images attached to users, chats and messages
+    :param seed: seed of the random generator
+    :param batch_size: number of rows inserted at once
+    :param chat_sizes: distribution of sizes of group chats, see chat_size
+    :param message_rate: distribution of messages over chats, see message_weights
+    :param log: function receiving progress messages
+    :return:
+    """
+    log = log or (lambda text: None)
+    rng = random.Random(seed)
+    writer = loaders.get_writer(batch_size)
+    models = [User, Chat, Membership, Message, Image]
+    writer.lock(models)
+    now = timezone.now()
+    start = now - timedelta(days=days)
+    first = User.objects.filter(username__startswith=PREFIX).count()
+
+    password = make_password(PASSWORD, salt=f'{PREFIX}{seed}')
+    user_ids = writer.reserve_ids(User, users)
+    writer.write(User, ['id', 'username', 'email', 'password', 'first_name', 'about', 'date_joined'], (
+        (user_id, f'{PREFIX}{number}', f'{PREFIX}{number}@example.com', password, rng.choice(WORDS).title(),
+         sentence(rng), start) for number, user_id in enumerate(user_ids, first)))
+    log(f'Created {users} users')
+
+    chat_ids = writer.reserve_ids(Chat, chats)
+    creators = [rng.choice(user_ids) for _ in chat_ids]
+    chat_members = [{creator, *rng.sample(user_ids, chat_size(rng, chat_sizes, members, users))}
+                    for creator in creators]
+    pairs = set()
+    for _ in range(dialogs):
+        first_user, second_user = rng.sample(user_ids, 2) if users > 1 else (user_ids[0], user_ids[0])
+        pairs.add((min(first_user, second_user), max(first_user, second_user)))
+    pairs = sorted(pairs)
+    dialog_ids = writer.reserve_ids(Chat, len(pairs))
+    chat_fields = ['id', 'name', 'description', 'creator_id', 'is_dialog', 'dialog_user_low_id',
+                   'dialog_user_high_id', 'date_created', 'last_activity_at']
+    writer.write(Chat, chat_fields, (
+        (chat_id, sentence(rng, 3), sentence(rng), creator, False, None, None, start, start)
+        for chat_id, creator in zip(chat_ids, creators)))
+    writer.write(Chat, chat_fields, (
+        (chat_id, f'{PREFIX}{low}-{high}', '', low, True, low, high, start, start)
+        for chat_id, (low, high) in zip(dialog_ids, pairs)))
+    all_chat_ids = [*chat_ids, *dialog_ids]
+    member_lists = [sorted(chat_user_ids) for chat_user_ids in chat_members] + [list(pair) for pair in pairs]
+    memberships = sum(map(len, member_lists))
+    membership_ids = iter(writer.reserve_ids(Membership, memberships))
+    writer.write(Membership, ['id', 'chat_id', 'user_id', 'date_started'], (
+        (next(membership_ids), chat_id, user_id, start)
+        for chat_id, chat_user_ids in zip(all_chat_ids, member_lists) for user_id in chat_user_ids))
+    log(f'Created {chats} chats, {len(pairs)} dialogs and {memberships} memberships')
+
+    # messages are created in the order of their dates, like real ones
+    message_ids = writer.reserve_ids(Message, messages) if all_chat_ids else range(0)
+    if message_ids:
+        cum_weights = message_weights(rng, message_rate, list(map(len, member_lists)))
+        contents = [sentence(rng, 20) for _ in range(SENTENCES)]
+        step = timedelta(days=days) / messages
+        # chats are drawn by batches, a separate generator keeps messages the same for any batch size
+        chat_rng = random.Random(f'{seed}.messages')
+        with writer.deferred_indexes(Message, messages):
+            for batch in loaders.batches(enumerate(message_ids), writer.batch_size):
+                chosen = chat_rng.choices(range(len(all_chat_ids)), cum_weights=cum_weights, k=len(batch))
+                writer.write(Message, ['id', 'chat_id', 'user_id', 'content', 'date_created'], (
+                    (message_id, all_chat_ids[chat], rng.choice(member_lists[chat]), rng.choice(contents),
+                     start + step * number) for (number, message_id), chat in zip(batch, chosen)))
+                log(f'Created {batch[-1][0] + 1} messages')
+        Chat.objects.filter(pk__in=all_chat_ids).refresh_last_messages()
+
+    owners = [(ContentType.objects.get_for_model(model), ids)
+              for model, ids in ((User, user_ids), (Chat, all_chat_ids), (Message, message_ids)) if ids]
+    image_ids = writer.reserve_ids(Image, images) if owners else range(0)
+    image_owners = [rng.choice(owners) for _ in image_ids]
+    writer.write(Image, ['id', 'name', 'imageURL', 'content_type_id', 'object_id'], (
+        (image_id, f'{PREFIX}{number}.png', f'https://example.com/{PREFIX}{number}.png', content_type.id,
+         rng.choice(ids)) for number, (image_id, (content_type, ids)) in enumerate(zip(image_ids, image_owners))))
+    log(f'Created {len(image_ids)} images')
+    writer.finish(models)
+    return {'users': users, 'chats': chats, 'dialogs': len(pairs), 'memberships': memberships,
+            'messages': len(message_ids), 'images': len(image_ids)}
+
+
+def import_dir(path, log=None):
+    """
+    Loads users, chats, memberships, messages and images from CSV files named after their tables, PostgreSQL only
+
+    Every file starts with a header of column names, missing files are skipped.
+    NOT NULL columns missing from a header get defaults of their fields, see loaders.import_csv.
+    Last messages of chats are refreshed afterwards.
+
+    :param path: directory with the files
+    :param log: function receiving progress messages
+    :return: numbers of loaded rows by tables
+    """
+    log = log or (lambda text: None)
+    loaded = {}
+    defaulted = []
+    with transaction.atomic():
+        for model in (User, Chat, Membership, Message, Image):
+            table = model._meta.db_table
+            file_path = os.path.join(path, f'{table}.csv')
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, newline='') as file:
+                loaded[table], fields = loaders.import_csv(model, file)
+            defaulted.extend(fields)
+            log(f'Loaded {loaded[table]} rows of {table}')
+        if loaded.get(Message._meta.db_table):
+            Chat.objects.refresh_last_messages()
+        loaders.drop_defaults(defaulted)
+    loaders.CopyWriter().finish([User, Chat, Membership, Message, Image])
+    return loaded
@@ -0,0 +1,267 @@
+"""
+Writers of generated rows: COPY for PostgreSQL, bulk_create for other databases
+
+Rows are tuples of values of the given attributes of a model, other concrete fields get their defaults.
+Primary keys are assigned by the generator from ranges reserved by the writer, so that rows
+referring to each other can be generated without reading inserted rows back.
+"""
+import csv
+import io
+import json
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime
+from itertools import islice
+from operator import methodcaller
+
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+
+_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _encode(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.translate(_ESCAPES)
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value).translate(_ESCAPES)
+    return str(value)
+
+
+# encoders of exact types skip the checks above, it matters for tens of millions of values
+_ENCODERS = {int: str, str: methodcaller('translate', _ESCAPES), datetime: datetime.isoformat}
+
+
+def encode(value):
+    """Value in the text format of COPY"""
+    return _ENCODERS.get(type(value), _encode)(value)
+
+
+class Writer:
+    def __init__(self, batch_size=100000):
+        self.batch_size = batch_size
+
+    @staticmethod
+    def fields(model, attnames):
+        """Concrete fields of model with the given ones first and the defaults of the rest"""
+        by_attname = {field.attname: field for field in model._meta.concrete_fields}
+        given = [by_attname[attname] for attname in attnames]
+        rest = [field for field in model._meta.concrete_fields if field not in given]
+        return given + rest, tuple(field.get_default() for field in rest)
+
+    def lock(self, models):
+        pass
+
+    def reserve_ids(self, model, count):
+        raise NotImplementedError
+
+    def write(self, model, attnames, rows):
+        """
+        Inserts rows of model
+
+        :param model:
+        :param attnames: attributes of the values of rows, e.g. `chat_id` for foreign keys
+        :param rows: iterable of tuples, it is consumed by batches
+        :return: number of inserted rows
+        """
+        raise NotImplementedError
+
+    def deferred_indexes(self, model, count):
+        """Context of writing `count` rows of model, in which the writer may drop indexes and build them later"""
+        return nullcontext()
+
+    def finish(self, models):
+        pass
+
+
+class CopyWriter(Writer):
+    """Writes rows with COPY FROM STDIN and reserves ids by moving sequences forward"""
+
+    def lock(self, models):
+        # concurrent inserts would take ids from the reserved ranges
+        tables = ', '.join(connection.ops.quote_name(model._meta.db_table) for model in models)
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {tables} IN SHARE ROW EXCLUSIVE MODE')
+
+    def reserve_ids(self, model, count):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_get_serial_sequence(%s, %s)",
+                           [connection.ops.quote_name(model._meta.db_table), model._meta.pk.column])
+            sequence = cursor.fetchone()[0]
+            cursor.execute('SELECT nextval(%s)', [sequence])
+            first = cursor.fetchone()[0]
+            if count > 1:
+                cursor.execute('SELECT setval(%s, %s)', [sequence, first + count - 1])
+        return range(first, first + count)
+
+    def write(self, model, attnames, rows):
+        fields, defaults = self.fields(model, attnames)
+        end = ''.join(f'\t{encode(value)}' for value in defaults) + '\n'
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+        sql = f'COPY {connection.ops.quote_name(model._meta.db_table)} ({columns}) FROM STDIN'
+        written = 0
+        with connection.cursor() as cursor:
+            for batch in batches(rows, self.batch_size):
+                buffer = io.StringIO()
+                buffer.writelines('\t'.join(map(encode, row)) + end for row in batch)
+                buffer.seek(0)
+                cursor.copy_expert(sql, buffer)
+                written += len(batch)
+        return written
+
+    @contextmanager
+    def deferred_indexes(self, model, count):
+        """
+        Drops indexes and foreign keys of model, except unique ones, while writing rows and creates them back after
+
+        Building an index at once is much faster than updating it row by row, so this is done only when new rows
+        outnumber the ones already in the table or in its partitions, as estimated by the last ANALYZE.
+        """
+        table = connection.ops.quote_name(model._meta.db_table)
+        with connection.cursor() as cursor:
+            # rows of partitioned tables are counted in their partitions, e.g. of messages after partition_messages
+            cursor.execute('WITH RECURSIVE tree (oid) AS (SELECT %s::regclass::oid UNION ALL '
+                           'SELECT inhrelid FROM pg_inherits JOIN tree ON inhparent = tree.oid) '
+                           'SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0) FROM pg_class JOIN tree USING (oid)',
+                           [table])
+            if count <= cursor.fetchone()[0]:
+                yield
+                return
+            # checks of rows written before must not be pending when tables are altered
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            cursor.execute('SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index '
+                           'WHERE indrelid = %s::regclass AND NOT EXISTS '
+                           '(SELECT FROM pg_constraint WHERE conindid = indexrelid)', [table])
+            indexes = cursor.fetchall()
+            cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                           "WHERE conrelid = %s::regclass AND contype = 'f'", [table])
+            constraints = cursor.fetchall()
+            for name, _ in constraints:
+                cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT {connection.ops.quote_name(name)}')
+            for name, _ in indexes:
+                cursor.execute(f'DROP INDEX {name}')
+        yield
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('maintenance_work_mem', %s, true)",
+                           [settings.BULK_LOAD_MAINTENANCE_WORK_MEM])
+            for _, definition in indexes:
+                # indexes of partitioned tables are defined ON ONLY the table, they are built for partitions too
+                cursor.execute(definition.replace(' ON ONLY ', ' ON ', 1))
+            for name, definition in constraints:
+                cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT {connection.ops.quote_name(name)} {definition}')
+
+    def finish(self, models):
+        with connection.cursor() as cursor:
+            for model in models:
+                cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+
+
+class BulkCreateWriter(Writer):
+    """Writes rows with bulk_create, ids are reserved above the largest existing one"""
+
+    def __init__(self, batch_size=10000):
+        super(BulkCreateWriter, self).__init__(batch_size)
+        self._next_ids = {}
+
+    def reserve_ids(self, model, count):
+        first = self._next_ids.get(model)
+        if first is None:
+            first = (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        self._next_ids[model] = first + count
+        return range(first, first + count)
+
+    def write(self, model, attnames, rows):
+        written = 0
+        for batch in batches(rows, self.batch_size):
+            model.objects.bulk_create([model(**dict(zip(attnames, row))) for row in batch])
+            written += len(batch)
+        return written
+
+    def finish(self, models):
+        # sequences know nothing of explicit ids
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+
+
+def get_writer(batch_size=None):
+    if connection.vendor == 'postgresql':
+        return CopyWriter(batch_size or 100000)
+    return BulkCreateWriter(batch_size or 10000)
+
+
+def column_default(field):
+    """
+    Value of a column missing from imported rows: the default of the field, which is an empty string
+    for text fields without one, or the current time for auto_now and auto_now_add fields
+
+    :param field:
+    :return:
+    :raises ValueError: when the field has no default, e.g. a foreign key
+    """
+    if field.has_default() or field.empty_strings_allowed:
+        return field.get_default()
+    if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+        return timezone.now()
+    raise ValueError(f'Column {field.column} of {field.model._meta.db_table} is required')
+
+
+def import_csv(model, file):
+    """
+    Loads rows of model from a CSV file with a header of column names, PostgreSQL only
+
+    Defaults of fields exist only in Django, so NOT NULL columns missing from the header and having
+    no default in the database get one from column_default. It must be dropped by drop_defaults
+    in the same transaction, after all files are loaded, as tables with pending checks of foreign keys
+    can not be altered.
+
+    :param model:
+    :param file: opened file
+    :return: number of loaded rows and fields which got defaults
+    :raises ValueError: when a NOT NULL column without a default is missing from the header
+    """
+    header = [column.strip() for column in next(csv.reader([file.readline()]))]
+    columns = ', '.join(connection.ops.quote_name(column) for column in header)
+    table = connection.ops.quote_name(model._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() "
+                       "AND table_name = %s AND is_nullable = 'NO' AND column_default IS NULL",
+                       [model._meta.db_table])
+        required = {column for column, in cursor.fetchall()} - set(header)
+        defaults = [(field, column_default(field)) for field in model._meta.concrete_fields
+                    if field.column in required]
+        for field, default in defaults:
+            cursor.execute(f'ALTER TABLE {table} ALTER COLUMN {connection.ops.quote_name(field.column)} '
+                           f'SET DEFAULT %s', [field.get_db_prep_save(default, connection)])
+        cursor.copy_expert(f'COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)', file)
+        loaded = cursor.rowcount
+        # ids in the file may be above the sequence
+        cursor.execute(f"SELECT setval(pg_get_serial_sequence(%s, %s), GREATEST(MAX({model._meta.pk.column}), 1)) "
+                       f"FROM {table}", [table, model._meta.pk.column])
+    return loaded, [field for field, _ in defaults]
+
+
+def drop_defaults(fields):
+    """Drops defaults set by import_csv, checks of foreign keys of loaded rows are run first"""
+    with connection.cursor() as cursor:
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        for field in fields:
+            cursor.execute(f'ALTER TABLE {connection.ops.quote_name(field.model._meta.db_table)} '
+                           f'ALTER COLUMN {connection.ops.quote_name(field.column)} DROP DEFAULT')
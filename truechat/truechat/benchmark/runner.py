@@ -0,0 +1,169 @@
+"""
+Runner of benchmark scenarios
+
+Scenarios run one after another in process, through the whole middleware stack, by `concurrency` threads,
+each with its own client and database connection. Latency percentiles, throughput and numbers of queries
+are reported per endpoint. Results are saved as JSON together with the commit they were measured on.
+"""
+import json
+import random
+import subprocess
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.test import APIClient
+
+from truechat.instrumentation import RequestMetrics
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[min(rank, len(values)) - 1]
+
+
+def run_scenario(scenario, context, requests, concurrency=1, warmup=0, seed=0):
+    """
+    Runs `requests` calls of scenario spread over `concurrency` threads after `warmup` calls per thread
+
+    :param scenario:
+    :param context: scenarios.Context
+    :param requests:
+    :param concurrency:
+    :param warmup:
+    :param seed:
+    :return: lists of (duration, queries, status, bytes) by endpoints and wall time of the run
+    """
+    samples = {}
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(concurrency + 1)
+
+    def worker(number, count):
+        rng = random.Random(f'{seed}.{number}')
+        client = APIClient()
+        measured = []
+        try:
+            for _ in range(warmup):
+                scenario(client, context, rng)
+            barrier.wait()
+            for _ in range(count):
+                metrics = RequestMetrics(False)
+                with ExitStack() as stack:
+                    for connection in connections.all():
+                        stack.enter_context(connection.execute_wrapper(metrics.execute))
+                    started = time.perf_counter()
+                    endpoint, response = scenario(client, context, rng)
+                    duration = time.perf_counter() - started
+                measured.append((endpoint, duration, metrics.queries, response.status_code, len(response.content)))
+        except Exception as e:
+            barrier.abort()
+            errors.append(e)
+        finally:
+            connections.close_all()
+        with lock:
+            for endpoint, *sample in measured:
+                samples.setdefault(endpoint, []).append(sample)
+
+    counts = [requests // concurrency + (number < requests % concurrency) for number in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(number, count)) for number, count in enumerate(counts)]
+    for thread in threads:
+        thread.start()
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples, wall_time):
+    """Statistics of measurements of one endpoint, durations are in milliseconds"""
+    durations = sorted(sample[0] * 1000 for sample in samples)
+    result = {
+        'requests': len(samples),
+        'errors': sum(sample[2] >= 400 for sample in samples),
+        'throughput': round(len(samples) / wall_time, 2) if wall_time else None,
+        'mean_ms': round(sum(durations) / len(durations), 3),
+        'queries': round(sum(sample[1] for sample in samples) / len(samples), 2),
+        'max_queries': max(sample[1] for sample in samples),
+        'response_bytes': round(sum(sample[3] for sample in samples) / len(samples)),
+    }
+    for percent in PERCENTILES:
+        result[f'p{percent}_ms'] = round(percentile(durations, percent), 3)
+    return result
+
+
+def current_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=settings.BASE_DIR, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, cwd=settings.BASE_DIR, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f'{commit}-dirty' if dirty else commit
+
+
+def run(scenarios, context, requests, concurrency=1, warmup=0, seed=0, log=None):
+    """
+    Runs scenarios and returns results ready to be saved
+
+    :param scenarios: dict of scenarios by names
+    :param context: scenarios.Context
+    :param requests: number of measured requests of every scenario
+    :return:
+    """
+    log = log or (lambda text: None)
+    results = {}
+    for name, scenario in scenarios.items():
+        samples, wall_time = run_scenario(scenario, context, requests, concurrency, warmup, seed)
+        results[name] = {endpoint: summarize(endpoint_samples, wall_time)
+                         for endpoint, endpoint_samples in sorted(samples.items())}
+        for endpoint, summary in results[name].items():
+            log(format_summary(name, endpoint, summary))
+    return {
+        'commit': current_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'parameters': {'requests': requests, 'concurrency': concurrency, 'warmup': warmup, 'seed': seed,
+                       'users': len(context.user_ids)},
+        'environment': {'database': connections['default'].vendor, 'replicas': len(settings.DATABASE_REPLICAS),
+                        'pool_size': settings.DATABASE_POOL_SIZE, 'cache': settings.CACHES['default']['BACKEND']},
+        'results': results,
+    }
+
+
+def format_summary(scenario, endpoint, summary, baseline=None):
+    text = f'{scenario:16} {endpoint:20} ' + ' '.join(
+        f'{key}={summary[key]}' for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput', 'queries', 'errors'))
+    if baseline:
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput'):
+            if baseline.get(key):
+                changes.append(f'{key} {(summary[key] - baseline[key]) / baseline[key] * 100:+.1f}%')
+        text += '  vs baseline: ' + ', '.join(changes)
+    return text
+
+
+def save(results, path):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, log):
+    """Logs results of every endpoint next to their changes relative to baseline results"""
+    log(f'Compared with {baseline.get("commit")} of {baseline.get("date")}')
+    for name, endpoints in results['results'].items():
+        for endpoint, summary in endpoints.items():
+            log(format_summary(name, endpoint, summary, baseline.get('results', {}).get(name, {}).get(endpoint)))
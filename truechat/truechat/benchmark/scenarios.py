@@ -0,0 +1,104 @@
+"""
+Benchmark scenarios, every call of a scenario makes one request of a randomly chosen user
+
+Scenarios are given a Context with generated users, their tokens and chats and return
+(endpoint, response) of the request they made.
+"""
+import random
+from urllib.parse import parse_qsl, urlsplit
+
+from rest_framework.authtoken.models import Token
+
+from chat.models import Membership
+from custom_auth.models import User
+from truechat.benchmark.data import PREFIX, WORDS, sentence
+
+
+class Context:
+    def __init__(self, users=200, seed=0):
+        """
+        Chooses generated users which are members of chats and gives them tokens
+
+        :param users: number of users taking part in scenarios
+        :param seed: seed of choices of users and chats
+        """
+        rng = random.Random(seed)
+        candidates = list(User.objects.filter(username__startswith=PREFIX, memberships__isnull=False).distinct()
+                          .order_by('id').values_list('id', flat=True))
+        if not candidates:
+            raise ValueError('There is no generated data, run seed_data first')
+        self.user_ids = rng.sample(candidates, min(users, len(candidates)))
+        self.tokens = {token.user_id: token.key for token in Token.objects.filter(user_id__in=self.user_ids)}
+        missing = [Token(user_id=user_id) for user_id in self.user_ids if user_id not in self.tokens]
+        for token in missing:
+            token.key = token.generate_key()
+            self.tokens[token.user_id] = token.key
+        Token.objects.bulk_create(missing)
+        self.chats = {}
+        memberships = Membership.objects.filter(user_id__in=self.user_ids, is_banned=False)
+        for user_id, chat_id in memberships.values_list('user_id', 'chat_id').order_by('id'):
+            self.chats.setdefault(user_id, []).append(chat_id)
+        self.user_ids = [user_id for user_id in self.user_ids if user_id in self.chats]
+
+    def headers(self, user_id):
+        return {'HTTP_AUTHORIZATION': f'Token {self.tokens[user_id]}'}
+
+
+def chat_list(client, context, rng):
+    user_id = rng.choice(context.user_ids)
+    return 'chats-list', client.get('/chats/', **context.headers(user_id))
+
+
+def chat_list_page(client, context, rng):
+    user_id = rng.choice(context.user_ids)
+    return 'chats-list?page', client.get('/chats/', {'page': 1}, **context.headers(user_id))
+
+
+class Scroll:
+    """Scrolls history of chats back by pages, starting over when the history ends"""
+
+    def __init__(self, pages=5, limit=50):
+        self.pages = pages
+        self.limit = limit
+
+    def __call__(self, client, context, rng):
+        state = client.__dict__.setdefault('_scroll', {})
+        if not state.get('next') or state['left'] <= 0:
+            user_id = rng.choice(context.user_ids)
+            chat_id = rng.choice(context.chats[user_id])
+            state.update(user_id=user_id, left=self.pages,
+                         next=f'/chats/{chat_id}/messages/?limit={self.limit}')
+        url = urlsplit(state['next'])
+        response = client.get(url.path, dict(parse_qsl(url.query)),
+                              **context.headers(state['user_id']))
+        state['left'] -= 1
+        state['next'] = response.data.get('next') if response.status_code == 200 else None
+        return 'chats-messages', response
+
+
+def send(client, context, rng):
+    user_id = rng.choice(context.user_ids)
+    chat_id = rng.choice(context.chats[user_id])
+    return 'chats-add-message', client.post(f'/chats/{chat_id}/add_message/', {'content': sentence(rng, 20)},
+                                            format='json', **context.headers(user_id))
+
+
+def search_profiles(client, context, rng):
+    user_id = rng.choice(context.user_ids)
+    return 'profiles', client.get(f'/profiles/{PREFIX}{rng.randint(0, 99)}/', **context.headers(user_id))
+
+
+def search_messages(client, context, rng):
+    user_id = rng.choice(context.user_ids)
+    return 'messages-search', client.get('/messages/search/', {'q': rng.choice(WORDS), 'limit': 20},
+                                         **context.headers(user_id))
+
+
+SCENARIOS = {
+    'list': chat_list,
+    'list_page': chat_list_page,
+    'scroll': Scroll(),
+    'send': send,
+    'search_profiles': search_profiles,
+    'search_messages': search_messages,
+}
@@ -0,0 +1,65 @@
+"""
+PostgreSQL backend taking connections from a process-wide ConnectionPool
+
+Settings of the pool are read from the POOL dictionary of the database settings:
+MAX_SIZE, TIMEOUT, CHECK_INTERVAL and MAX_AGE. CONN_MAX_AGE should be 0,
+so that connections are returned to the pool at the end of every request.
+"""
+import threading
+
+from django.db.backends.postgresql import base, creation
+
+from truechat.db_pool.pool import ConnectionPool
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, settings_dict, conn_params):
+    # test and maintenance databases have their own pools
+    key = (alias, repr(sorted(conn_params.items())))
+    with _pools_lock:
+        if key not in _pools:
+            options = settings_dict.get('POOL', {})
+            _pools[key] = ConnectionPool(max_size=options.get('MAX_SIZE', 10),
+                                         timeout=options.get('TIMEOUT', 10),
+                                         check_interval=options.get('CHECK_INTERVAL', 30),
+                                         max_age=options.get('MAX_AGE'))
+        return _pools[key]
+
+
+def pool_stats():
+    """Returns statistics of all pools of the process by database aliases"""
+    with _pools_lock:
+        pools = list(_pools.items())
+    stats = {}
+    for (alias, _), pool in pools:
+        alias_stats = stats.setdefault(alias, {})
+        for name, value in pool.get_stats().items():
+            if name == 'max_wait_time':
+                alias_stats[name] = max(alias_stats.get(name, 0), value)
+            else:
+                alias_stats[name] = alias_stats.get(name, 0) + value
+    return stats
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # idle pooled connections would prevent dropping of the database
+        for (alias, _), pool in list(_pools.items()):
+            if alias == self.connection.alias:
+                pool.close_all()
+        super(DatabaseCreation, self)._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        self.pool = get_pool(self.alias, self.settings_dict, conn_params)
+        return self.pool.acquire(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.release(self.connection)
@@ -0,0 +1,191 @@
+"""
+Bounded pool of database connections shared by threads of a process
+
+Connections are checked out by Django database wrappers instead of being opened,
+and checked in instead of being closed. A checkout waits up to `timeout` seconds
+for a free connection when `max_size` connections are in use. Connections idle for
+longer than `check_interval` seconds are probed before reuse and connections older than
+`max_age` seconds are replaced. Pools are bound to a process, connections inherited
+through fork are abandoned, never closed, so the parent's sessions are not terminated.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.created = 0
+        self.discarded = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class ConnectionPool:
+    def __init__(self, max_size=10, timeout=10.0, check_interval=30.0, max_age=None):
+        """
+        :param max_size: maximal number of connections, idle and checked out
+        :param timeout: seconds to wait for a free connection
+        :param check_interval: connections idle for longer are probed before reuse
+        :param max_age: seconds after which connections are replaced, None to keep them forever
+        """
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self._condition = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self.stats = PoolStats()
+        # (connection, created at, checked in at), the most recently used on the right
+        self._idle = deque()
+        # creation times of connections opened by this process
+        self._created_at = {}
+        self._in_use = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    @property
+    def size(self):
+        return len(self._idle) + self._in_use
+
+    def acquire(self, connect):
+        """
+        Checks out an idle connection or opens a new one when the pool is not full
+
+        :param connect: function opening a new psycopg2 connection
+        :return:
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        while True:
+            with self._condition:
+                self._check_pid()
+                while not self._idle and self._in_use >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats.timeouts += 1
+                        raise PoolTimeout(f'No free connection in the pool of {self.max_size} '
+                                          f'after waiting {self.timeout}s')
+                    waited = True
+                    self._condition.wait(remaining)
+                # reserves the place while the connection is probed or opened outside of the lock
+                self._in_use += 1
+                connection, checked_in = self._idle.pop() if self._idle else (None, None)
+            if connection is None:
+                return self._open(connect, started, waited)
+            if self._is_usable(connection, checked_in):
+                with self._condition:
+                    self._checked_out(started, waited)
+                return connection
+            with self._condition:
+                self._in_use -= 1
+                self._discard(connection)
+
+    def _open(self, connect, started, waited):
+        try:
+            connection = connect()
+        except Exception:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._created_at[id(connection)] = time.monotonic()
+            self.stats.created += 1
+            self._checked_out(started, waited)
+        return connection
+
+    def release(self, connection):
+        """Returns the connection to the pool, rolling back its unfinished transaction"""
+        with self._condition:
+            self._check_pid()
+            if id(connection) not in self._created_at:
+                # connection was inherited through fork, closing it would terminate the parent's session
+                return
+        reusable = self._clean(connection)
+        with self._condition:
+            self._in_use -= 1
+            if reusable:
+                self._idle.append((connection, time.monotonic()))
+            else:
+                self._discard(connection)
+            self._condition.notify()
+
+    def close_all(self):
+        """Closes idle connections, checked out ones are closed when they are released"""
+        with self._condition:
+            self._check_pid()
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+
+    def _checked_out(self, started, waited):
+        self.stats.checkouts += 1
+        if waited:
+            wait_time = time.monotonic() - started
+            self.stats.waits += 1
+            self.stats.wait_time += wait_time
+            self.stats.max_wait_time = max(self.stats.max_wait_time, wait_time)
+
+    def _is_usable(self, connection, checked_in):
+        if connection.closed:
+            return False
+        created_at = self._created_at.get(id(connection), 0)
+        if self.max_age is not None and time.monotonic() - created_at > self.max_age:
+            return False
+        if time.monotonic() - checked_in > self.check_interval:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                if not connection.autocommit:
+                    connection.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    @staticmethod
+    def _clean(connection):
+        if connection.closed:
+            return False
+        try:
+            status = connection.get_transaction_status()
+            if status in (extensions.TRANSACTION_STATUS_INTRANS, extensions.TRANSACTION_STATUS_INERROR):
+                connection.rollback()
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                return False
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, connection):
+        self._created_at.pop(id(connection), None)
+        self.stats.discarded += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def get_stats(self):
+        with self._condition:
+            self._check_pid()
+            return dict(self.stats.as_dict(), size=self.size, idle=len(self._idle), in_use=self._in_use,
+                        max_size=self.max_size)
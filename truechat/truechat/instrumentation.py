@@ -0,0 +1,238 @@
+"""
+Per-endpoint instrumentation of requests
+
+InstrumentationMiddleware measures every request: wall time, number and time of database queries
+on all connections, time spent in DRF serializers and size of the response. Measurements are
+aggregated in memory of the process by endpoint (URL name or route) and method and are exported
+in the Prometheus text format by the `metrics` view together with statistics of connection pools
+and of the token cache. Every process keeps its own metrics, so each worker should be scraped
+or INSTRUMENTATION_LOG should be enabled to get a structured log line per request instead.
+
+With INSTRUMENTATION_N_PLUS_ONE set (by default in DEBUG), requests which run the same statement
+with different parameters INSTRUMENTATION_N_PLUS_ONE_THRESHOLD times or more are logged as N+1 suspects.
+"""
+import hmac
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from rest_framework.serializers import BaseSerializer
+
+logger = logging.getLogger(__name__)
+request_logger = logging.getLogger('truechat.requests')
+
+_state = threading.local()
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# literals and placeholders of SQL statements, replaced to group statements differing only in parameters
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s")
+_SQL_LISTS = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+
+
+class RequestMetrics:
+    def __init__(self, detect_n_plus_one):
+        self.queries = 0
+        self.query_time = 0.0
+        self.serializer_time = 0.0
+        self.statements = Counter() if detect_n_plus_one else None
+        # depth of nested serializers, only the outermost one is timed
+        self.serializer_depth = 0
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_time += time.perf_counter() - started
+            self.queries += 1
+            if self.statements is not None:
+                self.statements[normalize_sql(sql)] += 1
+
+
+def normalize_sql(sql):
+    return _SQL_LISTS.sub('(?)', _SQL_LITERALS.sub('?', sql))
+
+
+def current_metrics():
+    return getattr(_state, 'metrics', None)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.duration = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.queries = 0
+        self.query_time = 0.0
+        self.serializer_time = 0.0
+        self.response_bytes = 0
+
+
+class Registry:
+    """Metrics of the process aggregated by (endpoint, method)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, method, status_code, duration, metrics, response_bytes):
+        with self._lock:
+            stats = self._endpoints.get((endpoint, method))
+            if stats is None:
+                stats = self._endpoints[endpoint, method] = EndpointStats()
+            stats.requests += 1
+            stats.errors += status_code >= 500
+            stats.duration += duration
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    stats.buckets[index] += 1
+            stats.queries += metrics.queries
+            stats.query_time += metrics.query_time
+            stats.serializer_time += metrics.serializer_time
+            stats.response_bytes += response_bytes
+
+    def snapshot(self):
+        with self._lock:
+            return {key: vars(stats).copy() for key, stats in self._endpoints.items()}
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+registry = Registry()
+
+
+def _serializer_data(self):
+    metrics = current_metrics()
+    if metrics is None:
+        return _base_serializer_data(self)
+    metrics.serializer_depth += 1
+    started = time.perf_counter()
+    try:
+        return _base_serializer_data(self)
+    finally:
+        metrics.serializer_depth -= 1
+        if not metrics.serializer_depth:
+            metrics.serializer_time += time.perf_counter() - started
+
+
+_base_serializer_data = BaseSerializer.data.fget
+
+
+def install():
+    """Times `data` of all DRF serializers, Serializer and ListSerializer get it from BaseSerializer"""
+    if BaseSerializer.data.fget is not _serializer_data:
+        BaseSerializer.data = property(_serializer_data)
+
+
+def endpoint_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name if match.url_name else match.route
+
+
+class InstrumentationMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        install()
+
+    def __call__(self, request):
+        metrics = RequestMetrics(settings.INSTRUMENTATION_N_PLUS_ONE)
+        _state.metrics = metrics
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics.execute))
+                response = self.get_response(request)
+        finally:
+            _state.metrics = None
+        duration = time.perf_counter() - started
+
+        endpoint = endpoint_name(request)
+        response_bytes = 0 if response.streaming else len(response.content)
+        registry.record(endpoint, request.method, response.status_code, duration, metrics, response_bytes)
+        response['Server-Timing'] = f'app;dur={duration * 1000:.1f}, db;dur={metrics.query_time * 1000:.1f}, ' \
+                                    f'serializer;dur={metrics.serializer_time * 1000:.1f}'
+        if settings.INSTRUMENTATION_LOG:
+            request_logger.info(json.dumps({
+                'endpoint': endpoint, 'method': request.method, 'path': request.path,
+                'status': response.status_code, 'duration': round(duration, 6), 'queries': metrics.queries,
+                'query_time': round(metrics.query_time, 6), 'serializer_time': round(metrics.serializer_time, 6),
+                'bytes': response_bytes,
+            }))
+        if metrics.statements:
+            self.report_n_plus_one(request, endpoint, metrics)
+        return response
+
+    @staticmethod
+    def report_n_plus_one(request, endpoint, metrics):
+        for sql, count in metrics.statements.most_common():
+            if count < settings.INSTRUMENTATION_N_PLUS_ONE_THRESHOLD:
+                break
+            logger.warning('Possible N+1 queries in %s %s (%s): %d times %s',
+                           request.method, request.path, endpoint, count, sql)
+
+
+_LABEL_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+
+def _labels(**labels):
+    """Labels in the Prometheus text format, backslashes, quotes and line feeds of values are escaped"""
+    return ','.join(f'{name}="{str(value).translate(_LABEL_ESCAPES)}"' for name, value in labels.items())
+
+
+def render_metrics():
+    """Returns metrics of the process in the Prometheus text format"""
+    from custom_auth.authentication import token_cache_stats
+    from truechat.db_pool.base import pool_stats
+
+    lines = [
+        '# TYPE truechat_requests_total counter',
+        '# TYPE truechat_request_errors_total counter',
+        '# TYPE truechat_request_duration_seconds histogram',
+        '# TYPE truechat_db_queries_total counter',
+        '# TYPE truechat_db_query_seconds_total counter',
+        '# TYPE truechat_serializer_seconds_total counter',
+        '# TYPE truechat_response_bytes_total counter',
+    ]
+    for (endpoint, method), stats in sorted(registry.snapshot().items()):
+        labels = _labels(endpoint=endpoint, method=method)
+        lines.append(f'truechat_requests_total{{{labels}}} {stats["requests"]}')
+        lines.append(f'truechat_request_errors_total{{{labels}}} {stats["errors"]}')
+        for bound, count in zip(DURATION_BUCKETS, stats['buckets']):
+            lines.append(f'truechat_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'truechat_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats["requests"]}')
+        lines.append(f'truechat_request_duration_seconds_sum{{{labels}}} {stats["duration"]:.6f}')
+        lines.append(f'truechat_request_duration_seconds_count{{{labels}}} {stats["requests"]}')
+        lines.append(f'truechat_db_queries_total{{{labels}}} {stats["queries"]}')
+        lines.append(f'truechat_db_query_seconds_total{{{labels}}} {stats["query_time"]:.6f}')
+        lines.append(f'truechat_serializer_seconds_total{{{labels}}} {stats["serializer_time"]:.6f}')
+        lines.append(f'truechat_response_bytes_total{{{labels}}} {stats["response_bytes"]}')
+    for alias, stats in sorted(pool_stats().items()):
+        for name, value in sorted(stats.items()):
+            lines.append(f'truechat_db_pool_{name}{{{_labels(alias=alias)}}} {value}')
+    for name, value in sorted(token_cache_stats().items()):
+        lines.append(f'truechat_auth_token_cache_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics(request):
+    """Prometheus endpoint, requires `Authorization: Bearer <METRICS_TOKEN>`, does not exist without METRICS_TOKEN"""
+    if not settings.METRICS_TOKEN:
+        raise Http404
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not hmac.compare_digest(authorization.encode(), f'Bearer {settings.METRICS_TOKEN}'.encode()):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,104 @@
+"""
+Routing of read-only views to database replicas
+
+Queries go to the primary database unless the current request is served by a view action
+listed in `replica_actions` of ReplicaReadMixin. Users who have just written something
+are kept on the primary for DATABASE_REPLICA_STICKY_SECONDS, so that they read their own writes
+even when replicas lag behind, they are remembered in the default cache, so replicas need SHARED_CACHE.
+Access checks read memberships from the primary too. Replicas are database aliases listed in DATABASE_REPLICAS.
+"""
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+_state = threading.local()
+
+
+def current_replica():
+    return getattr(_state, 'replica', None)
+
+
+def choose_replica():
+    return random.choice(settings.DATABASE_REPLICAS) if settings.DATABASE_REPLICAS else None
+
+
+@contextmanager
+def use_primary():
+    """Routes reads of the block to the primary, e.g. to build data which is cached"""
+    previous = current_replica()
+    _state.replica = None
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+def sticky_key(user_id):
+    return f'replicas.sticky.{user_id}'
+
+
+def stick_to_primary(user):
+    cache.set(sticky_key(user.pk), True, settings.DATABASE_REPLICA_STICKY_SECONDS)
+
+
+def is_stuck_to_primary(user):
+    return user.is_authenticated and cache.get(sticky_key(user.pk)) is not None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replica = current_replica()
+        if replica is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+class ReplicaReadMixin:
+    """
+    Serves safe requests to actions listed in `replica_actions` from a replica,
+    authentication and permission checks are done on the primary
+    """
+    replica_actions = ()
+
+    def dispatch(self, request, *args, **kwargs):
+        with use_primary():
+            return super(ReplicaReadMixin, self).dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super(ReplicaReadMixin, self).initial(request, *args, **kwargs)
+        action = getattr(self, 'action', None) or request.method.lower()
+        if request.method in SAFE_METHODS and action in self.replica_actions \
+                and not is_stuck_to_primary(request.user):
+            _state.replica = choose_replica()
+
+
+class StickyPrimaryMiddleware:
+    """Keeps users on the primary for a while after their requests which may have written"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        user = getattr(request, 'user', None)
+        if settings.DATABASE_REPLICAS and request.method not in SAFE_METHODS \
+                and user is not None and user.is_authenticated:
+            stick_to_primary(user)
+        return response
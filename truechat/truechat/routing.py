@@ -0,0 +1,8 @@
+from channels.routing import ProtocolTypeRouter, URLRouter
+
+from chat.routing import websocket_urlpatterns
+from custom_auth.middleware import TokenAuthMiddleware
+
+application = ProtocolTypeRouter({
+    'websocket': TokenAuthMiddleware(URLRouter(websocket_urlpatterns)),
+})
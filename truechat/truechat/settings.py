@@ -11,10 +11,12 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 import os
 import re
+import tempfile
 
 import cloudinary
 import dj_database_url
-from decouple import config
+from decouple import Csv, config
+from django.core.exceptions import ImproperlyConfigured
 from django.urls import reverse_lazy
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -41,6 +43,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.sites',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'chat.apps.ChatConfig',
     'custom_auth.apps.CustomAuthConfig',
     'attachments.apps.AttachmentsConfig',
@@ -54,6 +57,7 @@ INSTALLED_APPS = [
     'rest_framework_swagger',
     'corsheaders',
     'cloudinary',
+    'channels',
 ]
 
 CLOUDINARY_URL = config('CLOUDINARY_URL', default=None)
@@ -73,6 +77,28 @@ cloudinary.config(
     private_cdn=False,
 )
 
+# Storage of image files, switching it affects only new uploads
+ATTACHMENTS_STORAGES = {
+    'cloudinary': 'attachments.storage.CloudinaryImageStorage',
+    'filesystem': 'attachments.storage.FileSystemImageStorage',
+}
+ATTACHMENTS_STORAGE = config('ATTACHMENTS_STORAGE', default='cloudinary')
+ATTACHMENTS_ROOT = config('ATTACHMENTS_ROOT', default=os.path.join(BASE_DIR, 'media', 'images'))
+ATTACHMENTS_URL = config('ATTACHMENTS_URL', default='/images/files/')
+
+# Variants of images generated at upload, by the side of the square they fit into
+ATTACHMENTS_VARIANT_SIZES = {
+    'avatar': 64,
+    'preview': 320,
+}
+
+# Uploaded images are kept in ATTACHMENTS_UPLOAD_DIR until the worker backend uploads them
+ATTACHMENTS_UPLOAD_BACKEND = config('ATTACHMENTS_UPLOAD_BACKEND', default='attachments.tasks.ThreadPoolBackend')
+ATTACHMENTS_UPLOAD_WORKERS = config('ATTACHMENTS_UPLOAD_WORKERS', default=4, cast=int)
+ATTACHMENTS_UPLOAD_DIR = config('ATTACHMENTS_UPLOAD_DIR', default=tempfile.gettempdir())
+# Seconds after which pending images are failed by the sweep_uploads command
+ATTACHMENTS_PENDING_TIMEOUT = config('ATTACHMENTS_PENDING_TIMEOUT', default=3600, cast=int)
+
 SITE_ID = 1
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'rest_framework.schemas.coreapi.AutoSchema',
@@ -82,7 +108,8 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.DjangoModelPermissionsOrAnonReadOnly'
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'custom_auth.authentication.CachedTokenAuthentication',
+        'custom_auth.signed_tokens.SignedTokenAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
@@ -96,12 +123,15 @@ ACCOUNT_AUTHENTICATION_METHOD = 'username_email'
 AUTH_USER_MODEL = 'custom_auth.User'
 
 MIDDLEWARE = [
+    'truechat.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'django.middleware.http.ConditionalGetMiddleware',
+    'truechat.replicas.StickyPrimaryMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -111,16 +141,141 @@ SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 ROOT_URLCONF = 'truechat.urls'
 
 WSGI_APPLICATION = 'truechat.wsgi.application'
+ASGI_APPLICATION = 'truechat.routing.application'
+
+# Channel layer used for fan-out of chat events to websockets.
+# In-memory layer works only within a single process, so production should set REDIS_URL
+REDIS_URL = config('REDIS_URL', default=None)
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# Local memory cache works only within a single process, CACHE_BACKEND and CACHE_LOCATION
+# should point to a shared cache, e.g. memcached, when several processes serve the API
+CACHE_BACKEND = config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache')
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': config('CACHE_LOCATION', default='truechat'),
+        'OPTIONS': {
+            'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=100000, cast=int),
+        },
+    },
+}
+
+# Serialized users, chats and messages are kept in the default cache for this number of seconds
+PAYLOAD_CACHE_TIMEOUT = config('PAYLOAD_CACHE_TIMEOUT', default=3600, cast=int)
+
+# Whether all processes serving the API use the same default cache. Access to chats and payloads are cached
+# only in a shared cache, a cache of a single process would keep serving them after other processes changed them
+SHARED_CACHE = config('SHARED_CACHE', cast=bool, default=CACHE_BACKEND not in (
+    'django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache'))
+
+# Memberships resolved by permission checks are kept in the shared cache for this number of seconds
+CHAT_ACCESS_CACHE_TIMEOUT = config('CHAT_ACCESS_CACHE_TIMEOUT', default=300, cast=int)
+
+# Changes of chats are kept for sync this number of days, `manage.py prune_chat_changes` deletes older ones
+CHAT_CHANGES_RETENTION_DAYS = config('CHAT_CHANGES_RETENTION_DAYS', default=30, cast=int)
+
+# Tokens resolved to users are kept in memory of every process for AUTH_TOKEN_CACHE_TIMEOUT seconds,
+# up to AUTH_TOKEN_CACHE_SIZE of them. Deleted tokens and changed users are dropped right away
+# only in the process which made the change, others may accept them until the timeout.
+# Tokens are also kept in the default cache for AUTH_TOKEN_SHARED_CACHE_TIMEOUT seconds, 0 disables it
+AUTH_TOKEN_CACHE_SIZE = config('AUTH_TOKEN_CACHE_SIZE', default=10000, cast=int)
+AUTH_TOKEN_CACHE_TIMEOUT = config('AUTH_TOKEN_CACHE_TIMEOUT', default=30, cast=int)
+AUTH_TOKEN_SHARED_CACHE_TIMEOUT = config('AUTH_TOKEN_SHARED_CACHE_TIMEOUT', default=0, cast=int)
+
+# Signed access and refresh tokens, lifetimes are in seconds. JWT_SIGNING_KEYS are `id:secret` pairs,
+# new tokens are signed with the key JWT_SIGNING_KEY_ID, tokens signed with other listed keys are still accepted
+JWT_SIGNING_KEYS = dict(key.split(':', 1) for key in config('JWT_SIGNING_KEYS', default='', cast=Csv())) \
+    or {'default': SECRET_KEY}
+JWT_SIGNING_KEY_ID = config('JWT_SIGNING_KEY_ID', default=next(iter(JWT_SIGNING_KEYS)))
+JWT_ALGORITHM = 'HS256'
+JWT_ACCESS_TOKEN_LIFETIME = config('JWT_ACCESS_TOKEN_LIFETIME', default=300, cast=int)
+JWT_REFRESH_TOKEN_LIFETIME = config('JWT_REFRESH_TOKEN_LIFETIME', default=14 * 24 * 3600, cast=int)
+# Revoked access tokens are reloaded from the database by every process at most this often
+JWT_REVOCATION_REFRESH_INTERVAL = config('JWT_REVOCATION_REFRESH_INTERVAL', default=5, cast=int)
+
+# Requests are measured by truechat.instrumentation, metrics are served at /metrics/ to requests
+# with `Authorization: Bearer <METRICS_TOKEN>`, the endpoint is disabled while METRICS_TOKEN is not set.
+# INSTRUMENTATION_LOG writes a JSON line per request
+INSTRUMENTATION_LOG = config('INSTRUMENTATION_LOG', default=False, cast=bool)
+INSTRUMENTATION_N_PLUS_ONE = config('INSTRUMENTATION_N_PLUS_ONE', default=DEBUG, cast=bool)
+INSTRUMENTATION_N_PLUS_ONE_THRESHOLD = config('INSTRUMENTATION_N_PLUS_ONE_THRESHOLD', default=5, cast=int)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# Results of `manage.py benchmark` are saved to this directory
+BENCHMARK_DIR = config('BENCHMARK_DIR', default=os.path.join(os.path.dirname(BASE_DIR), 'benchmarks'))
+# Memory for building indexes of tables after `manage.py seed_data` writes millions of rows into them
+BULK_LOAD_MAINTENANCE_WORK_MEM = config('BULK_LOAD_MAINTENANCE_WORK_MEM', default='512MB')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'truechat': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
 
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
+# Connections are kept open between requests for DATABASE_CONN_MAX_AGE seconds.
+# With DATABASE_POOL_SIZE they are taken from a pool shared by threads of the process instead,
+# which bounds the number of connections a process opens
+DATABASE_POOL_SIZE = config('DATABASE_POOL_SIZE', default=0, cast=int)
+DATABASE_CONN_MAX_AGE = 0 if DATABASE_POOL_SIZE else config('DATABASE_CONN_MAX_AGE', default=600, cast=int)
+DATABASE_POOL = {
+    'MAX_SIZE': DATABASE_POOL_SIZE,
+    'TIMEOUT': config('DATABASE_POOL_TIMEOUT', default=10, cast=float),
+    'CHECK_INTERVAL': config('DATABASE_POOL_CHECK_INTERVAL', default=30, cast=float),
+    'MAX_AGE': config('DATABASE_POOL_MAX_AGE', default=None, cast=lambda value: value and float(value)),
+}
 DATABASES = {
     'default': dj_database_url.config(
-        default=config('DATABASE_URL')
+        default=config('DATABASE_URL'),
+        conn_max_age=DATABASE_CONN_MAX_AGE,
     )
 }
 
+# Read-only views are served by replicas from comma separated DATABASE_REPLICA_URLS,
+# users stay on the primary for DATABASE_REPLICA_STICKY_SECONDS after their writes
+DATABASE_REPLICAS = []
+for number, url in enumerate(config('DATABASE_REPLICA_URLS', default='', cast=Csv()), start=1):
+    DATABASES[f'replica{number}'] = dict(dj_database_url.parse(url, conn_max_age=DATABASE_CONN_MAX_AGE),
+                                         TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append(f'replica{number}')
+DATABASE_REPLICA_STICKY_SECONDS = config('DATABASE_REPLICA_STICKY_SECONDS', default=5, cast=int)
+if DATABASE_REPLICAS and not SHARED_CACHE:
+    # users are stuck to the primary in the default cache, the next request may be served by another process
+    raise ImproperlyConfigured('DATABASE_REPLICA_URLS need a shared cache, set CACHE_BACKEND and CACHE_LOCATION')
+DATABASE_ROUTERS = ['truechat.replicas.ReplicaRouter']
+
+if DATABASE_POOL_SIZE:
+    for database in DATABASES.values():
+        database['ENGINE'] = 'truechat.db_pool'
+        database['POOL'] = DATABASE_POOL
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
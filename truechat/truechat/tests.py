@@ -0,0 +1,411 @@
+import csv
+import json
+import os
+import runpy
+import shutil
+import tempfile
+import threading
+from contextlib import closing
+from io import StringIO
+from unittest import mock
+
+import psycopg2
+from psycopg2 import extensions
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITransactionTestCase
+
+from attachments.models import Image
+from chat.models import Chat, Membership, Message
+from custom_auth.models import User
+
+from truechat.benchmark.data import PREFIX
+from truechat.benchmark.loaders import CopyWriter
+from truechat.db_pool.base import DatabaseWrapper, pool_stats
+from truechat.db_pool.pool import ConnectionPool, PoolTimeout
+from truechat.instrumentation import InstrumentationMiddleware, RequestMetrics, normalize_sql, registry, \
+    render_metrics
+from truechat.warmup import warm_up
+
+GUNICORN_CONFIG = os.path.join(os.path.dirname(settings.BASE_DIR), 'gunicorn.conf.py')
+
+
+class GunicornConfigTest(SimpleTestCase):
+    def load(self, **environ):
+        with mock.patch.dict(os.environ, dict(dict(REDIS_URL='redis://localhost:6379'), **environ)):
+            return runpy.run_path(GUNICORN_CONFIG)
+
+    def test_defaults(self):
+        config = self.load(PORT='5000')
+        self.assertEqual(config['bind'], '0.0.0.0:5000')
+        self.assertEqual(config['worker_class'], 'sync')
+        self.assertTrue(config['preload_app'])
+        self.assertTrue(os.path.exists(os.path.join(config['chdir'], 'manage.py')))
+
+    def test_threads_switch_to_gthread_workers(self):
+        config = self.load(WEB_CONCURRENCY='3', GUNICORN_THREADS='8', GUNICORN_PRELOAD='false')
+        self.assertEqual((config['workers'], config['threads'], config['worker_class']), (3, 8, 'gthread'))
+        self.assertFalse(config['preload_app'])
+
+    def test_events_need_redis(self):
+        with self.assertRaisesMessage(RuntimeError, 'REDIS_URL must be set'):
+            self.load(REDIS_URL='')
+
+
+class WarmUpTest(TransactionTestCase):
+    def test_warm_up_loads_content_types_and_closes_connections(self):
+        ContentType.objects.clear_cache()
+        connection.ensure_connection()
+        with self.assertLogs('truechat.warmup', 'INFO'):
+            warm_up()
+        self.assertIsNone(connection.connection)
+        with self.assertNumQueries(0):
+            ContentType.objects.get_for_model(get_user_model())
+
+
+class ConnectionPoolTest(TransactionTestCase):
+    def connect(self):
+        return psycopg2.connect(**connection.get_connection_params())
+
+    def make_pool(self, **options):
+        pool = ConnectionPool(**options)
+        self.addCleanup(pool.close_all)
+        return pool
+
+    def test_connections_are_reused(self):
+        pool = self.make_pool(max_size=2)
+        first = pool.acquire(self.connect)
+        pool.release(first)
+        self.assertIs(pool.acquire(self.connect), first)
+        self.assertEqual(pool.get_stats()['checkouts'], 2)
+        self.assertEqual(pool.get_stats()['created'], 1)
+        pool.release(first)
+
+    def test_checkout_waits_for_free_connection(self):
+        pool = self.make_pool(max_size=1, timeout=5)
+        first = pool.acquire(self.connect)
+        threading.Timer(0.1, pool.release, [first]).start()
+        self.assertIs(pool.acquire(self.connect), first)
+        stats = pool.get_stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertGreater(stats['max_wait_time'], 0)
+        pool.release(first)
+
+    def test_checkout_times_out_when_pool_is_full(self):
+        pool = self.make_pool(max_size=1, timeout=0.05)
+        first = pool.acquire(self.connect)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(self.connect)
+        self.assertEqual(pool.get_stats()['timeouts'], 1)
+        pool.release(first)
+
+    def test_broken_connection_is_replaced(self):
+        pool = self.make_pool(max_size=1, check_interval=0)
+        first = pool.acquire(self.connect)
+        pid = first.get_backend_pid()
+        pool.release(first)
+        with closing(self.connect()) as other, other.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [pid])
+        second = pool.acquire(self.connect)
+        self.assertIsNot(second, first)
+        self.assertEqual(pool.get_stats()['discarded'], 1)
+        pool.release(second)
+
+    def test_unfinished_transaction_is_rolled_back(self):
+        pool = self.make_pool(max_size=1)
+        first = pool.acquire(self.connect)
+        with first.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        self.assertEqual(first.get_transaction_status(), extensions.TRANSACTION_STATUS_INTRANS)
+        pool.release(first)
+        self.assertEqual(first.get_transaction_status(), extensions.TRANSACTION_STATUS_IDLE)
+
+    def test_connections_inherited_through_fork_are_not_closed(self):
+        pool = self.make_pool(max_size=1)
+        first = pool.acquire(self.connect)
+        self.addCleanup(first.close)
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            pool.release(first)
+            self.assertEqual(pool.get_stats()['size'], 0)
+        self.assertFalse(first.closed)
+
+    def test_database_wrapper_checks_connections_out_of_pool(self):
+        settings_dict = dict(connection.settings_dict, ENGINE='truechat.db_pool', POOL={'MAX_SIZE': 1})
+        wrappers = [DatabaseWrapper(settings_dict) for _ in range(2)]
+        for wrapper in wrappers:
+            wrapper.ensure_connection()
+            self.assertEqual(wrapper.cursor().execute('SELECT 1'), None)
+            wrapper.close()
+        self.addCleanup(wrappers[0].pool.close_all)
+        self.assertIs(wrappers[0].pool, wrappers[1].pool)
+        self.assertEqual(pool_stats()['default']['created'], 1)
+        self.assertEqual(pool_stats()['default']['checkouts'], 2)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(APITransactionTestCase):
+    """The replica is a second connection to the test database, queries are told apart by their connections"""
+    databases = {'default', 'replica'}
+
+    @classmethod
+    def setUpClass(cls):
+        connections.databases['replica'] = dict(connections.databases['default'], TEST={'MIRROR': 'default'})
+        super(ReplicaRoutingTest, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ReplicaRoutingTest, cls).tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.databases['replica']
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        self.chat = Chat.objects.create(name='chat', creator=self.user)
+        self.chat.users.add(self.user)
+        Message.objects.create(chat=self.chat, user=self.user, content='hello')
+        self.client.force_authenticate(self.user)
+
+    def get(self, url):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in primary], [query['sql'] for query in replica]
+
+    def test_listed_actions_read_from_replica(self):
+        primary, replica = self.get(f'/chats/{self.chat.id}/messages/')
+        # payloads of messages are built on the replica too
+        self.assertTrue([sql for sql in replica if 'FROM "messages" INNER JOIN "chats"' in sql])
+        self.assertTrue([sql for sql in replica if 'FROM "Picture"' in sql])
+        self.assertFalse([sql for sql in primary if 'FROM "messages"' in sql or 'FROM "Picture"' in sql])
+
+    @override_settings(SHARED_CACHE=True)
+    def test_payloads_built_from_replica_are_not_cached(self):
+        self.get('/chats/')
+        primary, replica = self.get('/chats/')
+        self.assertTrue([sql for sql in replica if '"chats"."description"' in sql])
+        self.client.post(f'/chats/{self.chat.id}/add_message/', {'content': 'again'}, format='json')
+        # users stuck to the primary build payloads which are cached
+        self.get('/chats/')
+        primary, replica = self.get('/chats/')
+        self.assertEqual(replica, [])
+        self.assertFalse([sql for sql in primary if '"chats"."description"' in sql])
+
+    def test_access_is_checked_on_primary(self):
+        primary, replica = self.get(f'/chats/{self.chat.id}/messages/')
+        access = 'SELECT "Membership"."id", "Membership"."is_banned" FROM'
+        self.assertTrue([sql for sql in primary if sql.startswith(access)])
+        self.assertFalse([sql for sql in replica if sql.startswith(access)])
+        self.assertTrue([sql for sql in replica if 'FROM "messages"' in sql])
+
+    def test_writers_are_stuck_to_primary(self):
+        response = self.client.post(f'/chats/{self.chat.id}/add_message/', {'content': 'again'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        primary, replica = self.get('/chats/')
+        self.assertEqual(replica, [])
+
+    def test_replicas_need_shared_cache(self):
+        environ = {'DATABASE_REPLICA_URLS': os.environ['DATABASE_URL'],
+                   'CACHE_BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+        with mock.patch.dict(os.environ, environ), self.assertRaises(ImproperlyConfigured):
+            runpy.run_module('truechat.settings')
+        with mock.patch.dict(os.environ, environ, SHARED_CACHE='true'):
+            self.assertEqual(runpy.run_module('truechat.settings')['DATABASE_REPLICAS'], ['replica1'])
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        registry.clear()
+
+    def test_statements_differing_in_parameters_are_grouped(self):
+        sql = 'SELECT "users"."id" FROM "users" WHERE "users"."id" IN (%s, %s, %s) AND "users"."username" = %s'
+        self.assertEqual(normalize_sql(sql), 'SELECT "users"."id" FROM "users" WHERE "users"."id" IN (?) '
+                                             'AND "users"."username" = ?')
+        self.assertEqual(normalize_sql("SELECT 1 FROM \"users\" WHERE \"username\" = 'it''s' LIMIT 21"),
+                         'SELECT ? FROM "users" WHERE "username" = ? LIMIT ?')
+
+    def test_requests_are_measured(self):
+        user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        token = Token.objects.create(user=user)
+        response = self.client.get('/profiles/owner', HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        (key, stats), = [(key, stats) for key, stats in registry.snapshot().items() if key[1] == 'GET']
+        self.assertEqual(key, ('profiles', 'GET'))
+        self.assertEqual(stats['requests'], 1)
+        self.assertGreater(stats['queries'], 0)
+        self.assertEqual(stats['response_bytes'], len(response.content))
+
+    @override_settings(INSTRUMENTATION_N_PLUS_ONE=True, INSTRUMENTATION_N_PLUS_ONE_THRESHOLD=3)
+    def test_n_plus_one_queries_are_reported(self):
+        def view(request):
+            for pk in range(3):
+                User.objects.filter(pk=pk).exists()
+            return HttpResponse()
+
+        with self.assertLogs('truechat.instrumentation', 'WARNING') as logs:
+            InstrumentationMiddleware(view)(RequestFactory().get('/'))
+        self.assertIn('3 times SELECT', logs.output[0])
+
+    def test_label_values_are_escaped(self):
+        registry.record('profiles/(?P<name>\\w+|"x")\n', 'GET', 200, 0.01, RequestMetrics(False), 0)
+        self.assertIn('truechat_requests_total{endpoint="profiles/(?P<name>\\\\w+|\\"x\\")\\n",method="GET"} 1',
+                      render_metrics())
+
+    def test_metrics_are_disabled_without_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_require_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('truechat_requests_total{endpoint="', response.content.decode())
+        self.assertIn('truechat_auth_token_cache_misses ', response.content.decode())
+
+
+class BenchmarkTest(TransactionTestCase):
+    """Data is committed, as the benchmark makes requests from threads with their own connections"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def seed(self, **options):
+        options = dict(dict(users=30, chats=4, members=5, dialogs=6, messages=300, images=20, seed=1), **options)
+        call_command('seed_data', stdout=StringIO(), **options)
+
+    def benchmark(self, *scenarios, **options):
+        output = os.path.join(self.dir, 'results.json')
+        stdout = StringIO()
+        call_command('benchmark', *scenarios, requests=4, concurrency=2, warmup=1, users=10, output=output,
+                     stdout=stdout, **options)
+        with open(output) as file:
+            return json.load(file), stdout.getvalue()
+
+    def test_generated_data_can_be_cleared(self):
+        self.seed()
+        users = User.objects.filter(username__startswith=PREFIX)
+        self.assertEqual(users.count(), 30)
+        self.assertEqual(Message.objects.count(), 300)
+        self.assertEqual(Image.objects.count(), 20)
+        chats = Chat.objects.filter(is_dialog=False)
+        self.assertEqual(chats.count(), 4)
+        self.assertFalse(Chat.objects.filter(last_message__isnull=True, messages__isnull=False).exists())
+        membership = Membership.objects.first()
+        self.assertEqual((membership.last_read_message_id, membership.is_banned), (0, False))
+        self.assertTrue(users.first().check_password('benchmark'))
+
+        User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        call_command('seed_data', clear=True, stdout=StringIO())
+        self.assertEqual(list(User.objects.values_list('username', flat=True)), ['owner'])
+        self.assertFalse(Chat.objects.exists() or Message.objects.exists() or Image.objects.exists())
+
+    def test_generation_is_deterministic(self):
+        self.seed()
+        first = list(Message.objects.order_by('id').values_list('user__username', 'content'))
+        call_command('seed_data', clear=True, stdout=StringIO())
+        self.seed(batch_size=7)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('user__username', 'content')), first)
+
+    def test_benchmark_saves_results(self):
+        self.seed()
+        results, output = self.benchmark('list', 'scroll', 'send')
+        self.assertEqual(set(results['results']), {'list', 'scroll', 'send'})
+        summary = results['results']['list']['chats-list']
+        self.assertEqual((summary['requests'], summary['errors']), (4, 0))
+        self.assertLessEqual(summary['p50_ms'], summary['p99_ms'])
+        self.assertEqual(results['results']['send']['chats-add-message']['errors'], 0)
+        self.assertEqual(Message.objects.count(), 300 + 4 + 2)
+
+        baseline = os.path.join(self.dir, 'baseline.json')
+        shutil.copy(os.path.join(self.dir, 'results.json'), baseline)
+        results, output = self.benchmark('list', baseline=baseline)
+        self.assertIn('vs baseline: p50_ms', output)
+
+    def test_benchmark_requires_data(self):
+        with self.assertRaisesMessage(CommandError, 'run seed_data first'):
+            self.benchmark()
+        with self.assertRaisesMessage(CommandError, 'Unknown scenarios: nothing'):
+            self.benchmark('nothing')
+
+
+class ImportDataTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, table, header, *rows):
+        with open(os.path.join(self.dir, f'{table}.csv'), 'w', newline='') as file:
+            csv.writer(file).writerows([header, *rows])
+
+    def test_missing_columns_get_defaults(self):
+        self.write('User', ['id', 'username', 'email', 'password'], [1001, 'reader', 'reader@truechat.com', '!'])
+        self.write('chats', ['id', 'name', 'creator_id'], [1001, 'imported', 1001])
+        self.write('Membership', ['id', 'chat_id', 'user_id'], [1001, 1001, 1001])
+        self.write('messages', ['id', 'chat_id', 'user_id', 'content'], [1001, 1001, 1001, 'hello'])
+        self.write('Picture', ['id', 'name', 'imageURL', 'content_type_id', 'object_id'],
+                   [1001, 'photo', '/photo.png', ContentType.objects.get_for_model(User).id, 1001])
+        call_command('seed_data', import_dir=self.dir, stdout=StringIO())
+
+        user = User.objects.get(pk=1001)
+        self.assertTrue(user.is_active)
+        self.assertIsNotNone(user.date_joined)
+        self.assertEqual(Chat.objects.get(pk=1001).last_message_id, 1001)
+        membership = Membership.objects.get(pk=1001)
+        self.assertEqual((membership.last_read_message_id, membership.notifications), (0, True))
+        image = Image.objects.get(pk=1001)
+        self.assertEqual((image.status, image.variants), (Image.READY, {}))
+        # defaults exist only for the time of the load
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM information_schema.columns WHERE table_name = 'Picture' "
+                           "AND column_name IN ('status', 'variants') AND column_default IS NOT NULL")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_columns_without_defaults_are_required(self):
+        self.write('User', ['id', 'username', 'email', 'password'], [1001, 'reader', 'reader@truechat.com', '!'])
+        self.write('chats', ['id', 'name', 'creator_id'], [1001, 'imported', 1001])
+        self.write('Membership', ['id', 'chat_id'], [1001, 1001])
+        with self.assertRaisesMessage(CommandError, 'Column user_id of Membership is required'):
+            call_command('seed_data', import_dir=self.dir, stdout=StringIO())
+        self.assertFalse(User.objects.exists())
+
+
+class DeferredIndexesTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='owner', email='owner@truechat.com', password='password')
+        chat = Chat.objects.create(name='chat', creator=user)
+        Message.objects.bulk_create([Message(chat=chat, user=user, content='hello') for _ in range(100)])
+        with connection.cursor() as cursor:
+            # checks of foreign keys deferred by the test transaction would keep tables from being altered
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    def indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM pg_indexes WHERE tablename LIKE 'messages%%'")
+            return cursor.fetchone()[0]
+
+    def test_indexes_of_partitioned_table_are_kept_for_few_rows(self):
+        call_command('partition_messages', 'range', '--ahead', '1', stdout=StringIO())
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE messages')
+        indexes = self.indexes()
+        with CopyWriter().deferred_indexes(Message, 50):
+            self.assertEqual(self.indexes(), indexes)
+        with CopyWriter().deferred_indexes(Message, 500):
+            self.assertLess(self.indexes(), indexes)
+        self.assertEqual(self.indexes(), indexes)
@@ -3,7 +3,9 @@ from django.contrib import admin
 from django.urls import path, re_path
 from rest_framework_swagger.views import get_swagger_view
 
-from custom_auth.views import UserListView, UserAPIViewChange, confirm_email, user_upload_image
+from custom_auth.views import UserListView, UserAPIViewChange, confirm_email, obtain_tokens, refresh_token, \
+    revoke_tokens, user_upload_image
+from truechat.instrumentation import metrics
 
 schema_view = get_swagger_view(title='TrueChat API')
 
@@ -20,10 +22,14 @@ urlpatterns = [
         name='account_email_verification_sent'),
 
     url(r'^rest-auth/registration/', include('rest_auth.registration.urls')),
+    url(r'^auth/token/$', obtain_tokens, name='auth_token'),
+    url(r'^auth/token/refresh/$', refresh_token, name='auth_token_refresh'),
+    url(r'^auth/token/revoke/$', revoke_tokens, name='auth_token_revoke'),
+    url(r'^metrics/$', metrics, name='metrics'),
 
-    url(r'profile/upload_image/', user_upload_image),
-    re_path(r'profile/(?P<username>\w+|)', UserAPIViewChange.as_view()),
-    re_path(r'profiles/(?P<search_string>\w+|)', UserListView.as_view()),
+    url(r'profile/upload_image/', user_upload_image, name='profile_upload_image'),
+    re_path(r'profile/(?P<username>\w+|)', UserAPIViewChange.as_view(), name='profile'),
+    re_path(r'profiles/(?P<search_string>\w+|)', UserListView.as_view(), name='profiles'),
     re_path(r'images/', include('attachments.urls')),
 
     re_path(r'chats/', include('chat.urls')),
@@ -0,0 +1,33 @@
+"""
+Warm-up of a server process before it accepts requests
+
+Loads what would otherwise be loaded by the first requests of every worker: URL resolvers
+together with all views and serializers imported by URL configuration, and content types
+used by generic image relations. With preloading enabled it runs once in the master process
+and workers share the result after fork.
+"""
+import logging
+import time
+
+from django.apps import apps
+from django.db import DatabaseError, connections
+from django.urls import get_resolver
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up():
+    from django.contrib.contenttypes.models import ContentType
+
+    started = time.monotonic()
+    resolver = get_resolver()
+    # populates reverse lookups and imports all views
+    resolver.reverse_dict
+    try:
+        ContentType.objects.get_for_models(*apps.get_models())
+    except DatabaseError:
+        logger.warning('Content types are not loaded, database is unavailable', exc_info=True)
+    finally:
+        # connections must not be shared by forked workers
+        connections.close_all()
+    logger.info('Warmed up in %.3fs', time.monotonic() - started)
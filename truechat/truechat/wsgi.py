@@ -3,6 +3,9 @@ import os
 from django.core.wsgi import get_wsgi_application
 from whitenoise.django import DjangoWhiteNoise
 
+from truechat.warmup import warm_up
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'truechat.settings')
 
 application = DjangoWhiteNoise(get_wsgi_application())
+warm_up()